@@ -1,14 +1,71 @@
 from flask import Flask
 import os
 
-app = Flask(__name__)
-app.config.from_object('config')
 
-if os.environ.get('HEROKU') is not None:
-    import logging
-    stream_handler = logging.StreamHandler()
-    app.logger.addHandler(stream_handler)
-    app.logger.setLevel(logging.INFO)
-    app.logger.info('web-to-email startup')
+def create_app(config=None):
+    """
+    Creates the app and configures the shared caches, clients and pools from its settings. They are
+    shared by the whole process, so the last app created sets them for every app
+    :param config: settings to use over the ones in config.py
+    :return:
+    """
+    app = Flask(__name__)
+    app.config.from_object('config')
+    if config is not None:
+        app.config.update(config)
 
-from app import views
+    if os.environ.get('HEROKU') is not None:
+        import logging
+        stream_handler = logging.StreamHandler()
+        app.logger.addHandler(stream_handler)
+        app.logger.setLevel(logging.INFO)
+        app.logger.info('web-to-email startup')
+
+    configure_shared(app.config)
+
+    from app.views import main
+    from app.commands import COMMANDS
+    app.register_blueprint(main)
+    for command in COMMANDS:
+        app.cli.add_command(command)
+
+    return app
+
+
+def configure_shared(config):
+    """
+    Configures the caches, clients and pools the whole process shares, e.g. to go back to the
+    settings of an app after another one was created
+    :param config: an app config
+    :return:
+    """
+    from app.cache import conversion_cache, block_cache
+    from app.styles import stylesheet_cache
+    from app.http_client import http_client
+    from app.link_checker import link_checker
+    from app.images import image_prober
+    from app.slack import slack_reporter
+    from app.domains import domain_extractor
+    from app.instrumentation import instrumentation
+    from app.workers import process_pool
+    from app.backends import document_backends
+    from app.singleflight import conversion_flights
+    from app.prewarm import prewarm_queue
+    from app.compactor import output_compactor
+    http_client.configure(config)
+    conversion_cache.configure(config)
+    block_cache.configure(config)
+    link_checker.configure(config)
+    image_prober.configure(config)
+    slack_reporter.configure(config)
+    stylesheet_cache.configure(config)
+    domain_extractor.load()
+    instrumentation.configure(config)
+    process_pool.configure(config)
+    document_backends.configure(config)
+    conversion_flights.configure(config)
+    prewarm_queue.configure(config)
+    output_compactor.configure(config)
+
+
+app = create_app()
@@ -0,0 +1,124 @@
+from utils import MessagingScraper
+from styles import stylesheet_cache, download_stylesheet
+from workers import PooledMessagingScraper, process_pool
+from incremental import IncrementalMessagingScraper
+from singleflight import SingleFlightScraper, conversion_flights
+
+try:
+    import gevent
+    import gevent.pool
+    from gevent import monkey
+except ImportError:
+    # gevent is only needed to serve with the gevent worker, MessagingScraper is used without it
+    gevent = None
+
+
+def is_cooperative():
+    """
+    Returns True when gevent has patched the socket module, e.g. in a gunicorn gevent worker, so
+    requests waiting on the network let other greenlets run
+    :return:
+    """
+    return gevent is not None and monkey.is_module_patched('socket')
+
+
+class AsyncMessagingScraper(MessagingScraper):
+    """
+    MessagingScraper for gevent workers. Network waits (the page, its stylesheets, link checks and
+    image probes) yield to other greenlets through gevent's patched sockets, so one worker serves
+    many conversions waiting on upstream servers. The stylesheets of a page are downloaded
+    concurrently before inlining, instead of one after another by Premailer.
+
+    Parsing and inlining hold the CPU, and stay on the greenlet: once gevent has patched threading,
+    the locks and thread locals of Premailer and the caches can't be used from native threads. The
+    scraper yields between stages instead, so requests that are waiting on the network get answered
+    in between
+
+    scrape keeps its signature and blocks the calling greenlet, scrape_async and scrape_many
+    convert in new greenlets
+    """
+    def __init__(self, *args, **kwargs):
+        if gevent is None:
+            raise RuntimeError('AsyncMessagingScraper needs gevent, install it with pip install gevent')
+        MessagingScraper.__init__(self, *args, **kwargs)
+
+    def after_parse(self, soup):
+        gevent.sleep(0)
+
+    def before_inline(self, soup):
+        self.prefetch_stylesheets(soup)
+
+        gevent.sleep(0)
+
+    def scrape_async(self, url, page=None):
+        """
+        Starts scraping a page in a new greenlet
+        :param url:
+        :param page:
+        :return: a Greenlet, whose get() returns what scrape does or raises what it raised
+        """
+        return gevent.spawn(self.scrape, url, page)
+
+    def scrape_many(self, urls, concurrency=10):
+        """
+        Scrapes pages concurrently
+        :param urls:
+        :param concurrency: the most pages scraped at once
+        :return: a generator of (url, greenlet) in the order the scrapes finish, the greenlets have
+        finished and get() returns their result or raises their exception
+        """
+        pool = gevent.pool.Pool(concurrency)
+
+        def scrape(url):
+            greenlet = gevent.spawn(self.scrape, url)
+            greenlet.join()
+            return url, greenlet
+
+        return pool.imap_unordered(scrape, urls)
+
+    def prefetch_stylesheets(self, soup):
+        """
+        Downloads the external stylesheets of a page into the stylesheet cache at the same time, so
+        Premailer finds them there. Stylesheets that fail are left for Premailer to report
+        :param soup: a page whose urls have been made absolute
+        :return: True if every stylesheet is in the cache
+        """
+        urls = set()
+        for link in self.utils.backend.iter_tags(soup, ['link']):
+            href = link.get('href', '')
+            if 'stylesheet' in link.get('rel', []) and href.startswith(('http://', 'https://')):
+                urls.add(href)
+
+        def load(url):
+            # noinspection PyBroadException
+            try:
+                stylesheet_cache.load(url, lambda: download_stylesheet(url))
+                return True
+            except Exception:
+                return False
+
+        greenlets = [gevent.spawn(load, url) for url in urls]
+        gevent.joinall(greenlets)
+        return all(greenlet.value for greenlet in greenlets)
+
+
+def scraper_for(config):
+    """
+    Returns the scraper for the app config: the PooledMessagingScraper when the process pool is
+    enabled, the IncrementalMessagingScraper when INCREMENTAL_INLINING is set, the
+    AsyncMessagingScraper in a gevent worker, the MessagingScraper otherwise. Concurrent
+    conversions of the same url are coalesced unless SINGLE_FLIGHT is turned off
+    :param config:
+    :return:
+    """
+    if process_pool.enabled:
+        scraper = PooledMessagingScraper.from_config(config)
+    elif config.get('INCREMENTAL_INLINING'):
+        scraper = IncrementalMessagingScraper.from_config(config)
+    elif is_cooperative():
+        scraper = AsyncMessagingScraper.from_config(config)
+    else:
+        scraper = MessagingScraper.from_config(config)
+    if conversion_flights.enabled:
+        return SingleFlightScraper(scraper)
+    return scraper
@@ -0,0 +1,383 @@
+import collections
+import itertools
+import re
+import bs4
+from lxml import etree
+
+# the attributes BeautifulSoup splits into lists of values, by tag name, '*' for every tag
+LIST_ATTRIBUTES = {
+    '*': ('class', 'accesskey', 'dropzone'),
+    'a': ('rel', 'rev'),
+    'link': ('rel', 'rev'),
+    'td': ('headers', ),
+    'th': ('headers', ),
+    'form': ('accept-charset', ),
+    'object': ('archive', ),
+    'area': ('rel', ),
+    'icon': ('sizes', ),
+    'iframe': ('sandbox', ),
+    'output': ('for', ),
+}
+
+# tags BeautifulSoup writes as <tag/> when they have no content
+EMPTY_ELEMENT_TAGS = frozenset(['br', 'hr', 'input', 'img', 'meta', 'spacer', 'link', 'frame', 'base'])
+
+# tags whose text BeautifulSoup writes without escaping it
+CDATA_TAGS = frozenset(['script', 'style'])
+
+# tags in which BeautifulSoup keeps strings of whitespace as they are, and the characters it takes as whitespace
+PRESERVE_WHITESPACE_TAGS = ('pre', 'textarea')
+ASCII_SPACES = ' \n\t\x0c\r'
+
+whitespace_re = re.compile(r'\s+')
+markup_re = re.compile(r'[<>&]')
+markup_entities = {'<': '&lt;', '>': '&gt;', '&': '&amp;'}
+
+
+# LIST_ATTRIBUTES of each tag name, including the ones of every tag
+list_attributes_by_tag = dict((name, frozenset(LIST_ATTRIBUTES['*'] + keys)) for name, keys in LIST_ATTRIBUTES.items())
+list_attributes_of_any_tag = list_attributes_by_tag['*']
+
+
+def list_attributes(tag_name):
+    return list_attributes_by_tag.get(tag_name, list_attributes_of_any_tag)
+
+
+def escape_markup(text):
+    return markup_re.sub(lambda match: markup_entities[match.group(0)], text)
+
+
+def has_text(text):
+    """
+    Returns True if a string has content other than whitespace, stripped the way is_empty_tag strips
+    the utf-8 bytes of BeautifulSoup strings
+    :param text: a string of an lxml tree, or None
+    :return:
+    """
+    return text is not None and len(text.strip(' \t\n\r\x0b\x0c')) > 0
+
+
+def collapse_whitespace(text):
+    """
+    Returns a string the way BeautifulSoup keeps it when parsing: a newline if it is only whitespace
+    with a newline in it, a space if it is only whitespace, otherwise as it is
+    :param text: a string of an lxml tree, or None
+    :return:
+    """
+    if not text or text.strip(ASCII_SPACES):
+        return text
+    return '\n' if '\n' in text else ' '
+
+
+def collapse_tree_whitespace(document):
+    """
+    Collapses the strings of whitespace of an lxml tree, text, tails and comments, the way
+    BeautifulSoup does, except in pre and textarea tags
+    :param document: the root element
+    :return:
+    """
+    preserved = set()
+    for element in document.iter(*PRESERVE_WHITESPACE_TAGS):
+        if element not in preserved:
+            preserved.update(element.iter())
+    for element in document.iter():
+        if element not in preserved:
+            element.text = collapse_whitespace(element.text)
+        parent = element.getparent()
+        if parent is None or parent not in preserved:
+            element.tail = collapse_whitespace(element.tail)
+
+
+def quote_attribute(value):
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', '&quot;') + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+def soup_html(element):
+    """
+    Writes an lxml element the way BeautifulSoup writes the same tag, so both backends report the
+    same html for the tags of an error
+    :param element:
+    :return: the html of the element, without its tail, as a unicode string
+    """
+    name = element.tag
+    split_keys = list_attributes(name)
+    parts = [u'<', name]
+    for key, value in sorted(element.attrib.items()):
+        if key in split_keys:
+            value = ' '.join(whitespace_re.split(value))
+        parts.append(u' ' + key + u'=' + quote_attribute(escape_markup(value)))
+
+    escape = (lambda text: text) if name in CDATA_TAGS else escape_markup
+    if element.text is None and len(element) == 0 and name in EMPTY_ELEMENT_TAGS:
+        parts.append(u'/>')
+        return u''.join(parts)
+
+    parts.append(u'>')
+    if element.text:
+        parts.append(escape(element.text))
+    for child in element:
+        if isinstance(child, etree._Comment):
+            parts.append(u'<!--' + (child.text or u'') + u'-->')
+        elif isinstance(child, etree._ProcessingInstruction):
+            parts.append(u'<?' + child.target + u' ' + (child.text or u'') + u'>')
+        elif isinstance(child.tag, basestring):
+            parts.append(soup_html(child))
+        if child.tail:
+            parts.append(escape(child.tail))
+    parts.append(u'</' + name + u'>')
+    return u''.join(parts)
+
+
+class LxmlAttributes(collections.MutableMapping):
+    """
+    The attributes of an lxml element, read and written like the attrs of a BeautifulSoup tag: the
+    attributes BeautifulSoup splits, like class, are lists of values
+    """
+    __slots__ = ('element', 'split_keys')
+
+    def __init__(self, element):
+        self.element = element
+        self.split_keys = list_attributes(element.tag)
+
+    def __getitem__(self, key):
+        value = self.element.get(key)
+        if value is None:
+            raise KeyError(key)
+        if key in self.split_keys:
+            return whitespace_re.split(value)
+        return value
+
+    def get(self, key, default=None):
+        value = self.element.get(key)
+        if value is None:
+            return default
+        if key in self.split_keys:
+            return whitespace_re.split(value)
+        return value
+
+    def __setitem__(self, key, value):
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(value)
+        self.element.set(key, value)
+
+    def __delitem__(self, key):
+        del self.element.attrib[key]
+
+    def __contains__(self, key):
+        return self.element.get(key) is not None
+
+    def __iter__(self):
+        return iter(self.element.attrib)
+
+    def __len__(self):
+        return len(self.element.attrib)
+
+
+class LxmlTag(object):
+    """
+    An lxml element wrapped to be visited by the DocumentVisitors, which were written for
+    BeautifulSoup tags: it has the name, attrs, item access and str() of one
+    """
+    __slots__ = ('element', 'name', 'attrs')
+
+    def __init__(self, element):
+        self.element = element
+        self.name = element.tag
+        self.attrs = LxmlAttributes(element)
+
+    @property
+    def sourceline(self):
+        return self.element.sourceline
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def __setitem__(self, key, value):
+        self.attrs[key] = value
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def is_empty(self):
+        """
+        Returns True if the tag has no child tags and no text other than whitespace, like is_empty_tag
+        :return:
+        """
+        if has_text(self.element.text):
+            return False
+        for child in self.element:
+            if isinstance(child.tag, basestring) or has_text(child.text) or has_text(child.tail):
+                return False
+        return True
+
+    def __unicode__(self):
+        return soup_html(self.element)
+
+    def __str__(self):
+        return soup_html(self.element).encode('utf-8')
+
+
+class SoupBackend(object):
+    """
+    Parses pages with BeautifulSoup (on the lxml parser), the checks visit bs4 tags and the page is
+    serialized and parsed again by lxml for Premailer
+    """
+    name = 'soup'
+
+    # whether Premailer changes the tags the checks visited
+    inlines_in_place = False
+
+    def parse(self, page):
+        """
+        :param page: a FetchedPage
+        :return: the page's BeautifulSoup
+        """
+        return page.soup
+
+    def iter_tags(self, document, names=None):
+        """
+        Returns the tags of a document in document order
+        :param document:
+        :param names: the tag names to return, every tag when None
+        :return:
+        """
+        tags = (child for child in document.descendants if isinstance(child, bs4.element.Tag))
+        if names is None:
+            return tags
+        names = frozenset(names)
+        return (tag for tag in tags if tag.name in names)
+
+    def find_all(self, document, name, attrs):
+        return document.find_all(name, attrs)
+
+    def wrap_content(self, document):
+        """
+        Moves the contents of the body into a div with the content_div class
+        :param document:
+        :return:
+        """
+        body = document.body
+
+        content_div = document.new_tag('div')
+
+        content_div.attrs['class'] = 'content_div'
+
+        for content in reversed(body.contents):
+            content_div.insert(0, content.extract())
+
+        body.append(content_div)
+
+    def to_etree(self, document):
+        """
+        Returns the lxml tree Premailer inlines the page in
+        :param document:
+        :return: the root element
+        """
+        return etree.fromstring(self.serialize(document), etree.HTMLParser(encoding='utf-8'))
+
+    def serialize(self, document):
+        return document.encode(formatter='html')
+
+
+class LxmlBackend(object):
+    """
+    Parses pages with lxml.html only. The checks visit the elements they are interested in through
+    LxmlTag wrappers, and Premailer inlines the same tree, so a conversion parses the page once and
+    never builds a BeautifulSoup tree. Attributes are put in the order BeautifulSoup writes them
+    before inlining, so both backends return the same html
+    """
+    name = 'lxml'
+
+    inlines_in_place = True
+
+    def parse(self, page):
+        """
+        :param page: a FetchedPage
+        :return: the root element of the page's lxml tree, with whitespace collapsed like BeautifulSoup does
+        """
+        document = page.tree
+        collapse_tree_whitespace(document)
+        return document
+
+    def iter_tags(self, document, names=None):
+        if names is None:
+            names = (etree.Element, )
+        elif not names:
+            return iter([])
+        # the root element stands for the whole document, like a BeautifulSoup does
+        elements = document.iter(*names) if document.getparent() is None else document.iterdescendants(*names)
+        return itertools.imap(LxmlTag, elements)
+
+    def find_all(self, document, name, attrs):
+        return [element for element in document.iter(name)
+                if all(element.get(key) == value for key, value in attrs.items())]
+
+    def wrap_content(self, document):
+        body = document.find('body')
+
+        content_div = etree.Element('div')
+
+        content_div.set('class', 'content_div')
+
+        content_div.text, body.text = body.text, None
+
+        for content in list(body):
+            content_div.append(content)
+
+        body.append(content_div)
+
+    def to_etree(self, document):
+        for element in document.iter(etree.Element):
+            keys = element.keys()
+            if len(keys) > 1 and keys != sorted(keys):
+                items = sorted(element.items())
+                element.attrib.clear()
+                for key, value in items:
+                    element.set(key, value)
+            split_keys = list_attributes(element.tag)
+            for key in keys:
+                if key in split_keys:
+                    value = element.get(key)
+                    joined = ' '.join(whitespace_re.split(value))
+                    if joined != value:
+                        element.set(key, joined)
+        return document
+
+    def serialize(self, document):
+        return etree.tostring(document, method='html', encoding='utf-8')
+
+
+BACKENDS = {
+    SoupBackend.name: SoupBackend,
+    LxmlBackend.name: LxmlBackend,
+}
+
+
+def get_backend(name):
+    """
+    Returns a document backend by name
+    :param name: soup or lxml
+    :raises: ValueError: for other names
+    :return:
+    """
+    if name not in BACKENDS:
+        raise ValueError('Unknown parser backend %r, expected one of %s' % (name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name]()
+
+
+class DocumentBackends(object):
+    """
+    Holds the backend conversions parse pages with when none is given, chosen by PARSER_BACKEND
+    """
+    def __init__(self):
+        self.default = SoupBackend()
+
+    def configure(self, config):
+        self.default = get_backend(config.get('PARSER_BACKEND', self.default.name))
+
+
+document_backends = DocumentBackends()
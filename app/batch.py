@@ -0,0 +1,92 @@
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from form_validators import fetch_messaging_page
+from utils import MessagingScraper
+from async_scraper import scraper_for
+from workers import PoolFullException
+
+
+def convert_url(url, config, shared=False):
+    """
+    Validates and converts one url
+    :param url:
+    :param config: the app config, or a dictionary of its settings
+    :param shared: whether to convert with the scraper requests get from scraper_for, so the url
+    shares a conversion in progress for a request and waits its turn in the process pool
+    :return: a dictionary with the url, whether it was converted, the seconds it took and either the
+    inlined content and errors or the reason it couldn't be converted. A url turned away by a full
+    process pool has the seconds to wait before retrying it as retry_after
+    """
+    started = time.time()
+    result = {'url': url}
+
+    # noinspection PyBroadException
+    try:
+        page = fetch_messaging_page(url)
+        scraper = scraper_for(config) if shared else MessagingScraper.from_config(config)
+        content, errors = scraper.scrape(url, page=page)
+        result['ok'] = True
+        result['content'] = content
+        result['errors'] = [error_category.to_dict() for error_category in errors]
+    except ValueError as e:
+        # ValidationErrors, and malformed urls
+        result['ok'] = False
+        result['error'] = str(e)
+    except PoolFullException as e:
+        result['ok'] = False
+        result['error'] = str(e)
+        result['retry_after'] = e.retry_after
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+
+def convert_url_args(args):
+    """
+    convert_url for pool.imap_unordered, which passes a single argument
+    :param args: a (url, config, shared) tuple
+    :return:
+    """
+    return convert_url(*args)
+
+
+class BatchConverter(object):
+    """
+    Converts many urls on a pool of threads, or of processes when processes is True, yielding each
+    result as soon as it is done. The threads convert like requests do, through the process pool and
+    single-flight when they are enabled, the processes each convert on their own
+    """
+    def __init__(self, config, workers=4, processes=False):
+        self.config = dict(config)
+        self.workers = workers
+        self.processes = processes
+
+    def convert(self, urls):
+        """
+        Converts the urls, duplicates are converted once
+        :param urls:
+        :return: a generator of convert_url results, in the order they finish
+        """
+        unique_urls = []
+        seen = set()
+        for url in urls:
+            url = url.strip()
+            if url and url not in seen:
+                seen.add(url)
+                unique_urls.append(url)
+        if not unique_urls:
+            return
+
+        if self.processes:
+            pool = Pool(self.workers)
+        else:
+            pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(convert_url_args, [(url, self.config, not self.processes) for url in unique_urls]):
+                yield result
+        finally:
+            pool.terminate()
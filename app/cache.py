@@ -0,0 +1,349 @@
+import os
+import pickle
+import hashlib
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from singleflight import normalize_url
+
+# changed whenever ConversionEntry changes, so entries pickled by an older release are never read
+ENTRY_FORMAT_VERSION = 2
+
+# the settings a cached conversion's content and errors depend on
+CONVERSION_SETTINGS = ('PARSER_BACKEND', 'OUTPUT_COMPACTION', 'OUTPUT_SIZE_BUDGET', 'CHECK_BROKEN_LINKS',
+                       'PROBE_IMAGE_SIZES')
+
+
+class LRUCache(object):
+    """
+    In-process cache that evicts the least recently used entry once it holds max_size entries,
+    and entries older than ttl seconds
+    """
+    def __init__(self, max_size=128, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or None if it's missing or expired
+        :param key:
+        :return:
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            stored, value = self.entries.pop(key)
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                return None
+            self.entries[key] = (stored, value)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FileCache(object):
+    """
+    Cache that pickles each entry into its own file in a directory, so that every gunicorn worker
+    on a dyno sees the same entries. Entries older than ttl seconds are ignored, and the oldest
+    files are removed once the directory holds more than max_size of them
+    """
+    def __init__(self, directory, max_size=1024, ttl=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path_for(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.cache')
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or None if it's missing, expired or unreadable
+        :param key:
+        :return:
+        """
+        path = self.path_for(key)
+
+        # noinspection PyBroadException
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except Exception:
+            return None
+
+    def set(self, key, value):
+        """
+        Writes the entry to a temporary file and renames it into place so readers never see a
+        partially written entry
+        :param key:
+        :param value:
+        :return:
+        """
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as cache_file:
+            pickle.dump(value, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self.path_for(key))
+        self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path_for(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self.cache_files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def cache_files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith('.cache')]
+
+    def prune(self):
+        """
+        Removes the oldest entries once there are more than max_size of them
+        :return:
+        """
+        paths = self.cache_files()
+        if self.max_size is None or len(paths) <= self.max_size:
+            return
+        dated_paths = []
+        for path in paths:
+            try:
+                dated_paths.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        dated_paths.sort()
+        for mtime, path in dated_paths[:len(dated_paths) - self.max_size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def after_fork(self):
+        # the files are shared, nothing is held in the process
+        pass
+
+    def __len__(self):
+        return len(self.cache_files())
+
+
+class ConversionEntry(object):
+    """
+    A cached conversion of a page, along with the validators needed to check it is still current.
+    The errors leave out the broken and unverified links and images, resources holds the
+    ResourceErrors to check them again with
+    """
+    def __init__(self, url, content_hash, etag, last_modified, content, errors, resources=()):
+        self.url = url
+        self.content_hash = content_hash
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content = content
+        self.errors = errors
+        self.resources = list(resources)
+
+
+class ConversionCache(object):
+    """
+    Caches the (content, errors) result of MessagingScraper.scrape per url. Before a cached result
+    is used, the page is requested again with If-None-Match / If-Modified-Since, and the result is
+    reused when the server answers 304 Not Modified or sends back byte for byte the same page.
+
+    Entries are keyed by the normalized url and the settings the conversion depends on, so a
+    change of settings or of the entry format doesn't serve entries from a shared directory that
+    were converted differently
+    """
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = LRUCache()
+        self.backend = backend
+        self.fingerprint = self.settings_fingerprint({})
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def configure(self, config):
+        """
+        Picks the cache backend from the app config: a shared directory when CONVERSION_CACHE_DIR
+        is set, otherwise an in-process LRU cache
+        :param config:
+        :return:
+        """
+        size = config.get('CONVERSION_CACHE_SIZE', 128)
+        ttl = config.get('CONVERSION_CACHE_TTL')
+        directory = config.get('CONVERSION_CACHE_DIR')
+        if directory:
+            self.backend = FileCache(directory, max_size=size, ttl=ttl)
+        else:
+            self.backend = LRUCache(max_size=size, ttl=ttl)
+        self.fingerprint = self.settings_fingerprint(config)
+
+    @staticmethod
+    def settings_fingerprint(config):
+        settings = [(name, config.get(name)) for name in CONVERSION_SETTINGS]
+        return hashlib.sha1(repr(settings)).hexdigest()[:12]
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.backend.after_fork()
+
+    def key_for(self, url):
+        """
+        Returns the key the conversion of a url is cached under
+        :param url:
+        :return:
+        """
+        return '%d %s %s' % (ENTRY_FORMAT_VERSION, self.fingerprint, normalize_url(url))
+
+    def get(self, url):
+        return self.backend.get(self.key_for(url))
+
+    def conditional_headers(self, entry):
+        """
+        Returns the headers that make a GET for a cached entry conditional
+        :param entry: a ConversionEntry or None
+        :return:
+        """
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def fetch_page(self, url, utils):
+        """
+        Fetches a page, revalidating any cached conversion of it. The returned page's cached
+        attribute holds the ConversionEntry to reuse, or None if the page has to be converted
+        :param url:
+        :param utils: the ArticleUtils used to fetch the page
+        :return: a FetchedPage
+        """
+        entry = self.get(url)
+        page = utils.fetch_page(url, headers=self.conditional_headers(entry))
+        if entry is not None and page.is_not_modified():
+            page.cached = entry
+            self.count('not_modified')
+        elif entry is not None and page.is_ok() and page.content_hash == entry.content_hash:
+            page.cached = entry
+        if page.cached is not None:
+            self.count('hits')
+        else:
+            self.count('misses')
+        return page
+
+    def store(self, page, content, errors, resources=()):
+        """
+        Caches the conversion of a fetched page. The statuses of its links and images are left out,
+        they are kept by the LinkChecker for a shorter time
+        :param page: the FetchedPage that was converted
+        :param content:
+        :param errors:
+        :param resources: the ResourceErrors of the urls the LinkChecker checked for the errors
+        :return:
+        """
+        if not page.is_ok():
+            return
+        if resources:
+            errors = list(errors)
+            for resource in resources:
+                resource.remove_errors(errors)
+        # the entry mustn't keep the parsed page alive
+        for error_category in errors:
+            error_category.detach()
+        for resource in resources:
+            resource.detach()
+        entry = ConversionEntry(page.url, page.content_hash, page.headers.get('etag'),
+                                page.headers.get('last-modified'), content, errors, resources)
+        self.backend.set(self.key_for(page.url), entry)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'entries': len(self.backend),
+        }
+
+
+class BlockCache(object):
+    """
+    Caches the conversion of the top-level blocks of pages' content, keyed by a hash of each
+    block's html and of everything else its inlining depends on. Used by the
+    IncrementalMessagingScraper to convert only the blocks of a page that changed
+    """
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = LRUCache(max_size=2048)
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+        self.backend = LRUCache(max_size=config.get('BLOCK_CACHE_SIZE', 2048),
+                                ttl=config.get('CONVERSION_CACHE_TTL'))
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.backend.after_fork()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        self.count('hits' if value is not None else 'misses')
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'blocks': len(self.backend),
+        }
+
+
+conversion_cache = ConversionCache()
+block_cache = BlockCache()
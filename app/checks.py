@@ -0,0 +1,432 @@
+from urlparse import urljoin
+import time
+import bs4
+from errors import ErrorCategory, ErrorType, TagRef
+from backends import has_text
+from link_checker import LinkChecker
+
+
+class DocumentVisitor(object):
+    """
+    Base class for everything ArticleUtils.walk dispatches tags to. visit is called for each tag
+    whose name is in tag_names, or for every tag when tag_names is None
+    """
+    tag_names = None
+
+    # whether visitors of the class can be merged, pages are only converted block by block by the
+    # IncrementalMessagingScraper when every check can be
+    mergeable = False
+
+    def visit(self, tag):
+        pass
+
+    def resource_urls(self):
+        """
+        Returns the urls the visitor wants checked by the LinkChecker once the walk is done
+        :return:
+        """
+        return []
+
+    def resolve(self, statuses):
+        """
+        Receives the LinkChecker status of each url returned by resource_urls, before result is called
+        :param statuses: a dictionary of url to LinkChecker status
+        :return:
+        """
+        pass
+
+    def resource_errors(self):
+        """
+        Returns the ResourceErrors of the urls the visitor had checked, to be checked again when a
+        cached conversion is reused, or None
+        :return:
+        """
+        return None
+
+    def result(self):
+        """
+        Returns the ErrorCategory found by the visitor once the walk is done, or None if the
+        visitor doesn't check anything
+        :return:
+        """
+        return None
+
+    def detach(self):
+        """
+        Writes the html of the tags the visitor holds and drops its references to the tree once it
+        has been visited, so the tree can be inlined in place, or the visitor pickled and finished in
+        another process
+        :return:
+        """
+        pass
+
+    def merge(self, other):
+        """
+        Adds what another visitor of the same class found in a later part of the document, before
+        either of them is finished
+        :param other:
+        :return:
+        """
+        raise NotImplementedError()
+
+
+class UrlRewriter(DocumentVisitor):
+    """
+    converts the urls of images, iframes, links and stylesheets from relative to full urls
+    """
+    tag_names = ('img', 'iframe', 'a', 'link')
+
+    url_attributes = {
+        'img':      'src',
+        'iframe':   'src',
+        'a':        'href',
+        'link':     'href',
+    }
+
+    def __init__(self, page_url):
+        self.page_url = page_url
+
+    def visit(self, tag):
+        attribute = self.url_attributes[tag.name]
+        if attribute in tag.attrs:
+            tag.attrs[attribute] = urljoin(self.page_url, tag.attrs[attribute])
+
+
+class ImageSizer(DocumentVisitor):
+    """
+    fills in missing width and height attributes of images from the size of the image files. The
+    sizes are read in the background while the rest of the page is walked
+    """
+    tag_names = ('img', )
+
+    def __init__(self, image_prober):
+        self.image_prober = image_prober
+        self.images_by_src = {}
+        self.pending = {}
+        self.started = None
+
+    def visit(self, image):
+        if 'width' in image.attrs and 'height' in image.attrs:
+            return
+        src = image.attrs.get('src', '').strip()
+        if not self.image_prober.is_probeable(src):
+            return
+        if src not in self.pending:
+            if self.started is None:
+                self.started = time.time()
+            self.pending[src] = self.image_prober.start(src)
+        self.images_by_src.setdefault(src, []).append(image)
+
+    def result(self):
+        if self.pending:
+            sizes = self.image_prober.wait(self.pending, self.started)
+            for src, images in self.images_by_src.items():
+                if src in sizes:
+                    for image in images:
+                        set_image_size(image, sizes[src])
+        return None
+
+
+def set_image_size(image, size):
+    """
+    sets the width and height attributes of an image that is missing one or both of them, keeping
+    the image's aspect ratio when one of them is already set
+    :param image:
+    :param size: the (width, height) of the image file
+    :return:
+    """
+    width, height = size
+    if width == 0 or height == 0:
+        return
+    if 'width' in image.attrs:
+        if image['width'].strip().isdigit():
+            image['height'] = str(int(round(int(image['width']) * height / float(width))))
+    elif 'height' in image.attrs:
+        if image['height'].strip().isdigit():
+            image['width'] = str(int(round(int(image['height']) * width / float(height))))
+    else:
+        image['width'] = str(width)
+        image['height'] = str(height)
+
+
+def is_empty_tag(tag):
+    """
+    Returns True if a tag has no child tags and no text other than whitespace. Only the tag's own
+    strings are looked at, nothing is serialized
+    :param tag:
+    :return:
+    """
+    if not isinstance(tag, bs4.element.Tag):
+        # the tags of the lxml backend
+        return tag.is_empty()
+    for content in tag.contents:
+        if isinstance(content, bs4.element.Tag) or has_text(content):
+            return False
+    return True
+
+
+def add_resource_errors(tags_by_url, statuses, broken, not_verified):
+    """
+    Adds the tags whose url the LinkChecker found broken or couldn't verify to the matching error types
+    :param tags_by_url: a dictionary of url to the TagRefs of the tags using it
+    :param statuses: a dictionary of url to LinkChecker status
+    :param broken: the ErrorType for broken urls
+    :param not_verified: the ErrorType for urls that weren't checked in time
+    :return:
+    """
+    for url, tags in tags_by_url.items():
+        status = statuses.get(url)
+        if status == LinkChecker.BROKEN:
+            error_type = broken
+        elif status == LinkChecker.NOT_VERIFIED:
+            error_type = not_verified
+        else:
+            continue
+        for tag in tags:
+            error_type.add_tag(tag)
+
+
+def merge_tags(tags_by_url, other_tags_by_url):
+    """
+    Adds the tags of a url to tags dictionary to another one
+    :param tags_by_url: the dictionary added to
+    :param other_tags_by_url:
+    :return:
+    """
+    for url, tags in other_tags_by_url.items():
+        tags_by_url.setdefault(url, []).extend(tags)
+
+
+def detach_tags(tags_by_url, *error_types):
+    """
+    Writes the html of the TagRefs a check holds, in a url to tags dictionary and in its error types
+    :param tags_by_url:
+    :param error_types:
+    :return:
+    """
+    for tags in tags_by_url.values():
+        for tag in tags:
+            tag.detach()
+    for error_type in error_types:
+        error_type.detach()
+
+
+class ResourceErrors(object):
+    """
+    The tags of a check by the urls the LinkChecker checked for it, and the names of the error types
+    and category the broken and unverified ones go in. Kept with a cached conversion instead of those
+    error types, whose statuses only hold for LINK_CHECK_TTL, so the urls are checked again each time
+    the conversion is reused
+    """
+    def __init__(self, category, tags_by_url, broken, not_verified):
+        self.category = category
+        self.tags_by_url = tags_by_url
+        self.broken = broken
+        self.not_verified = not_verified
+
+    def urls(self):
+        return list(self.tags_by_url)
+
+    def find_category(self, errors):
+        for index, error_category in enumerate(errors):
+            if error_category.category == self.category:
+                return index
+        return None
+
+    def remove_errors(self, errors):
+        """
+        Replaces the category in a list of errors with a copy without the broken and unverified urls
+        :param errors: a list of ErrorCategory objects
+        :return:
+        """
+        index = self.find_category(errors)
+        if index is None:
+            return
+        error_category = errors[index].copy()
+        error_category.remove_type(self.broken)
+        error_category.remove_type(self.not_verified)
+        errors[index] = error_category
+
+    def add_errors(self, errors, statuses):
+        """
+        Replaces the category in a list of errors with a copy that has the broken and unverified urls
+        :param errors: a list of ErrorCategory objects
+        :param statuses: a dictionary of url to LinkChecker status
+        :return:
+        """
+        broken = ErrorType(self.broken)
+        not_verified = ErrorType(self.not_verified)
+        add_resource_errors(self.tags_by_url, statuses, broken, not_verified)
+        index = self.find_category(errors)
+        if index is None or not (broken.tags or not_verified.tags):
+            return
+        error_category = errors[index].copy()
+        for error_type in (broken, not_verified):
+            if len(error_type.tags) > 0:
+                error_category.add_type(error_type)
+        errors[index] = error_category
+
+    def detach(self):
+        detach_tags(self.tags_by_url)
+
+
+class ImageCheck(DocumentVisitor):
+    """
+    Checks image tags for errors including:
+        - missing alt attribute
+        - missing src attribute
+        - broken link, when the ArticleUtils has a LinkChecker
+    """
+    tag_names = ('img', )
+    mergeable = True
+
+    def __init__(self, utils):
+        self.category = ErrorCategory('Image Check')
+        self.missing_src = ErrorType('Missing source')
+        self.missing_alt = ErrorType('Missing alt text')
+        self.broken_image = ErrorType('Broken image')
+        self.image_not_verified = ErrorType('Image not verified')
+        self.images_by_src = {}
+
+    def visit(self, image):
+        ref = TagRef(image)
+
+        if 'src' not in image.attrs:
+            self.missing_src.add_tag(ref)
+        elif len(image['src'].lstrip().rstrip()) == 0:
+            self.missing_src.add_tag(ref)
+        else:
+            self.images_by_src.setdefault(image['src'].strip(), []).append(ref)
+
+        if 'alt' in image.attrs:
+            alt = image.attrs['alt'].lstrip().rstrip()
+            if len(alt) == 0:
+                self.missing_alt.add_tag(ref)
+        else:
+            self.missing_alt.add_tag(ref)
+
+    def resource_urls(self):
+        return list(self.images_by_src)
+
+    def resolve(self, statuses):
+        add_resource_errors(self.images_by_src, statuses, self.broken_image, self.image_not_verified)
+
+    def resource_errors(self):
+        return ResourceErrors(self.category.category, self.images_by_src, self.broken_image.name,
+                              self.image_not_verified.name)
+
+    def detach(self):
+        detach_tags(self.images_by_src, self.missing_src, self.missing_alt)
+
+    def merge(self, other):
+        self.missing_src.tags.extend(other.missing_src.tags)
+        self.missing_alt.tags.extend(other.missing_alt.tags)
+        merge_tags(self.images_by_src, other.images_by_src)
+
+    def result(self):
+        if len(self.missing_src.tags) > 0:
+            self.category.add_type(self.missing_src)
+
+        if len(self.missing_alt.tags) > 0:
+            self.category.add_type(self.missing_alt)
+
+        if len(self.broken_image.tags) > 0:
+            self.category.add_type(self.broken_image)
+
+        if len(self.image_not_verified.tags) > 0:
+            self.category.add_type(self.image_not_verified)
+
+        return self.category
+
+
+class LinkCheck(DocumentVisitor):
+    """
+    Checks <a> tags for errors including:
+        - no content
+        - missing href attribute
+        - broken link, when the ArticleUtils has a LinkChecker
+    """
+    tag_names = ('a', )
+    mergeable = True
+
+    def __init__(self, utils):
+        self.category = ErrorCategory('Link Check')
+        self.empty_link = ErrorType('Empty link')
+        self.missing_href = ErrorType('Missing href')
+        self.broken_link = ErrorType('Broken link')
+        self.link_not_verified = ErrorType('Link not verified')
+        self.links_by_href = {}
+
+    def visit(self, link):
+        ref = TagRef(link)
+
+        if is_empty_tag(link):
+            self.empty_link.add_tag(ref)
+
+        if 'href' not in link.attrs:
+            self.missing_href.add_tag(ref)
+        elif len(link['href'].lstrip().rstrip()) == 0:
+            self.missing_href.add_tag(ref)
+        else:
+            self.links_by_href.setdefault(link['href'].strip(), []).append(ref)
+
+    def resource_urls(self):
+        return list(self.links_by_href)
+
+    def resolve(self, statuses):
+        add_resource_errors(self.links_by_href, statuses, self.broken_link, self.link_not_verified)
+
+    def resource_errors(self):
+        return ResourceErrors(self.category.category, self.links_by_href, self.broken_link.name,
+                              self.link_not_verified.name)
+
+    def detach(self):
+        detach_tags(self.links_by_href, self.empty_link, self.missing_href)
+
+    def merge(self, other):
+        self.empty_link.tags.extend(other.empty_link.tags)
+        self.missing_href.tags.extend(other.missing_href.tags)
+        merge_tags(self.links_by_href, other.links_by_href)
+
+    def result(self):
+        if len(self.empty_link.tags) > 0:
+            self.category.add_type(self.empty_link)
+
+        if len(self.missing_href.tags) > 0:
+            self.category.add_type(self.missing_href)
+
+        if len(self.broken_link.tags) > 0:
+            self.category.add_type(self.broken_link)
+
+        if len(self.link_not_verified.tags) > 0:
+            self.category.add_type(self.link_not_verified)
+
+        return self.category
+
+
+class TagCheck(DocumentVisitor):
+    """
+    Checks content tags (headings, paragraphs and list items) for tags without content
+    """
+    mergeable = True
+
+    def __init__(self, utils):
+        self.tag_names = tuple(utils.content_tags_dict)
+        self.category = ErrorCategory('Tag Check')
+        self.empty_tag = ErrorType('Empty tag')
+
+    def visit(self, tag):
+        if is_empty_tag(tag):
+            self.empty_tag.add_tag(tag)
+
+    def detach(self):
+        self.empty_tag.detach()
+
+    def merge(self, other):
+        self.empty_tag.tags.extend(other.empty_tag.tags)
+
+    def result(self):
+        if len(self.empty_tag.tags) > 0:
+            self.category.add_type(self.empty_tag)
+
+        return self.category
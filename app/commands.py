@@ -0,0 +1,76 @@
+import json
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from batch import BatchConverter
+from prewarm import PrewarmJob, PrewarmWorker, prewarm_queue
+
+
+@click.command()
+@click.argument('urls', nargs=-1)
+@click.option('--file', 'url_file', type=click.File('r'), help='Read urls from a file, one per line.')
+@click.option('--workers', default=4, help='Number of urls converted at once.')
+@click.option('--processes', is_flag=True, help='Convert on a pool of processes instead of threads.')
+@click.option('--output', type=click.File('w'), default='-', help='File to write the results to.')
+@with_appcontext
+def convert(urls, url_file, workers, processes, output):
+    """
+    Converts emailbuilder urls and writes one json result per line as each url finishes
+    """
+    urls = list(urls)
+    if url_file is not None:
+        urls.extend(line.strip() for line in url_file if line.strip())
+
+    started = time.time()
+    converted = failed = 0
+    converter = BatchConverter(current_app.config, workers=workers, processes=processes)
+    for result in converter.convert(urls):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+        if result['ok']:
+            converted += 1
+        else:
+            failed += 1
+            click.echo('%s: %s' % (result['url'], result['error']), err=True)
+        click.echo('%.3fs %s' % (result['seconds'], result['url']), err=True)
+
+    click.echo('%d converted, %d failed in %.1fs' % (converted, failed, time.time() - started), err=True)
+
+
+@click.command()
+@click.argument('urls', nargs=-1)
+@click.option('--index', 'indexes', multiple=True, help='An index page or sitemap whose pages to queue.')
+@click.option('--file', 'url_file', type=click.File('r'), help='Read urls from a file, one per line.')
+@with_appcontext
+def prewarm(urls, indexes, url_file):
+    """
+    Queues emailbuilder urls to be converted ahead of time by the prewarm-worker
+    """
+    if not prewarm_queue.enabled:
+        raise click.UsageError('Set PREWARM_QUEUE_PATH to queue urls')
+    urls = list(urls)
+    if url_file is not None:
+        urls.extend(line.strip() for line in url_file if line.strip())
+
+    queued = sum(prewarm_queue.enqueue(url) for url in urls)
+    queued += sum(prewarm_queue.enqueue(url, PrewarmJob.INDEX) for url in indexes)
+    click.echo('%d queued, %d already waiting' % (queued, len(urls) + len(indexes) - queued), err=True)
+
+
+@click.command('prewarm-worker')
+@click.option('--poll-interval', default=1.0, help='Seconds to wait when no url is due.')
+@with_appcontext
+def prewarm_worker(poll_interval):
+    """
+    Converts the queued urls into the conversion cache, until stopped
+    """
+    if not prewarm_queue.enabled:
+        raise click.UsageError('Set PREWARM_QUEUE_PATH to convert queued urls')
+    if not current_app.config.get('CONVERSION_CACHE_DIR'):
+        click.echo('CONVERSION_CACHE_DIR is not set, the web workers won\'t see the conversions', err=True)
+    PrewarmWorker(prewarm_queue, current_app.config).run(poll_interval)
+
+
+# the commands create_app adds to the flask command
+COMMANDS = [convert, prewarm, prewarm_worker]
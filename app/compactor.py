@@ -0,0 +1,220 @@
+import cgi
+import re
+from lxml import etree
+from errors import ErrorCategory, ErrorType
+
+# Gmail shows a link to the rest of a message instead of the message once its html is over about 102 KB
+GMAIL_CLIP_BYTES = 102000
+
+# declarations that set a property to the value it has anyway. Only properties that aren't inherited
+# and that no browser or email client styles by default are listed, so leaving them out changes nothing
+DEFAULT_VALUES = {
+    'background-image': 'none',
+    'background-repeat': 'repeat',
+    'box-shadow': 'none',
+    'clear': 'none',
+    'float': 'none',
+    'max-height': 'none',
+    'max-width': 'none',
+    'opacity': '1',
+    'position': 'static',
+    'transform': 'none',
+    'z-index': 'auto',
+}
+
+# the attributes whose effect an inline style of these properties overrides, a declaration of a
+# default value is kept on elements that have them
+PRESENTATIONAL_ATTRIBUTES = {
+    'background-image': ('background', ),
+    'background-repeat': ('background', ),
+    'float': ('align', ),
+    'clear': ('clear', ),
+}
+
+# shorthands and the properties they set, a declaration of one of those before the shorthand is overridden
+SHORTHANDS = {
+    'margin': ('margin-top', 'margin-right', 'margin-bottom', 'margin-left'),
+    'padding': ('padding-top', 'padding-right', 'padding-bottom', 'padding-left'),
+}
+
+# elements whose whitespace is shown as it is
+PREFORMATTED_TAGS = frozenset(['pre', 'textarea', 'script', 'style'])
+
+whitespace_re = re.compile(r'[ \t\n\r\f]+')
+zero_length_re = re.compile(r'(?<![\w.#-])0(?:px|em|rem|pt|pc|ex|in|cm|mm)\b')
+declaration_re = re.compile(r'''((?:[^;"'(]|"[^"]*"|'[^']*'|\([^)]*\))+)''')
+
+
+def parse_declarations(style):
+    """
+    Splits a style attribute into its declarations, leaving semicolons in strings and url()s alone
+    :param style:
+    :return: a list of (property, value, important) tuples, properties in lower case
+    """
+    declarations = []
+    for match in declaration_re.finditer(style):
+        name, colon, value = match.group(1).partition(':')
+        name = name.strip().lower()
+        value = ' '.join(value.split())
+        if not colon or not name or not value:
+            continue
+        important = value.lower().endswith('!important')
+        if important:
+            value = value[:-len('!important')].rstrip()
+        declarations.append((name, value, important))
+    return declarations
+
+
+def compact_value(value):
+    """
+    Writes zero lengths without their unit, except in strings and urls
+    :param value:
+    :return:
+    """
+    if '(' in value or '"' in value or "'" in value:
+        return value
+    return zero_length_re.sub('0', value)
+
+
+def compact_style(style, element):
+    """
+    Rewrites a style attribute in as few bytes as it takes: a declaration of a property replaces the
+    ones before it, declarations of default values are left out, and the declarations are written
+    without whitespace
+    :param style:
+    :param element: the element the style is on
+    :return: the compacted style, empty if nothing is left of it
+    """
+    kept = []
+    for name, value, important in parse_declarations(style):
+        # an !important declaration isn't overridden by one that isn't
+        if not important and (name, True) in [(kept_name, kept_important) for kept_name, _, kept_important in kept]:
+            continue
+        # a value with a function leaves the ones before it for clients that don't support the function
+        if '(' not in value:
+            overridden = (name, ) + SHORTHANDS.get(name, ())
+            kept = [declaration for declaration in kept
+                    if declaration[0] not in overridden or (declaration[2] and not important)]
+        kept.append((name, compact_value(value), important))
+
+    parts = []
+    for name, value, important in kept:
+        if not important and DEFAULT_VALUES.get(name) == value.lower() and \
+                not any(element.get(attribute) is not None for attribute in PRESENTATIONAL_ATTRIBUTES.get(name, ())):
+            continue
+        parts.append(name + ':' + value + ('!important' if important else ''))
+    return ';'.join(parts)
+
+
+def is_conditional_comment(comment):
+    text = (comment.text or '').strip()
+    return text.startswith('[if') or text.startswith('<![endif]')
+
+
+def compact_element(element, preformatted=False):
+    """
+    Compacts the styles, whitespace and comments of an element and everything in it
+    :param element:
+    :param preformatted: whether the element is in one whose whitespace is shown as it is
+    :return:
+    """
+    if isinstance(element.tag, basestring):
+        style = element.get('style')
+        if style is not None:
+            style = compact_style(style, element)
+            if style:
+                element.set('style', style)
+            else:
+                del element.attrib['style']
+            preformatted = preformatted or 'white-space:pre' in style
+        preformatted = preformatted or element.tag in PREFORMATTED_TAGS
+        if element.text and not preformatted:
+            element.text = whitespace_re.sub(' ', element.text)
+
+    for child in list(element):
+        compact_element(child, preformatted)
+        if child.tail and not preformatted:
+            child.tail = whitespace_re.sub(' ', child.tail)
+        if isinstance(child, etree._Comment) and not is_conditional_comment(child):
+            remove_keeping_tail(child)
+
+
+def remove_keeping_tail(element):
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+    parent.remove(element)
+
+
+def format_bytes(size):
+    return '{:,} bytes'.format(size)
+
+
+class OutputCompactor(object):
+    """
+    Makes the inlined html smaller after Premailer is done with it: styles are rewritten without
+    repeated, overridden or default declarations and without whitespace, runs of whitespace in text
+    become one space, and comments other than conditional comments for Outlook are removed. The
+    size of the result is checked against the budget, Gmail clips messages over it
+    """
+    def __init__(self, enabled=False, budget=GMAIL_CLIP_BYTES):
+        self.enabled = enabled
+        self.budget = budget
+
+    def configure(self, config):
+        self.enabled = config.get('OUTPUT_COMPACTION', self.enabled)
+        self.budget = config.get('OUTPUT_SIZE_BUDGET', self.budget)
+
+    def compact(self, content):
+        """
+        :param content: the inlined html of the content div's contents, as an ascii string
+        :return: the compacted html, as an ascii string
+        """
+        document = etree.fromstring('<div>' + content + '</div>', etree.HTMLParser(encoding='us-ascii'))
+        wrapper = document.find('body/div')
+        compact_element(wrapper)
+
+        compacted = ''
+        if wrapper.text:
+            compacted += cgi.escape(wrapper.text).encode('ascii', 'xmlcharrefreplace')
+        for child in wrapper:
+            compacted += etree.tostring(child, method='html', encoding='us-ascii')
+        return compacted
+
+    def compact_content(self, content):
+        """
+        Compacts the inlined content if enabled, and reports its size
+        :param content: the inlined html of the content div's contents
+        :return: the content, and a Size Check ErrorCategory, or None when compaction is off and the
+        content is within the budget
+        """
+        size = len(content)
+        if self.enabled:
+            content = self.compact(content)
+        elif size <= self.budget:
+            return content, None
+        return content, self.size_check(size, len(content))
+
+    def size_check(self, original_size, size):
+        """
+        :param original_size: the bytes of the html Premailer returned
+        :param size: the bytes of the html sent back
+        :return: an ErrorCategory with the sizes as its summary, and an error if the html is over the budget
+        """
+        size_check = ErrorCategory('Size Check')
+        if size == original_size:
+            size_check.summary = 'The html is %s' % format_bytes(size)
+        else:
+            size_check.summary = 'The html is %s, compacted from %s' % (format_bytes(size), format_bytes(original_size))
+        if size > self.budget:
+            error_type = ErrorType('Over the Gmail clipping limit')
+            error_type.add_tag('%s, Gmail clips messages over %s' % (format_bytes(size), format_bytes(self.budget)))
+            size_check.add_type(error_type)
+        return size_check
+
+
+output_compactor = OutputCompactor()
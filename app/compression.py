@@ -0,0 +1,54 @@
+import gzip
+import io
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, responses are gzipped without it
+    brotli = None
+
+
+def available_encodings():
+    """
+    Returns the content encodings responses can be compressed with, in order of preference
+    :return:
+    """
+    if brotli is not None:
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def gzip_bytes(data, level=6):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level) as gzip_file:
+        gzip_file.write(data)
+    return buf.getvalue()
+
+
+def compress_response(response, accept_encodings, min_size=500):
+    """
+    Compresses the body of a response with the best encoding the client accepts. Streamed responses,
+    responses that are already encoded and bodies smaller than min_size bytes are left as they are
+    :param response: a Flask response
+    :param accept_encodings: the request's accept_encodings
+    :param min_size:
+    :return: the response
+    """
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed or 'Content-Encoding' in response.headers or response.status_code != 200:
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+
+    encoding = accept_encodings.best_match(available_encodings())
+    if encoding == 'br':
+        response.set_data(brotli.compress(data))
+    elif encoding == 'gzip':
+        response.set_data(gzip_bytes(data))
+    else:
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,67 @@
+import threading
+from urlparse import urlparse
+import tldextract
+from cache import LRUCache
+
+
+class DomainExtractor(object):
+    """
+    Finds the registered domain of urls, e.g. ucsc for news.ucsc.edu. The public suffix list is read
+    once from the snapshot bundled with tldextract and never downloaded, the domain of each hostname
+    is kept once found, and known_hosts are answered without a lookup at all
+    """
+    def __init__(self, known_hosts=None, cache_size=4096):
+        if known_hosts is None:
+            known_hosts = {'emailbuilder.ucsc.edu': 'ucsc'}
+        self.known_hosts = known_hosts
+        self.domains = LRUCache(max_size=cache_size)
+        self.extractor = None
+        self.lock = threading.Lock()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.domains.after_fork()
+
+    def load(self):
+        """
+        Reads the bundled public suffix list, done at app startup so the first request doesn't wait on it
+        :return:
+        """
+        extractor = tldextract.TLDExtract(cache_file=False, suffix_list_urls=None, fallback_to_snapshot=True)
+        extractor.update(fetch_now=True)
+        with self.lock:
+            self.extractor = extractor
+
+    def get_extractor(self):
+        if self.extractor is None:
+            self.load()
+        return self.extractor
+
+    def hostname(self, url):
+        """
+        Returns the lower case hostname of a url, which may leave out the scheme
+        :param url:
+        :return:
+        """
+        if '//' not in url:
+            url = '//' + url
+        return (urlparse(url.strip()).hostname or '').rstrip('.')
+
+    def domain(self, url):
+        """
+        Returns the registered domain of a url, without its public suffix
+        :param url:
+        :return: the domain, e.g. ucsc for https://emailbuilder.ucsc.edu/page
+        """
+        hostname = self.hostname(url)
+        if hostname in self.known_hosts:
+            return self.known_hosts[hostname]
+
+        domain = self.domains.get(hostname)
+        if domain is None:
+            domain = self.get_extractor()(hostname).domain
+            self.domains.set(hostname, domain)
+        return domain
+
+
+domain_extractor = DomainExtractor()
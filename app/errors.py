@@ -1,7 +1,84 @@
+import copy
+
+# the most bytes of a tag's html kept for an error, the html of longer tags is cut short
+SNIPPET_LENGTH = 1000
+
+
+class TagRef(object):
+    """
+    A tag an error was found in. The tag's html is only written the first time it is needed, e.g.
+    when the error is rendered, and then the tag is let go and only the first SNIPPET_LENGTH bytes of
+    its html are kept. A tag found by several checks is written once
+    """
+    __slots__ = ('name', 'line', 'tag', '_snippet')
+
+    def __init__(self, tag):
+        self.name = tag.name
+        # BeautifulSoup looks up unknown attributes as child tags, only lxml tags know their line
+        self.line = tag.sourceline if hasattr(type(tag), 'sourceline') else None
+        self.tag = tag
+        self._snippet = None
+
+    @property
+    def snippet(self):
+        """
+        The html of the tag, cut short after SNIPPET_LENGTH bytes
+        :return: a utf-8 encoded str
+        """
+        if self._snippet is None:
+            tag = self.tag
+            if tag is None:
+                # written meanwhile by another request sharing the error
+                return self._snippet
+            html = str(tag)
+            if len(html) > SNIPPET_LENGTH:
+                html = html[:SNIPPET_LENGTH].decode('utf-8', 'ignore').encode('utf-8') + '...'
+            self._snippet = html
+            self.tag = None
+        return self._snippet
+
+    def detach(self):
+        """
+        Writes the tag's html now, e.g. before the tree is changed or the error leaves the process
+        :return:
+        """
+        self.snippet
+
+    def __str__(self):
+        return self.snippet
+
+    def __unicode__(self):
+        return self.snippet.decode('utf-8')
+
+    def __eq__(self, other):
+        if isinstance(other, TagRef):
+            return self.snippet == other.snippet
+        if isinstance(other, str):
+            return self.snippet == other
+        if isinstance(other, unicode):
+            return unicode(self) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.snippet)
+
+    def __getstate__(self):
+        return self.name, self.line, self.snippet
+
+    def __setstate__(self, state):
+        self.name, self.line, self._snippet = state
+        self.tag = None
 
 
 class ErrorCategory(object):
 
+    # a line shown under the category's name, e.g. the sizes of the Size Check
+    summary = None
+
     def __init__(self, category):
         self.category = category
         self.class_name = self.make_class_name(category)
@@ -29,6 +106,39 @@ class ErrorCategory(object):
                 return self.types[name]
         return None
 
+    def copy(self):
+        """
+        Returns a copy of the category whose error types can be added and removed without changing
+        this one, e.g. one that is shared through a cache
+        :return:
+        """
+        error_category = copy.copy(self)
+        if self.types is not None:
+            error_category.types = dict(self.types)
+        return error_category
+
+    def detach(self):
+        if self.types is not None:
+            for error_type in self.types.values():
+                error_type.detach()
+
+    def to_dict(self):
+        """
+        Returns the category and its error types as a dictionary that can be serialized to json
+        :return:
+        """
+        types = []
+        if self.types is not None:
+            types = [error_type.to_dict() for error_type in self.types.values()]
+        result = {
+            'category': self.category,
+            'class_name': self.class_name,
+            'types': types,
+        }
+        if self.summary is not None:
+            result['summary'] = self.summary
+        return result
+
 
 class ErrorType(object):
 
@@ -50,4 +160,22 @@ class ErrorType(object):
         self.class_name = self.make_class_name(new_name)
 
     def add_tag(self, tag):
-        self.tags.append(tag)
\ No newline at end of file
+        """
+        :param tag: a tag of the document, a TagRef to it, or its html
+        :return:
+        """
+        if not isinstance(tag, (basestring, TagRef)):
+            tag = TagRef(tag)
+        self.tags.append(tag)
+
+    def detach(self):
+        for tag in self.tags:
+            if isinstance(tag, TagRef):
+                tag.detach()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'class_name': self.class_name,
+            'tags': [str(tag) for tag in self.tags],
+        }
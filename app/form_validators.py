@@ -1,33 +1,92 @@
 from wtforms import ValidationError
-import tldextract
 import requests
-from bs4 import BeautifulSoup
 import re
+from utils import ArticleUtils
+from cache import conversion_cache
+from domains import domain_extractor
+from singleflight import conversion_flights, normalize_url
+
+# the published pages that can be converted
+MESSAGING_URL_RE = re.compile(r"^http(|s):\/\/emailbuilder.ucsc.edu\/.+")
+
+
+class PageUnavailableError(ValidationError):
+    """
+    Raised for a page that couldn't be loaded or isn't published yet, which may change later
+    """
+    pass
+
+
+def fetch_messaging_page(url):
+    """
+    Validates that a URL points at a level 3 UCSC content page and returns the downloaded page.
+    Concurrent requests for the same url share one download. A request for a url that is being
+    converted waits for the conversion, and then finds it in the conversion cache
+    :param url:
+    :raises: ValidationError: if the url isn't a published emailbuilder.ucsc.edu page
+    :return: a FetchedPage
+    """
+    key = normalize_url(url)
+    conversion_flights.wait(key)
+
+    fetched = []
+
+    def fetch():
+        fetched.append(True)
+        return download_messaging_page(url)
+
+    page = conversion_flights.do('fetch ' + key, fetch)
+    # a page downloaded for another request is converted from its own parse
+    return page if fetched else page.copy()
+
+
+def download_messaging_page(url):
+    """
+    Downloads and validates a page for fetch_messaging_page. Pages with a current entry in the
+    conversion cache were validated when they were converted, so they are not parsed again
+    :param url:
+    :raises: ValidationError: if the url isn't a published emailbuilder.ucsc.edu page, a
+    PageUnavailableError if it couldn't be loaded
+    :return: a FetchedPage
+    """
+    if domain_extractor.domain(url) != 'ucsc':
+        raise ValidationError('URL must belong to a UCSC domain')
+    utils = ArticleUtils()
+    try:
+        page = conversion_cache.fetch_page(url, utils)
+    except ValueError:
+        # malformed urls, reported with requests' own message
+        raise
+    except requests.RequestException:
+        raise PageUnavailableError('That URL could not be loaded. Please try again in a moment.')
+    if page.cached is not None and MESSAGING_URL_RE.match(url):
+        return page
+    if not page.is_ok():
+        raise PageUnavailableError('That URL was not found. Perhaps it isn\'t published yet?')
+    if not page.is_html():
+        raise ValidationError('That URL does not contain HTML')
+    document = utils.backend.parse(page)
+
+    valid = False
+
+    if MESSAGING_URL_RE.match(url):
+        tables = utils.backend.find_all(document, 'table', {'align': 'center', 'summary': 'Email content'})
+        if tables:
+            valid = True
+
+    if not valid:
+        raise ValidationError('URL must be from emailbuilder.ucsc.edu')
+
+    return page
 
 
 class MessagingURl(object):
     """
     Validates that a URL points at a level 3 UCSC content page
+
+    The downloaded page is kept on the field as field.fetched_page so the scraper can reuse it
+    instead of requesting and parsing the page a second time
     """
 
     def __call__(self, form, field):
-        messaging_regex = re.compile(r"^http(|s):\/\/emailbuilder.ucsc.edu\/.+")
-        ext = tldextract.extract(field.data)
-        if ext.domain != 'ucsc':
-            raise ValidationError('URL must belong to a UCSC domain')
-        r = requests.get(field.data)
-        if r.status_code != requests.codes.ok:            
-            raise ValidationError('That URL was not found. Perhaps it isn\'t published yet?')
-        if r.headers['content-type'] != 'text/html; charset=UTF-8':
-            raise ValidationError('That URL does not contain HTML')
-        soup = BeautifulSoup(r.content, 'lxml')
-
-        valid = False
-
-        if messaging_regex.match(field.data):
-            tables = soup.findAll('table', {'align': 'center', 'summary': 'Email content'})
-            if tables is not None:
-                valid = True
-
-        if not valid:
-            raise ValidationError('URL must be from emailbuilder.ucsc.edu')
+        field.fetched_page = fetch_messaging_page(field.data)
@@ -0,0 +1,123 @@
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+class ResponseTooLargeException(requests.RequestException):
+    """
+    Exception for when a response body is larger than the client accepts
+    """
+    def __init__(self, url, max_bytes):
+        requests.RequestException.__init__(self, "Response from %s is larger than %d bytes" % (url, max_bytes))
+
+
+class HttpClient(object):
+    """
+    Shared requests session for every outbound request. Connections are kept alive and pooled per
+    host, every request has a connect and a read timeout, idempotent requests are retried with
+    backoff on connection errors and 502/503/504 responses, and response bodies are capped at
+    max_response_bytes
+    """
+    def __init__(self, connect_timeout=3.05, read_timeout=10, retries=2, backoff_factor=0.3,
+                 pool_size=10, max_response_bytes=10 * 1024 * 1024):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.max_response_bytes = max_response_bytes
+        self.session = self.make_session()
+
+    def configure(self, config):
+        """
+        Reads the HTTP_ settings from the app config and replaces the session
+        :param config:
+        :return:
+        """
+        self.connect_timeout = config.get('HTTP_CONNECT_TIMEOUT', self.connect_timeout)
+        self.read_timeout = config.get('HTTP_READ_TIMEOUT', self.read_timeout)
+        self.retries = config.get('HTTP_RETRIES', self.retries)
+        self.backoff_factor = config.get('HTTP_BACKOFF_FACTOR', self.backoff_factor)
+        self.pool_size = config.get('HTTP_POOL_SIZE', self.pool_size)
+        self.max_response_bytes = config.get('HTTP_MAX_RESPONSE_BYTES', self.max_response_bytes)
+        self.session = self.make_session()
+
+    def after_fork(self):
+        # the pooled connections and their locks are the parent's
+        self.session = self.make_session()
+
+    def make_session(self):
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, url, max_bytes=None, read_body=True, **kwargs):
+        """
+        Sends a request and reads the response body, up to max_bytes
+        :param method:
+        :param url:
+        :param max_bytes: the largest body accepted, max_response_bytes if None
+        :param read_body: when False the connection is released without reading the body, for
+        requests that only need the status and headers
+        :param kwargs: passed on to requests
+        :raises: ResponseTooLargeException: if the body is larger than max_bytes
+        :raises: requests.RequestException: if the request fails or times out
+        :return: a requests Response with its content read
+        """
+        if max_bytes is None:
+            max_bytes = self.max_response_bytes
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        response = self.session.request(method, url, stream=True, **kwargs)
+
+        if not read_body:
+            response.close()
+            return response
+
+        try:
+            content_length = response.headers.get('content-length')
+            if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+                raise ResponseTooLargeException(url, max_bytes)
+
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ResponseTooLargeException(url, max_bytes)
+                chunks.append(chunk)
+        except:
+            response.close()
+            raise
+
+        # the body was streamed to enforce the cap, hand it to requests as if it had read it itself
+        response._content = b''.join(chunks)
+        response._content_consumed = True
+        return response
+
+    def stream(self, url, **kwargs):
+        """
+        Sends a GET without reading the response body, for callers that only need its start. The
+        caller reads what it needs with iter_content and closes the response
+        :param url:
+        :param kwargs: passed on to requests
+        :return: a requests Response
+        """
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        return self.session.request('GET', url, stream=True, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+http_client = HttpClient()
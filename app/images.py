@@ -0,0 +1,142 @@
+import io
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+from PIL import Image
+from cache import LRUCache, FileCache
+from http_client import http_client
+
+
+class ImageException(Exception):
+    def __init__(self, image_url):
+        Exception.__init__(self, "Error getting height and width of image " + image_url)
+
+
+class ImageProber(object):
+    """
+    Reads the width and height of images from the first bytes of each file. Only a Range request
+    for the start of the image is made, and Pillow reads the size from the image header without
+    decoding it. Sizes are kept per url, on disk when a cache directory is configured
+    """
+    def __init__(self, workers=8, deadline=2.0, max_bytes=64 * 1024, chunk_size=8 * 1024, timeout=(3.05, 5),
+                 sizes=None, client=http_client):
+        self.workers = workers
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        if sizes is None:
+            sizes = LRUCache(max_size=4096)
+        self.sizes = sizes
+        self.client = client
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def configure(self, config):
+        self.workers = config.get('IMAGE_PROBE_WORKERS', self.workers)
+        self.deadline = config.get('IMAGE_PROBE_DEADLINE', self.deadline)
+        self.max_bytes = config.get('IMAGE_PROBE_BYTES', self.max_bytes)
+        directory = config.get('IMAGE_SIZE_CACHE_DIR')
+        if directory:
+            self.sizes = FileCache(directory, max_size=config.get('IMAGE_SIZE_CACHE_SIZE', 4096))
+
+    def after_fork(self):
+        """
+        Drops the locks and the thread pool of the parent, in a forked process
+        :return:
+        """
+        self.lock = threading.Lock()
+        self.pool = None
+        self.sizes.after_fork()
+
+    def get_pool(self):
+        """
+        The thread pool is started on first use, so it isn't created in a process that forks
+        :return:
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+            return self.pool
+
+    def probe_url(self, url):
+        """
+        Reads the size of an image from the start of the file
+        :param url:
+        :raises: ImageException: if the size couldn't be read from the first max_bytes of the image
+        :return: a (width, height) tuple
+        """
+        size = self.sizes.get(url)
+        if size is not None:
+            return size
+
+        headers = {'Range': 'bytes=0-%d' % (self.max_bytes - 1)}
+        data = b''
+
+        # noinspection PyBroadException
+        try:
+            response = self.client.stream(url, headers=headers, timeout=self.timeout)
+            try:
+                if response.status_code >= 400:
+                    raise ImageException(url)
+                for chunk in response.iter_content(self.chunk_size):
+                    data += chunk
+                    size = self.read_size(data)
+                    if size is not None or len(data) >= self.max_bytes:
+                        break
+            finally:
+                response.close()
+        except ImageException:
+            raise
+        except Exception:
+            raise ImageException(url)
+
+        if size is None:
+            raise ImageException(url)
+        self.sizes.set(url, size)
+        return size
+
+    def read_size(self, data):
+        """
+        Returns the (width, height) of an image from its first bytes, or None if they don't hold the
+        whole image header
+        :param data:
+        :return:
+        """
+        # noinspection PyBroadException
+        try:
+            return Image.open(io.BytesIO(data)).size
+        except Exception:
+            return None
+
+    def start(self, url):
+        """
+        Starts reading the size of an image in the background
+        :param url:
+        :return: an AsyncResult for probe_url
+        """
+        return self.get_pool().apply_async(self.probe_url, (url, ))
+
+    def wait(self, pending, started):
+        """
+        Collects the sizes of started probes, waiting until deadline seconds after started
+        :param pending: a dictionary of url to the AsyncResult returned by start
+        :param started: the time the first probe was started
+        :return: a dictionary of url to (width, height) for the images whose size was read in time
+        """
+        finish_by = started + self.deadline
+        sizes = {}
+        for url, result in pending.items():
+            try:
+                sizes[url] = result.get(timeout=max(finish_by - time.time(), 0))
+            except (TimeoutError, ImageException):
+                pass
+        return sizes
+
+    def is_probeable(self, url):
+        return urlparse(url).scheme in ('http', 'https')
+
+
+image_prober = ImageProber()
@@ -0,0 +1,173 @@
+import cgi
+import hashlib
+import cPickle as pickle
+import re
+from urlparse import urljoin
+from lxml import etree
+from utils import MessagingScraper, premailer_for
+from backends import LxmlBackend
+from cache import BlockCache, block_cache as shared_block_cache
+from styles import stylesheet_cache, download_stylesheet
+from instrumentation import instrumentation
+
+# selectors whose matches depend on an element's siblings, which a block inlined without the blocks
+# around it doesn't have
+POSITIONAL_SELECTOR_RE = re.compile(r'[+~]|:(first|last|nth|only)-')
+
+
+class IncrementalMessagingScraper(MessagingScraper):
+    """
+    MessagingScraper that converts the top-level blocks of a page's content one by one, and reuses
+    the inlined html and check results of the blocks that haven't changed since they were last
+    converted. An edit to one story of a newsletter only sends that story through Premailer and the
+    checks again, the link checks of the whole page are still done with the LinkChecker's statuses.
+
+    Each block is keyed by its html, along with the page url, the page's head, the text of its
+    stylesheets and the checks. Pages are parsed with lxml, whatever PARSER_BACKEND is. Pages with
+    stylesheets in their content, with selectors that depend on siblings, or with checks that can't
+    be merged are converted as a whole
+    """
+    def __init__(self, start_index=0, cache=None, link_checker=None, image_prober=None, block_cache=None,
+                 compactor=None):
+        """
+        :param block_cache: the BlockCache to reuse and store converted blocks in, a new one if None
+        """
+        MessagingScraper.__init__(self, start_index, cache=cache, link_checker=link_checker, image_prober=image_prober,
+                                  backend=LxmlBackend(), compactor=compactor)
+        self.block_cache = block_cache if block_cache is not None else BlockCache()
+
+    @classmethod
+    def from_config(cls, config):
+        scraper = super(IncrementalMessagingScraper, cls).from_config(config)
+        scraper.block_cache = shared_block_cache
+        return scraper
+
+    def convert(self, url, page):
+        converted = self.convert_blocks(url, page)
+        if converted is None:
+            return MessagingScraper.convert(self, url, page)
+        return converted
+
+    def convert_blocks(self, url, page):
+        """
+        Inlines and checks a page block by block, converting only the blocks that aren't in the block cache
+        :param url:
+        :param page: a FetchedPage
+        :return: the inlined content and the visited checks of the whole page, to be finished with
+        ArticleUtils.finish_visitors, or None if the page has to be converted as a whole
+        """
+        if not page.is_ok() or not all(check_class.mergeable for check_class in self.utils.checks):
+            return None
+
+        document = self.utils.get_soup_from_page(page)
+        body = document.find('body')
+        if body is None or body.find('.//style') is not None or body.find('.//link') is not None:
+            return None
+
+        stylesheets = self.stylesheets(document, url)
+        if any(POSITIONAL_SELECTOR_RE.search(css) for css in stylesheets):
+            return None
+
+        with instrumentation.timer('serialize'):
+            context = self.context_hash(document, url, stylesheets)
+            blocks = list(body)
+            keys = [hashlib.sha1(context + etree.tostring(block, method='html', encoding='utf-8')).hexdigest()
+                    for block in blocks]
+
+        # the head and body are checked on their own, then each block
+        for block in blocks:
+            body.remove(block)
+        prepare_visitors = self.utils.prepare_visitors(url)
+        check_visitors = self.utils.check_visitors()
+        self.utils.visit_tree(document, prepare_visitors + check_visitors)
+
+        converted = [self.block_cache.get(key) for key in keys]
+        changed = [index for index, block in enumerate(converted) if block is None]
+        block_checks = {}
+        for index in changed:
+            block_checks[index] = self.utils.check_visitors()
+            self.utils.visit_tree(blocks[index], prepare_visitors + block_checks[index])
+        self.utils.finish_visitors(prepare_visitors)
+
+        for visitor in check_visitors:
+            visitor.detach()
+        for visitors in block_checks.values():
+            for visitor in visitors:
+                visitor.detach()
+
+        if changed:
+            for index, content in zip(changed, self.inline_blocks(document, [blocks[index] for index in changed])):
+                converted[index] = pickle.dumps((content, block_checks[index]), pickle.HIGHEST_PROTOCOL)
+                self.block_cache.set(keys[index], converted[index])
+
+        content_string = ''
+        if body.text:
+            content_string += cgi.escape(body.text).encode('ascii', 'xmlcharrefreplace')
+        for block in converted:
+            content, visitors = pickle.loads(block)
+            content_string += content
+            for visitor, block_visitor in zip(check_visitors, visitors):
+                visitor.merge(block_visitor)
+
+        return content_string, check_visitors
+
+    def stylesheets(self, document, url):
+        """
+        Returns the text of the stylesheets of a page, in the order Premailer reads them. External
+        stylesheets are loaded into the stylesheet cache, where Premailer finds them
+        :param document:
+        :param url:
+        :return:
+        """
+        stylesheets = []
+        for element in document.iter('style', 'link'):
+            if element.tag == 'style':
+                stylesheets.append(element.text or '')
+            elif 'stylesheet' in (element.get('rel') or '').split() and element.get('href'):
+                href = urljoin(url, element.get('href'))
+                stylesheets.append(stylesheet_cache.load(href, lambda: download_stylesheet(href)))
+        return stylesheets
+
+    def context_hash(self, document, url, stylesheets):
+        """
+        Hashes everything but its own html the conversion of a block depends on
+        :param document:
+        :param url:
+        :param stylesheets:
+        :return:
+        """
+        context = hashlib.sha1(url.encode('utf-8') if isinstance(url, unicode) else url)
+        head = document.find('head')
+        if head is not None:
+            context.update(etree.tostring(head, method='html', encoding='utf-8', with_tail=False))
+        for element in (document, document.find('body')):
+            context.update(repr(sorted(element.items())))
+        for css in stylesheets:
+            context.update(css.encode('utf-8') if isinstance(css, unicode) else css)
+        context.update(repr([check_class.__name__ for check_class in self.utils.checks]))
+        context.update(repr(self.utils.image_prober is not None))
+        return context.hexdigest()
+
+    def inline_blocks(self, document, blocks):
+        """
+        Inlines the css of blocks in the page they came from, wrapped in the content div
+        :param document: the page, without its blocks
+        :param blocks:
+        :return: the inlined html of each block, as ascii strings
+        """
+        body = document.find('body')
+        content_div = etree.SubElement(body, 'div')
+        content_div.set('class', 'content_div')
+        for block in blocks:
+            content_div.append(block)
+
+        with instrumentation.timer('serialize'):
+            document = self.utils.backend.to_etree(document)
+
+        with instrumentation.timer('inline'):
+            premailer = premailer_for(document)
+
+            premailer.transform()
+
+        with instrumentation.timer('extract'):
+            return [etree.tostring(block, method='html', encoding='us-ascii') for block in content_div]
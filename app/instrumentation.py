@@ -0,0 +1,198 @@
+import bisect
+import re
+import threading
+import time
+
+
+class NullTimer(object):
+    """
+    Timer handed out while nothing is being recorded, entering and leaving it does nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def stage_name(obj):
+    """
+    Returns the stage name of an object from its class name, e.g. image_check for an ImageCheck
+    :param obj:
+    :return:
+    """
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', type(obj).__name__).lower()
+
+
+class Timer(object):
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timings.add(self.stage, time.time() - self.started)
+        return False
+
+
+class Timings(object):
+    """
+    The seconds spent in each stage of one request, in the order the stages first ran. A stage that
+    runs more than once adds up
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.seconds = {}
+
+    def add(self, stage, seconds):
+        if stage not in self.seconds:
+            self.stages.append(stage)
+            self.seconds[stage] = 0.0
+        self.seconds[stage] += seconds
+
+    def total(self):
+        return time.time() - self.started
+
+    def items(self):
+        return [(stage, self.seconds[stage]) for stage in self.stages]
+
+    def server_timing(self):
+        """
+        Returns the timings as a Server-Timing header value, in milliseconds
+        :return:
+        """
+        return ', '.join('%s;dur=%.1f' % (stage, seconds * 1000) for stage, seconds in self.items())
+
+    def to_dict(self):
+        return dict((stage, round(seconds, 6)) for stage, seconds in self.items())
+
+
+class Histogram(object):
+    """
+    A Prometheus style histogram, counting observations into cumulative buckets of upper bounds
+    """
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if index < len(self.counts):
+                self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self):
+        """
+        Returns the (le, cumulative count) of each bucket, ending with +Inf, and the sum and count
+        :return:
+        """
+        with self.lock:
+            cumulative = []
+            total = 0
+            for bound, count in zip(self.buckets, self.counts):
+                total += count
+                cumulative.append((repr(float(bound)), total))
+            cumulative.append(('+Inf', self.count))
+            return cumulative, self.sum, self.count
+
+
+class Instrumentation(object):
+    """
+    Times the stages of a conversion. Recording is started and finished per request on the thread
+    handling it, and stages are timed with `with instrumentation.timer('inline'):`. While disabled,
+    or outside a recording, timer returns a shared timer that does nothing. Finished recordings are
+    added to a histogram per stage, rendered for Prometheus by render_metrics
+    """
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    metric = 'web_to_email_stage_seconds'
+    total_metric = 'web_to_email_request_seconds'
+
+    def __init__(self, enabled=False, buckets=default_buckets):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.local = threading.local()
+        self.histograms = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def configure(self, config):
+        self.enabled = config.get('INSTRUMENTATION', self.enabled)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        for histogram in self.histograms.values() + self.totals.values():
+            histogram.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts recording the stages run on this thread
+        :return:
+        """
+        if self.enabled:
+            self.local.timings = Timings()
+
+    def current(self):
+        return getattr(self.local, 'timings', None)
+
+    def finish(self, endpoint=None):
+        """
+        Stops recording on this thread and adds the stages to the histograms
+        :param endpoint: the name the total time of the request is kept under, if not None
+        :return: the Timings, or None if nothing was being recorded
+        """
+        timings = self.current()
+        if timings is None:
+            return None
+        self.local.timings = None
+        for stage, seconds in timings.items():
+            self.histogram(self.histograms, stage).observe(seconds)
+        if endpoint is not None:
+            self.histogram(self.totals, endpoint).observe(timings.total())
+        return timings
+
+    def timer(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+        timings = self.current()
+        if timings is None:
+            return NULL_TIMER
+        return Timer(timings, stage)
+
+    def histogram(self, histograms, name):
+        with self.lock:
+            if name not in histograms:
+                histograms[name] = Histogram(self.buckets)
+            return histograms[name]
+
+    def render_metrics(self):
+        """
+        Returns the histograms in the Prometheus text format
+        :return:
+        """
+        lines = []
+        for metric, label, histograms in ((self.metric, 'stage', self.histograms),
+                                          (self.total_metric, 'endpoint', self.totals)):
+            lines.append('# TYPE %s histogram' % metric)
+            for name in sorted(histograms):
+                buckets, total, count = histograms[name].samples()
+                for bound, cumulative in buckets:
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label, name, bound, cumulative))
+                lines.append('%s_sum{%s="%s"} %r' % (metric, label, name, total))
+                lines.append('%s_count{%s="%s"} %d' % (metric, label, name, count))
+        return '\n'.join(lines) + '\n'
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,121 @@
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+from cache import LRUCache
+from http_client import http_client
+
+
+class LinkChecker(object):
+    """
+    Checks that the urls of links and images resolve. Urls are deduplicated and checked
+    concurrently on a thread pool, with at most per_host requests to the same host at once, using
+    HEAD and falling back to GET for servers that don't answer HEAD. Results are cached for ttl
+    seconds, and urls that aren't checked within the deadline are reported as not verified
+    """
+    OK = 'ok'
+    BROKEN = 'broken'
+    NOT_VERIFIED = 'not verified'
+
+    def __init__(self, workers=16, per_host=4, deadline=5.0, timeout=(3.05, 5), ttl=600, cache_size=4096,
+                 hosts=1024, client=http_client):
+        self.workers = workers
+        self.per_host = per_host
+        self.deadline = deadline
+        self.timeout = timeout
+        self.results = LRUCache(max_size=cache_size, ttl=ttl)
+        self.client = client
+        self.pool = None
+        self.lock = threading.Lock()
+        # the semaphores of the hosts checked last
+        self.host_semaphores = LRUCache(max_size=hosts)
+
+    def configure(self, config):
+        self.workers = config.get('LINK_CHECK_WORKERS', self.workers)
+        self.per_host = config.get('LINK_CHECK_PER_HOST', self.per_host)
+        self.deadline = config.get('LINK_CHECK_DEADLINE', self.deadline)
+        self.results = LRUCache(max_size=self.results.max_size, ttl=config.get('LINK_CHECK_TTL', self.results.ttl))
+
+    def after_fork(self):
+        """
+        Drops the locks and the thread pool of the parent, in a forked process
+        :return:
+        """
+        self.lock = threading.Lock()
+        self.pool = None
+        self.host_semaphores = LRUCache(max_size=self.host_semaphores.max_size)
+        self.results.after_fork()
+
+    def is_checkable(self, url):
+        return urlparse(url).scheme in ('http', 'https')
+
+    def get_pool(self):
+        """
+        The thread pool is started on first use, so it isn't created in a process that forks
+        :return:
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+            return self.pool
+
+    def host_semaphore(self, url):
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            semaphore = self.host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host)
+                self.host_semaphores.set(host, semaphore)
+            return semaphore
+
+    def check_url(self, url):
+        """
+        Requests a url and caches whether it resolves
+        :param url:
+        :return: LinkChecker.OK or LinkChecker.BROKEN
+        """
+        with self.host_semaphore(url):
+            # noinspection PyBroadException
+            try:
+                response = self.client.head(url, timeout=self.timeout, read_body=False)
+                if response.status_code >= 400:
+                    response = self.client.get(url, timeout=self.timeout, read_body=False)
+                status = self.OK if response.status_code < 400 else self.BROKEN
+            except Exception:
+                status = self.BROKEN
+        self.results.set(url, status)
+        return status
+
+    def check(self, urls, deadline=None):
+        """
+        Checks a list of urls, waiting at most deadline seconds for all of them
+        :param urls: the urls to check, duplicates and non http urls are ignored
+        :param deadline: seconds to wait, self.deadline if None
+        :return: a dictionary of url to LinkChecker.OK, BROKEN or NOT_VERIFIED
+        """
+        if deadline is None:
+            deadline = self.deadline
+        finish_by = time.time() + deadline
+
+        statuses = {}
+        pending = {}
+        for url in urls:
+            if url in statuses or url in pending or not self.is_checkable(url):
+                continue
+            status = self.results.get(url)
+            if status is not None:
+                statuses[url] = status
+            else:
+                pending[url] = self.get_pool().apply_async(self.check_url, (url, ))
+
+        for url, result in pending.items():
+            try:
+                statuses[url] = result.get(timeout=max(finish_by - time.time(), 0))
+            except TimeoutError:
+                statuses[url] = self.NOT_VERIFIED
+
+        return statuses
+
+
+link_checker = LinkChecker()
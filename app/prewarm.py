@@ -0,0 +1,255 @@
+import os
+import sqlite3
+import time
+from urlparse import urljoin, urldefrag
+from lxml import etree
+from form_validators import fetch_messaging_page, MESSAGING_URL_RE, PageUnavailableError
+from utils import ArticleUtils, MessagingScraper
+from singleflight import normalize_url
+
+# a job still running after this many seconds is taken to belong to a worker that died
+RUNNING_TIMEOUT = 10 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL,
+    updated REAL NOT NULL,
+    error TEXT
+)
+'''
+
+
+class PrewarmJob(object):
+    """
+    A url to convert ahead of time, or an index page (an issue's table of contents, or a sitemap)
+    whose emailbuilder links are to be converted
+    """
+    PAGE = 'page'
+    INDEX = 'index'
+
+    def __init__(self, key, url, kind, attempts):
+        self.key = key
+        self.url = url
+        self.kind = kind
+        self.attempts = attempts
+
+
+class PrewarmQueue(object):
+    """
+    The urls waiting to be converted by the pre-warming worker, in a sqlite database the web workers
+    and the worker process share. A url is queued once however many times it is added while it
+    waits, and is queued again when added after it was converted, e.g. because the page was
+    republished. Failed conversions are retried with backoff
+    """
+    def __init__(self, path=None, max_attempts=3, retry_delay=30):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def configure(self, config):
+        self.path = config.get('PREWARM_QUEUE_PATH', self.path)
+        self.max_attempts = config.get('PREWARM_MAX_ATTEMPTS', self.max_attempts)
+        self.retry_delay = config.get('PREWARM_RETRY_DELAY', self.retry_delay)
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # autocommit, transactions are begun explicitly where a job is read and then changed
+        connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        connection.execute(SCHEMA)
+        return connection
+
+    def enqueue(self, url, kind=PrewarmJob.PAGE):
+        """
+        Queues a url, unless it is already waiting or being converted
+        :param url:
+        :param kind: PrewarmJob.PAGE to convert the url, PrewarmJob.INDEX to queue the pages it links to
+        :return: True if the url was queued
+        """
+        key = kind + ' ' + normalize_url(url)
+        now = time.time()
+        connection = self.connect()
+        try:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, run_after = ?, updated = ?, error = NULL "
+                "WHERE key = ? AND status IN ('done', 'failed')", (now, now, key))
+            if cursor.rowcount:
+                return True
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO jobs (key, url, kind, status, run_after, updated) "
+                "VALUES (?, ?, ?, 'queued', ?, ?)", (key, url, kind, now, now))
+            return cursor.rowcount > 0
+        finally:
+            connection.close()
+
+    def claim(self):
+        """
+        Marks the next job that is due as running
+        :return: a PrewarmJob, or None if no job is due
+        """
+        now = time.time()
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(
+                "SELECT key, url, kind, attempts FROM jobs "
+                "WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND updated < ?) "
+                "ORDER BY run_after LIMIT 1", (now, now - RUNNING_TIMEOUT)).fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            key, url, kind, attempts = row
+            connection.execute("UPDATE jobs SET status = 'running', attempts = ?, updated = ? WHERE key = ?",
+                               (attempts + 1, now, key))
+            connection.execute('COMMIT')
+            return PrewarmJob(key, url, kind, attempts + 1)
+        finally:
+            connection.close()
+
+    def complete(self, job):
+        self.set_status(job, 'done')
+
+    def fail(self, job, error, retry=True):
+        """
+        Records a failed job, and queues it again after a delay that doubles with each attempt
+        :param job:
+        :param error: the reason it failed
+        :param retry: False for failures that won't go away by trying again
+        :return:
+        """
+        if retry and job.attempts < self.max_attempts:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            self.set_status(job, 'queued', error, run_after=time.time() + delay)
+        else:
+            self.set_status(job, 'failed', error)
+
+    def set_status(self, job, status, error=None, run_after=None):
+        now = time.time()
+        connection = self.connect()
+        try:
+            connection.execute('UPDATE jobs SET status = ?, error = ?, run_after = ?, updated = ? WHERE key = ?',
+                               (status, error, run_after if run_after is not None else now, now, job.key))
+        finally:
+            connection.close()
+
+    def stats(self):
+        """
+        :return: the number of jobs by status
+        """
+        stats = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        if not self.enabled:
+            return stats
+        connection = self.connect()
+        try:
+            for status, count in connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'):
+                stats[status] = count
+        finally:
+            connection.close()
+        return stats
+
+
+def discover_urls(page):
+    """
+    Returns the emailbuilder pages an index page links to: the <loc> urls of a sitemap, or the
+    links of an html page
+    :param page: a FetchedPage
+    :return: the absolute urls, without fragments, in the order they are found
+    """
+    content = page.content.lstrip()
+    if content.startswith('<?xml') or content.startswith('<urlset') or content.startswith('<sitemapindex'):
+        document = etree.fromstring(content, etree.XMLParser(resolve_entities=False, no_network=True))
+        links = [element.text.strip() for element in document.iter('{*}loc') if element.text]
+    else:
+        links = [element.get('href') for element in page.tree.iter('a') if element.get('href')]
+
+    urls = []
+    seen = set([normalize_url(page.url)])
+    for link in links:
+        url = urldefrag(urljoin(page.url, link))[0]
+        if MESSAGING_URL_RE.match(url) and normalize_url(url) not in seen:
+            seen.add(normalize_url(url))
+            urls.append(url)
+    return urls
+
+
+class PrewarmWorker(object):
+    """
+    Converts the queued urls into the conversion cache, so the first person to open a page finds it
+    converted. Runs in its own process, `flask prewarm-worker`, and needs CONVERSION_CACHE_DIR to
+    share the cache with the web workers
+    """
+    def __init__(self, queue, config):
+        self.queue = queue
+        self.config = config
+
+    def run(self, poll_interval=1, stop=None):
+        """
+        Runs jobs until stop is set, waiting poll_interval seconds whenever none are due
+        :param poll_interval:
+        :param stop: a threading.Event, or None to run forever
+        :return:
+        """
+        while stop is None or not stop.is_set():
+            if self.run_once() is None:
+                time.sleep(poll_interval)
+
+    def run_once(self):
+        """
+        Runs the next job that is due
+        :return: the job, or None if none was due
+        """
+        job = self.queue.claim()
+        if job is None:
+            return None
+        # noinspection PyBroadException
+        try:
+            if job.kind == PrewarmJob.INDEX:
+                self.crawl(job.url)
+            else:
+                self.convert(job.url)
+        except PageUnavailableError as e:
+            self.queue.fail(job, str(e))
+        except ValueError as e:
+            # other ValidationErrors and malformed urls fail the same way every time
+            self.queue.fail(job, str(e), retry=False)
+        except Exception as e:
+            self.queue.fail(job, '%s: %s' % (type(e).__name__, e))
+        else:
+            self.queue.complete(job)
+        return job
+
+    def convert(self, url):
+        """
+        Converts a url, reusing a current conversion from the cache. The conversion is cached under
+        the normalized url, as the queue and the requests for any spelling of the url look it up
+        :param url:
+        :return:
+        """
+        page = fetch_messaging_page(url)
+        MessagingScraper.from_config(self.config).scrape(url, page=page)
+
+    def crawl(self, url):
+        """
+        Queues the emailbuilder pages an index page links to
+        :param url:
+        :raises: IOError: if the index page couldn't be loaded
+        :return:
+        """
+        page = ArticleUtils().fetch_page(url)
+        if not page.is_ok():
+            raise IOError('The index page answered with status %d' % page.status_code)
+        for page_url in discover_urls(page):
+            self.queue.enqueue(page_url)
+
+
+prewarm_queue = PrewarmQueue()
@@ -0,0 +1,282 @@
+import errno
+import fcntl
+import hashlib
+import os
+import sys
+import threading
+import time
+from urlparse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+
+def normalize_url(url):
+    """
+    Returns the url concurrent requests for the same page are coalesced under: the scheme and host
+    lower cased, without the default port and the fragment, with an empty path made /
+    :param url:
+    :return:
+    """
+    scheme, netloc, path, query, fragment = urlsplit(url.strip())
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if netloc.endswith(':' + DEFAULT_PORTS.get(scheme, '')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunsplit((scheme, netloc, path or '/', query, ''))
+
+
+class Flight(object):
+    """
+    A call in progress and, once it has finished, what it returned or raised
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def outcome(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the function, callers that
+    arrive while it runs wait for it and get what it returned, or raise what it raised. In a gevent
+    worker the waiting greenlets let others run.
+
+    With a lock directory, calls for a key in other workers on the same machine are waited for
+    too, through a lock file per key. Their result can't be shared across processes, so once the
+    other worker is done the caller retries, e.g. by reading what the other worker left in a shared
+    cache
+    """
+    def __init__(self, enabled=True, lock_dir=None, timeout=60, poll_interval=0.05):
+        self.enabled = enabled
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.flights = {}
+        # key -> (content, check) of streamed conversions whose checks are still running
+        self.streamed = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def configure(self, config):
+        self.enabled = config.get('SINGLE_FLIGHT', self.enabled)
+        self.lock_dir = config.get('SINGLE_FLIGHT_LOCK_DIR', self.lock_dir)
+        self.timeout = config.get('SINGLE_FLIGHT_TIMEOUT', self.timeout)
+        if self.lock_dir and not os.path.isdir(self.lock_dir):
+            os.makedirs(self.lock_dir)
+
+    def after_fork(self):
+        # the calls running in the parent don't go on in a forked process
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.streamed = {}
+
+    def do(self, key, function, retry=None):
+        """
+        Calls function, unless a call for key is already running, in which case its outcome is shared
+        :param key:
+        :param function: called without arguments
+        :param retry: called instead of function when a call for key in another process had to be
+        waited for. Calls without retry are only coalesced within this process
+        :return: what function returned
+        """
+        if not self.enabled:
+            return function()
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            if flight.done.wait(self.timeout):
+                return flight.outcome()
+            # the call is taking too long to keep waiting for
+            return function()
+
+        try:
+            if retry is not None and self.lock_dir:
+                with self.file_lock(key) as waited:
+                    flight.result = retry() if waited else function()
+            else:
+                flight.result = function()
+        except Exception:
+            flight.exc_info = sys.exc_info()
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.outcome()
+
+    def wait(self, key):
+        """
+        Waits for a running call for key to finish, in this process or, with a lock directory, another one
+        :param key:
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            flight = self.flights.get(key)
+        if flight is not None:
+            flight.done.wait(self.timeout)
+        elif self.lock_dir:
+            with self.file_lock(key):
+                pass
+
+    def share_streamed(self, key, content, check):
+        """
+        Shares a conversion whose content is sent before its checks are done with the requests for
+        key that arrive until the checks are: the conversion cache only gets the result once they
+        are. The checks are finished in the background straight away, so the result is cached
+        however slowly the content is streamed, or if nobody waits for the checks
+        :param key:
+        :param content:
+        :param check: finishes the checks and stores the result in the conversion cache
+        :return: the content, and a function that returns what check returned, called once
+        """
+        def finish():
+            try:
+                return check()
+            finally:
+                with self.lock:
+                    if self.streamed.get(key) is streamed:
+                        del self.streamed[key]
+
+        streamed = (content, once(finish))
+        if self.enabled:
+            with self.lock:
+                self.streamed[key] = streamed
+        thread = threading.Thread(target=streamed[1], name='streamed-checks')
+        thread.daemon = True
+        thread.start()
+        return streamed
+
+    def get_streamed(self, key):
+        """
+        :param key:
+        :return: the (content, check) shared by share_streamed for key, or None once its checks are done
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            return self.streamed.get(key)
+
+    def file_lock(self, key):
+        return FileLock(self.lock_path(key), self.timeout, self.poll_interval)
+
+    def lock_path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.lock_dir, hashlib.sha1(key).hexdigest() + '.lock')
+
+    def stats(self):
+        return {
+            'running': len(self.flights),
+            'leaders': self.leaders,
+            'followers': self.followers,
+        }
+
+
+class FileLock(object):
+    """
+    An exclusive flock on a file, as a context manager whose value is True if another process held
+    it first. The lock is polled rather than waited on so gevent workers keep serving meanwhile, and
+    given up on after timeout seconds
+    """
+    def __init__(self, path, timeout, poll_interval):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a')
+        deadline = time.time() + self.timeout
+        waited = False
+        while True:
+            try:
+                fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return waited
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() > deadline:
+                return waited
+            waited = True
+            time.sleep(self.poll_interval)
+
+    def __exit__(self, *exc_info):
+        # closing the file releases the lock, the file is left for the next call for the key
+        self.handle.close()
+        self.handle = None
+
+
+class SingleFlightScraper(object):
+    """
+    Wraps a scraper so concurrent conversions of the same url share one conversion. With a lock
+    directory and a shared conversion cache (CONVERSION_CACHE_DIR), a conversion running in another
+    worker is waited for and its cached result reused. A streamed conversion is also shared after it
+    has finished, until its checks are done and its result is in the cache
+    """
+    def __init__(self, scraper, flights=None):
+        """
+        :param scraper: the scraper that converts pages
+        :param flights: the SingleFlight to coalesce conversions with, the shared conversion_flights if None
+        """
+        self.scraper = scraper
+        self.flights = flights if flights is not None else conversion_flights
+
+    def __getattr__(self, name):
+        return getattr(self.scraper, name)
+
+    def scrape(self, url, page=None):
+        return self.flights.do(normalize_url(url), lambda: self.scraper.scrape(url, page=page),
+                               retry=lambda: self.scraper.scrape(url))
+
+    def scrape_content_first(self, url, page=None):
+        key = normalize_url(url)
+
+        def convert(page):
+            content, check = self.scraper.scrape_content_first(url, page=page)
+            return self.flights.share_streamed(key, content, check)
+
+        streamed = self.flights.get_streamed(key)
+        if streamed is not None:
+            return streamed
+        return self.flights.do(key, lambda: convert(page), retry=lambda: convert(None))
+
+
+def once(function):
+    """
+    Returns a function that calls function the first time it is called, and returns the same result
+    every time after, e.g. for the checks of a conversion shared by several requests
+    :param function: called without arguments
+    :return:
+    """
+    lock = threading.Lock()
+    flight = Flight()
+
+    def call():
+        with lock:
+            if not flight.done.is_set():
+                try:
+                    flight.result = function()
+                except Exception:
+                    flight.exc_info = sys.exc_info()
+                flight.done.set()
+        return flight.outcome()
+
+    return call
+
+
+conversion_flights = SingleFlight()
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from Queue import Queue, Empty, Full
+from http_client import http_client
+
+
+class SlackReporter(object):
+    """
+    Reports errors to a Slack webhook from a background thread, so error pages never wait on Slack.
+    Errors are put on a bounded queue and dropped, and counted, when it is full. The first error
+    for a path is sent straight away, repeats of it within window seconds are sent afterwards as a
+    single message with a count, and messages are sent at most once every min_interval seconds
+    """
+    message = "Error in the *Web-to-Email* tool: %(error)s \nURL: %(url)s"
+    repeated_message = "\nOccurred %(count)d times in the last %(window)d seconds"
+
+    def __init__(self, webhook_url=None, queue_size=100, window=60, min_interval=1.0, client=http_client):
+        self.webhook_url = webhook_url
+        self.queue_size = queue_size
+        self.window = window
+        self.min_interval = min_interval
+        self.client = client
+        self.queue = Queue(queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.pid = None
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        # (error, path) -> time the error was last sent
+        self.last_sent = {}
+        # (error, path) -> {'url': url, 'count': repeats since it was last sent}
+        self.pending = {}
+        self.next_send = 0
+
+    def configure(self, config):
+        self.webhook_url = config.get('SLACK_WEBHOOK_URL')
+        self.queue_size = config.get('SLACK_QUEUE_SIZE', self.queue_size)
+        self.window = config.get('SLACK_COALESCE_WINDOW', self.window)
+        self.min_interval = config.get('SLACK_MIN_INTERVAL', self.min_interval)
+        self.queue = Queue(self.queue_size)
+
+    def after_fork(self):
+        """
+        Drops the lock, the queue and the thread of the parent, in a forked process
+        :return:
+        """
+        self.lock = threading.Lock()
+        self.queue = Queue(self.queue_size)
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def report(self, error, url, path=None):
+        """
+        Queues an error to be sent to Slack, without waiting
+        :param error: the error, sent as str(error)
+        :param url: the url of the request that failed
+        :param path: the path errors are coalesced by, the url if None
+        :return:
+        """
+        if not self.webhook_url:
+            return
+        self.ensure_started()
+        try:
+            self.queue.put_nowait((str(error), url, path or url, time.time()))
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def ensure_started(self):
+        """
+        Starts the worker thread on first use, and again in a process forked after it was started
+        :return:
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive() or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name='slack-reporter')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Stops the worker thread once it has taken the queued errors and sent the ones that are due
+        :param timeout: seconds to wait for the thread
+        :return:
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return
+        self.stopping.set()
+        try:
+            # wakes the thread up if it is waiting for an error
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+        thread.join(timeout)
+
+    def run(self):
+        while True:
+            try:
+                queued = self.queue.get(timeout=1)
+                if queued is not None:
+                    self.add(*queued)
+            except Empty:
+                pass
+            self.send_pending()
+            if self.stopping.is_set() and self.queue.empty():
+                return
+
+    def add(self, error, url, path, reported):
+        key = (error, path)
+        last_sent = self.last_sent.get(key)
+        if key in self.pending:
+            self.pending[key]['count'] += 1
+        elif last_sent is not None and reported - last_sent < self.window:
+            self.pending[key] = {'url': url, 'count': 1}
+        else:
+            self.pending[key] = {'url': url, 'count': 1, 'first': True}
+
+    def send_pending(self):
+        """
+        Sends the errors that are due: new errors straight away, repeats once their window is over
+        :return:
+        """
+        now = time.time()
+        for key, entry in self.pending.items():
+            if now < self.next_send:
+                return
+            last_sent = self.last_sent.get(key)
+            if entry.get('first') or last_sent is None or now - last_sent >= self.window:
+                error, path = key
+                text = self.message % {'error': error, 'url': entry['url']}
+                if entry['count'] > 1 or not entry.get('first'):
+                    text += self.repeated_message % {'count': entry['count'], 'window': self.window}
+                del self.pending[key]
+                self.last_sent[key] = now
+                self.next_send = now + self.min_interval
+                self.send(text)
+
+        for key, last_sent in self.last_sent.items():
+            if now - last_sent >= self.window and key not in self.pending:
+                del self.last_sent[key]
+
+    def send(self, text):
+        # noinspection PyBroadException
+        try:
+            self.client.post(self.webhook_url, json={'text': text})
+            self.sent += 1
+        except Exception:
+            self.failed += 1
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'queued': self.queue.qsize(),
+        }
+
+
+slack_reporter = SlackReporter()
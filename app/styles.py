@@ -0,0 +1,113 @@
+import hashlib
+import threading
+from lxml.cssselect import CSSSelector
+from cache import LRUCache
+from http_client import http_client
+
+try:
+    from gevent.monkey import get_original
+    # once gevent has patched threading, threading.local is per greenlet, so per request
+    thread_local = get_original('threading', 'local')
+except ImportError:
+    thread_local = threading.local
+
+
+class StylesheetCache(object):
+    """
+    Process wide cache of the external stylesheets pages link to, and of the rules Premailer parses
+    out of them. Stylesheets are kept per url for ttl seconds, parsed rules are kept per hash of
+    the stylesheet text, so a stylesheet that is downloaded again unchanged isn't parsed again
+    """
+    def __init__(self, max_size=256, ttl=300):
+        self.sheets = LRUCache(max_size=max_size, ttl=ttl)
+        self.rules = LRUCache(max_size=max_size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+        size = config.get('STYLESHEET_CACHE_SIZE', 256)
+        ttl = config.get('STYLESHEET_CACHE_TTL', 300)
+        self.sheets = LRUCache(max_size=size, ttl=ttl)
+        self.rules = LRUCache(max_size=size)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.sheets.after_fork()
+        self.rules.after_fork()
+
+    def load(self, url, download):
+        """
+        Returns the text of the stylesheet at url, downloading it if it isn't cached
+        :param url:
+        :param download: a function that downloads the stylesheet text
+        :return:
+        """
+        css_body = self.sheets.get(url)
+        if css_body is None:
+            self.count('misses')
+            css_body = download()
+            self.sheets.set(url, css_body)
+        else:
+            self.count('hits')
+        return css_body
+
+    def parse_rules(self, key, css_body, parse):
+        """
+        Returns the (rules, leftover) Premailer parses from a stylesheet, parsing it if it isn't cached
+        :param key: the Premailer options the rules depend on
+        :param css_body: the stylesheet text
+        :param parse: a function that parses the stylesheet
+        :return:
+        """
+        if isinstance(css_body, unicode):
+            content_hash = hashlib.sha1(css_body.encode('utf-8')).hexdigest()
+        else:
+            content_hash = hashlib.sha1(css_body).hexdigest()
+        key = (content_hash, ) + key
+
+        parsed = self.rules.get(key)
+        if parsed is None:
+            parsed = parse()
+            self.rules.set(key, parsed)
+        rules, leftover = parsed
+        return list(rules), list(leftover)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stylesheets': len(self.sheets),
+            'rule_sets': len(self.rules),
+        }
+
+
+stylesheet_cache = StylesheetCache()
+
+# per thread, the greenlets of a gevent worker share the selectors of its thread
+compiled_selectors = thread_local()
+
+
+def compiled_css_selector(selector, max_size=1024):
+    """
+    Returns a compiled CSSSelector for a css selector, compiling each selector only once per thread.
+    lxml serializes calls to a compiled selector, so every thread keeps its own
+    :param selector:
+    :param max_size: the number of selectors each thread keeps
+    :return:
+    """
+    selectors = getattr(compiled_selectors, 'selectors', None)
+    if selectors is None or len(selectors) >= max_size:
+        selectors = compiled_selectors.selectors = {}
+    css_selector = selectors.get(selector)
+    if css_selector is None:
+        css_selector = selectors[selector] = CSSSelector(selector)
+    return css_selector
+
+
+def download_stylesheet(url):
+    return http_client.get(url).text
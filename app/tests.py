@@ -1,9 +1,73 @@
 import unittest
+import os
 import sys
-from utils import ArticleUtils
+import shutil
+import tempfile
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from utils import ArticleUtils, FetchedPage, MessagingScraper
+from cache import LRUCache, FileCache, ConversionCache, conversion_cache
+from checks import DocumentVisitor
+from errors import ErrorCategory, ErrorType, TagRef, SNIPPET_LENGTH
+import pickle
+from styles import StylesheetCache
+from inliner import CachingPremailer
+from http_client import HttpClient, ResponseTooLargeException
+from link_checker import LinkChecker
+from images import ImageProber
+from PIL import Image
+import io
+import gzip
+import json
+import batch
+from batch import BatchConverter
+from slack import SlackReporter
+from domains import DomainExtractor
+from instrumentation import Instrumentation, NULL_TIMER, instrumentation
+from async_scraper import AsyncMessagingScraper, gevent
+from workers import ProcessPool, PooledMessagingScraper, PoolFullException
+from backends import LxmlBackend, LxmlTag, get_backend
+from incremental import IncrementalMessagingScraper
+from singleflight import SingleFlight, SingleFlightScraper, normalize_url, once
+import prewarm
+from prewarm import PrewarmQueue, PrewarmWorker, PrewarmJob, discover_urls
+from compactor import OutputCompactor, compact_style
+import form_validators
+from form_validators import PageUnavailableError, download_messaging_page
+from wtforms import ValidationError
+from checks import is_empty_tag
+from lxml import etree
+import subprocess
+import textwrap
 from bs4 import BeautifulSoup
 
 
+SAMPLE_PAGE = '<html><head>' \
+              '<style>h1 { color: red; } p.intro { font-size: 14px; }</style>' \
+              '</head><body>' \
+              '<table align="center" summary="Email content" class="main"><tr><td>' \
+              '<h1>Newsletter</h1>' \
+              '<p class="intro">Caf\xc3\xa9 opening <a href="/news/story.html">today</a></p>' \
+              '<p></p>' \
+              '<img src="/images/banner.jpg"/>' \
+              '</td></tr></table>' \
+              '</body></html>'
+
+SAMPLE_URL = 'http://emailbuilder.ucsc.edu/samples/newsletter/index.html'
+
+
+def make_page(html=SAMPLE_PAGE, url=SAMPLE_URL, status_code=200, headers=None):
+    """
+    builds a FetchedPage as if it had been downloaded
+    :return:
+    """
+    if headers is None:
+        headers = {'content-type': 'text/html; charset=UTF-8'}
+    return FetchedPage(url, status_code, headers, html)
+
+
 class TestArticleUtils(unittest.TestCase):
 
     def setUp(self):
@@ -14,15 +78,24 @@ class TestArticleUtils(unittest.TestCase):
         self.utils = ArticleUtils()
 
     def test_unicode_to_html_entities(self):
-
         """
-        for i in xrange(200):
-            x = unichr(i)
-            y = self.utils.unicode_to_html_entities(x)
+        tests converting 2, 3 and 4 byte utf-8 sequences to html entities
+        :return:
+        """
+        assert self.utils.unicode_to_html_entities('plain &amp; ascii') == 'plain &amp; ascii'
+        assert self.utils.unicode_to_html_entities('caf\xc3\xa9') == 'caf&#233;'
+        assert self.utils.unicode_to_html_entities('\xc3\xa9\xe2\x80\x99') == '&#233;&#8217;'
+        assert self.utils.unicode_to_html_entities('a\xe2\x80\x9cb\xe2\x80\x9d') == 'a&#8220;b&#8221;'
+        assert self.utils.unicode_to_html_entities(u'\u2014') == '&#8212;'
+        assert self.utils.unicode_to_html_entities('\xf0\x9f\x8e\x93 end') in ('&#127891; end',
+                                                                              '&#55356;&#57235; end')
 
-            print x
+    def test_unicode_to_html_entities_invalid_utf8(self):
         """
-        assert 1 == 1
+        bytes that aren't valid utf-8 are read as latin-1
+        :return:
+        """
+        assert self.utils.unicode_to_html_entities('caf\xe9 \xc3\xa9') == 'caf&#233; &#233;'
 
     def test_convert_urls(self):
         """
@@ -160,5 +233,1777 @@ class TestArticleUtils(unittest.TestCase):
         assert empty_tag is not None
         assert len(empty_tag.tags) == 16
 
+    def test_check_document(self):
+        """
+        converting urls and running every check in one walk gives the same errors as running them separately
+        :return:
+        """
+        url = 'http://website.com/post.html'
+        soup = BeautifulSoup(SAMPLE_PAGE, 'lxml')
+        errors = self.utils.check_document(soup, url)
+
+        assert soup.find('a').attrs['href'] == 'http://website.com/news/story.html'
+        assert soup.find('img').attrs['src'] == 'http://website.com/images/banner.jpg'
+
+        separate_soup = BeautifulSoup(SAMPLE_PAGE, 'lxml')
+        self.utils.convert_urls(separate_soup, url)
+        separate_errors = [
+            self.utils.image_check(separate_soup),
+            self.utils.link_check(separate_soup),
+            self.utils.tag_check(separate_soup),
+        ]
+
+        assert len(errors) == len(separate_errors)
+        for category, separate_category in zip(errors, separate_errors):
+            assert category.category == separate_category.category
+            assert sorted(category.types or {}) == sorted(separate_category.types or {})
+            for name, error_type in (category.types or {}).items():
+                assert error_type.tags == separate_category.types[name].tags
+
+    def test_register_check(self):
+        """
+        registered checks run in the same walk as the built in ones
+        :return:
+        """
+        class TableCheck(DocumentVisitor):
+            tag_names = ('table', )
+
+            def __init__(self, utils):
+                self.category = ErrorCategory('Table Check')
+                self.missing_summary = ErrorType('Missing summary')
+
+            def visit(self, table):
+                if 'summary' not in table.attrs:
+                    self.missing_summary.add_tag(str(table))
+
+            def result(self):
+                if self.missing_summary.tags:
+                    self.category.add_type(self.missing_summary)
+                return self.category
+
+        self.utils.register_check(TableCheck)
+        soup = BeautifulSoup('<table><tr><td>No summary</td></tr></table>', 'lxml')
+        errors = self.utils.get_errors_dict(soup)
+
+        assert [category.category for category in errors] == ['Image Check', 'Link Check', 'Tag Check',
+                                                                'Table Check']
+        assert len(errors[3].get_type('Missing summary').tags) == 1
+
+
+class TestMessagingScraper(unittest.TestCase):
+
+    def setUp(self):
+        """
+        set up the testing class
+        :return:
+        """
+        self.scraper = MessagingScraper()
+
+    def test_fetched_page_parses_once(self):
+        """
+        the soup of a fetched page is only parsed the first time it's used
+        :return:
+        """
+        page = make_page()
+        assert page.is_ok() and page.is_html()
+        assert page.soup is page.soup
+
+    def test_scrape_fetched_page(self):
+        """
+        scraping an already fetched page inlines its css without downloading it again
+        :return:
+        """
+        content, errors = self.scraper.scrape(SAMPLE_URL, page=make_page())
+
+        soup = BeautifulSoup(content, 'lxml')
+        h1 = soup.find('h1')
+        assert h1 is not None
+        assert 'color:red' in h1.attrs['style']
+        assert u'Caf\xe9' in soup.find('p').get_text()
+        content.decode('ascii')
+
+        link = soup.find('a')
+        assert link.attrs['href'] == 'http://emailbuilder.ucsc.edu/news/story.html'
+
+        assert [category.category for category in errors] == ['Image Check', 'Link Check', 'Tag Check']
+        assert errors[0].get_type('Missing alt text') is not None
+        assert errors[2].get_type('Empty tag') is not None
+
+    def test_scrape_content_first(self):
+        """
+        the content is inlined before the checks are run, and gives the same result as scrape
+        :return:
+        """
+        content, errors = self.scraper.scrape(SAMPLE_URL, page=make_page())
+        streamed_content, check = self.scraper.scrape_content_first(SAMPLE_URL, page=make_page())
+
+        assert streamed_content == content
+        streamed_errors = check()
+        assert [category.to_dict() for category in streamed_errors] == [category.to_dict() for category in errors]
+
+    def test_stream_result(self):
+        """
+        the result page sends the content before running the checks
+        :return:
+        """
+        from app import app
+        from views import stream_result
+        checked = []
+
+        def check():
+            checked.append(True)
+            return self.scraper.utils.run_checks(BeautifulSoup(SAMPLE_PAGE, 'lxml'))
+
+        scraper = MessagingScraper()
+        scraper.scrape_content_first = lambda url, page=None: ('<h1>Newsletter</h1>', check)
+        with app.test_request_context('/?url=' + SAMPLE_URL):
+            response = stream_result('result.html', scraper, SAMPLE_URL)
+            assert response.is_streamed
+            chunks = response.response
+            sent = ''
+            while '<h1>Newsletter</h1>' not in sent:
+                sent += next(chunks)
+            assert not checked
+            assert 'Checking the page for errors' in sent
+
+            sent += ''.join(chunks)
+        assert checked
+        assert 'Missing alt text' in sent
+        assert sent.index('Missing alt text') > sent.index('<h1>Newsletter</h1>')
+
+    def test_stream_result_check_fails(self):
+        """
+        checks failing after the content has been sent are reported and shown in the page
+        :return:
+        """
+        from app import app
+        import views
+        reported = []
+
+        def check():
+            raise IOError('link checker gone')
+
+        scraper = MessagingScraper()
+        scraper.scrape_content_first = lambda url, page=None: ('<h1>Newsletter</h1>', check)
+        report = views.slack_reporter.report
+        views.slack_reporter.report = lambda error, url, path=None: reported.append((str(error), path))
+        app.logger.disabled = True
+        try:
+            with app.test_request_context('/?url=' + SAMPLE_URL):
+                sent = ''.join(views.stream_result('result.html', scraper, SAMPLE_URL).response)
+        finally:
+            views.slack_reporter.report = report
+            app.logger.disabled = False
+
+        assert '<h1>Newsletter</h1>' in sent
+        assert 'Checks failed' in sent and 'IOError: link checker gone' in sent
+        assert reported == [('link checker gone', '/')]
+
+    def test_inline_content_matches_string_path(self):
+        """
+        inlining on the lxml tree gives the same content as inlining the serialized page
+        :return:
+        """
+        page_html = SAMPLE_PAGE.replace('<h1>', '<!-- headline --><h1>')
+        soup = BeautifulSoup(page_html, 'lxml')
+        body = soup.body
+        content_div = soup.new_tag('div')
+        content_div.attrs['class'] = 'content_div'
+        for content in reversed(body.contents):
+            content_div.insert(0, content.extract())
+        body.append(content_div)
+
+        tree_content = self.scraper.inline_content(soup)
+        string_content = self.scraper.inline_content_string(soup.encode(formatter='html'))
+
+        assert '<!-- headline -->' in tree_content
+        tree_soup = BeautifulSoup(tree_content, 'lxml')
+        string_soup = BeautifulSoup(string_content, 'lxml')
+        content_tags = ['h1', 'p', 'a', 'img']
+        tree_tags = [(tag.name, tag.get_text().strip(), tag.attrs.get('style'))
+                     for tag in tree_soup.find_all(content_tags)]
+        string_tags = [(tag.name, tag.get_text().strip(), tag.attrs.get('style'))
+                       for tag in string_soup.find_all(content_tags)]
+        assert tree_tags == string_tags
+
+    def test_inline_content_serialization(self):
+        """
+        the content is written as html by lxml: non-ascii text and named entities become numeric
+        entities, and void tags aren't self-closed
+        :return:
+        """
+        html = '<html><head><style>p { color: red; }</style></head><body>' \
+               '<p>Caf\xc3\xa9&nbsp;&amp; <br/>more</p><img alt="" src="/i.png"/><hr></body></html>'
+        for backend in ('soup', 'lxml'):
+            content, errors = MessagingScraper(backend=get_backend(backend)).scrape(SAMPLE_URL, page=make_page(html))
+            assert content == '<p style="color:red">Caf&#233;&#160;&amp; <br>more</p>' \
+                              '<img alt="" src="http://emailbuilder.ucsc.edu/i.png"><hr>'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves the responses in the server's routes dict: path -> (status, headers, body)
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        if self.path in self.server.delays:
+            time.sleep(self.server.delays[self.path])
+        status, headers, body = self.server.routes.get(self.path, (404, {}, 'Not Found'))
+        if self.command == 'HEAD' and self.path in self.server.head_statuses:
+            status = self.server.head_statuses[self.path]
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server for tests that exercise real requests
+    """
+    daemon_threads = True
+
+    def __init__(self, routes, delays=None, head_statuses=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.routes = routes
+        self.delays = delays or {}
+        self.head_statuses = head_statuses or {}
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CannedCache(object):
+    """
+    Stands in for the conversion cache, serving a canned page instead of downloading it
+    """
+
+    def __init__(self, page):
+        self.page = page
+
+    def fetch_page(self, url, utils):
+        return self.page
+
+
+class TestFormValidators(unittest.TestCase):
+
+    def setUp(self):
+        self.conversion_cache = form_validators.conversion_cache
+
+    def tearDown(self):
+        form_validators.conversion_cache = self.conversion_cache
+
+    def test_messaging_page(self):
+        """
+        a page with the email content table is returned
+        :return:
+        """
+        page = make_page()
+        form_validators.conversion_cache = CannedCache(page)
+        assert download_messaging_page(SAMPLE_URL) is page
+
+    def test_not_a_messaging_page(self):
+        """
+        a page without the email content table is rejected
+        :return:
+        """
+        form_validators.conversion_cache = CannedCache(make_page(html='<html><body><p>Hi</p></body></html>'))
+        with self.assertRaises(ValidationError) as context:
+            download_messaging_page(SAMPLE_URL)
+        assert str(context.exception) == 'URL must be from emailbuilder.ucsc.edu'
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/page.html': (200, {'Content-Type': 'text/html; charset=UTF-8'}, SAMPLE_PAGE),
+            '/large.html': (200, {'Content-Type': 'text/html; charset=UTF-8'}, 'x' * 4096),
+        })
+        self.client = HttpClient(retries=0, max_response_bytes=1024)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get(self):
+        """
+        responses are read through the shared session
+        :return:
+        """
+        response = self.client.get(self.server.url('/page.html'), max_bytes=len(SAMPLE_PAGE))
+        assert response.status_code == 200
+        assert response.content == SAMPLE_PAGE
+
+    def test_response_too_large(self):
+        """
+        bodies over the size cap are refused
+        :return:
+        """
+        self.assertRaises(ResponseTooLargeException, self.client.get, self.server.url('/large.html'))
+
+
+class TestLinkChecker(unittest.TestCase):
+
+    def setUp(self):
+        image = (200, {'Content-Type': 'image/jpeg'}, 'jpeg')
+        self.server = StubServer({'/image.jpg': image, '/no-head.html': image, '/slow.html': image},
+                                 delays={'/slow.html': 1},
+                                 head_statuses={'/no-head.html': 405})
+        self.checker = LinkChecker(client=HttpClient(retries=0))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_check(self):
+        """
+        working, missing, HEAD-less and slow urls are each reported once
+        :return:
+        """
+        urls = [self.server.url('/image.jpg'), self.server.url('/missing.jpg'), self.server.url('/no-head.html'),
+                self.server.url('/image.jpg'), self.server.url('/slow.html'), 'mailto:someone@ucsc.edu']
+        statuses = self.checker.check(urls, deadline=0.5)
+
+        assert statuses == {
+            self.server.url('/image.jpg'): LinkChecker.OK,
+            self.server.url('/missing.jpg'): LinkChecker.BROKEN,
+            self.server.url('/no-head.html'): LinkChecker.OK,
+            self.server.url('/slow.html'): LinkChecker.NOT_VERIFIED,
+        }
+        image_requests = [request for request in self.server.requests if request[1] == '/image.jpg']
+        assert len(image_requests) == 1
+
+    def test_results_cached(self):
+        """
+        urls checked by an earlier conversion aren't requested again
+        :return:
+        """
+        url = self.server.url('/image.jpg')
+        self.checker.check([url])
+        self.checker.check([url])
+        assert len(self.server.requests) == 1
+
+    def test_host_semaphores_bounded(self):
+        checker = LinkChecker(hosts=2)
+        semaphore = checker.host_semaphore('http://one.ucsc.edu/')
+        assert checker.host_semaphore('http://one.ucsc.edu/page.html') is semaphore
+        checker.host_semaphore('http://two.ucsc.edu/')
+        checker.host_semaphore('http://three.ucsc.edu/')
+        assert len(checker.host_semaphores) == 2
+
+    def test_broken_link_errors(self):
+        """
+        the link and image checks report broken links and images
+        :return:
+        """
+        utils = ArticleUtils(link_checker=self.checker)
+        html = '<a href="%s">Missing page</a><img src="%s" alt="Missing image"/><img src="%s" alt="Image"/>' % (
+            self.server.url('/missing.html'), self.server.url('/missing.jpg'), self.server.url('/image.jpg'))
+        soup = BeautifulSoup(html, 'lxml')
+
+        image_errors, link_errors, tag_errors = utils.get_errors_dict(soup)
+
+        assert len(image_errors.get_type('Broken image').tags) == 1
+        assert len(link_errors.get_type('Broken link').tags) == 1
+        assert image_errors.get_type('Missing alt text') is None
+
+
+    def test_cached_conversion_rechecked(self):
+        """
+        a cached conversion of an unchanged page reports its links as the link checker last found them
+        :return:
+        """
+        checker = LinkChecker(client=HttpClient(retries=0), ttl=0.5)
+        html = '<html><body><table align="center" summary="Email content"><tr><td>' \
+               '<a href="%s">Story</a></td></tr></table></body></html>' % self.server.url('/story.html')
+        cache = ConversionCache()
+        scraper = MessagingScraper(cache=cache)
+        scraper.utils = RecordingUtils([make_page(html=html) for _ in range(3)])
+        scraper.utils.link_checker = checker
+
+        errors = scraper.scrape(SAMPLE_URL)[1]
+        assert errors[1].get_type('Broken link') is not None
+        assert cache.get(SAMPLE_URL).errors[1].get_type('Broken link') is None
+
+        self.server.routes['/story.html'] = (200, {'Content-Type': 'text/html'}, 'Story')
+        errors = scraper.scrape(SAMPLE_URL)[1]
+        assert errors[1].get_type('Broken link') is not None
+
+        time.sleep(0.6)
+        errors = scraper.scrape(SAMPLE_URL)[1]
+        assert errors[1].get_type('Broken link') is None
+        assert cache.stats()['hits'] == 2
+
+def make_image(width, height, image_format='PNG'):
+    """
+    returns the bytes of a blank image
+    :return:
+    """
+    data = io.BytesIO()
+    Image.new('RGB', (width, height)).save(data, image_format)
+    return data.getvalue()
+
+
+class TestImageProber(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/banner.png': (200, {'Content-Type': 'image/png'}, make_image(600, 200)),
+            '/photo.jpg': (200, {'Content-Type': 'image/jpeg'}, make_image(300, 400, 'JPEG')),
+        })
+        self.prober = ImageProber(client=HttpClient(retries=0))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_probe_url(self):
+        """
+        image sizes are read from a range request and cached
+        :return:
+        """
+        assert self.prober.probe_url(self.server.url('/banner.png')) == (600, 200)
+        assert self.prober.probe_url(self.server.url('/photo.jpg')) == (300, 400)
+        assert self.prober.probe_url(self.server.url('/banner.png')) == (600, 200)
+        assert len(self.server.requests) == 2
+        assert self.server.requests[0][2]['range'] == 'bytes=0-65535'
+
+    def test_fill_image_sizes(self):
+        """
+        missing widths and heights are filled in, keeping the aspect ratio of sized images
+        :return:
+        """
+        utils = ArticleUtils(image_prober=self.prober)
+        html = '<img src="/banner.png" alt="Banner"/>' \
+               '<img src="/banner.png" width="300" alt="Half width banner"/>' \
+               '<img src="/photo.jpg" width="100%" alt="Full width photo"/>' \
+               '<img src="/missing.png" alt="Missing"/>'
+        soup = BeautifulSoup(html, 'lxml')
+
+        utils.check_document(soup, self.server.url('/newsletter.html'))
+
+        images = soup.find_all('img')
+        assert (images[0]['width'], images[0]['height']) == ('600', '200')
+        assert (images[1]['width'], images[1]['height']) == ('300', '100')
+        assert 'height' not in images[2].attrs
+        assert 'width' not in images[3].attrs
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        from app import app
+        app.config['TESTING'] = True
+        self.config = app.config
+        self.app = app.test_client()
+
+    def test_error_category_to_dict(self):
+        """
+        error categories serialize to json
+        :return:
+        """
+        soup = BeautifulSoup('<img src="/image.jpg"/>', 'lxml')
+        image_errors = ArticleUtils().image_check(soup)
+        assert json.loads(json.dumps(image_errors.to_dict())) == {
+            'category': 'Image Check',
+            'class_name': 'image-check',
+            'types': [{
+                'name': 'Missing alt text',
+                'class_name': 'missing-alt-text',
+                'tags': ['<img src="/image.jpg"/>'],
+            }],
+        }
+
+    def test_convert(self):
+        """
+        every url gets one result, duplicates are converted once
+        :return:
+        """
+        converter = BatchConverter(self.config, workers=2)
+        results = list(converter.convert(['http://google.com', 'ucsc', 'http://google.com', ' ']))
+
+        assert sorted(result['url'] for result in results) == ['http://google.com', 'ucsc']
+        for result in results:
+            assert result['ok'] is False
+            assert result['seconds'] >= 0
+        errors = dict((result['url'], result['error']) for result in results)
+        assert errors['http://google.com'] == 'URL must belong to a UCSC domain'
+
+    def test_convert_like_requests(self):
+        """
+        urls are converted with the scraper requests use, and a full process pool is reported per url
+        :return:
+        """
+        class FullPoolScraper(object):
+            def scrape(self, url, page=None):
+                raise PoolFullException(5)
+
+        fetch_messaging_page, scraper_for = batch.fetch_messaging_page, batch.scraper_for
+        batch.fetch_messaging_page = lambda url: make_page(url=url)
+        batch.scraper_for = lambda config: FullPoolScraper()
+        try:
+            results = list(BatchConverter(self.config, workers=2).convert([SAMPLE_URL]))
+        finally:
+            batch.fetch_messaging_page, batch.scraper_for = fetch_messaging_page, scraper_for
+
+        assert results[0]['ok'] is False
+        assert results[0]['retry_after'] == 5
+        assert results[0]['error'] == 'Every converter process is busy, retry in 5 seconds'
+
+    def test_batch_endpoint(self):
+        """
+        the batch endpoint streams a json result per url and rejects malformed requests
+        :return:
+        """
+        rv = self.app.post('/batch', data=json.dumps({'urls': ['http://google.com']}),
+                           content_type='application/json')
+        assert rv.status_code == 200
+        lines = rv.data.strip().split('\n')
+        assert len(lines) == 1
+        assert json.loads(lines[0])['url'] == 'http://google.com'
+
+        rv = self.app.post('/batch', data=json.dumps({'url': 'http://google.com'}),
+                           content_type='application/json')
+        assert rv.status_code == 400
+
+
+class FakeSlackClient(object):
+    """
+    Records the messages posted to Slack, blocking until released when block is set
+    """
+    def __init__(self, block=False):
+        self.messages = []
+        self.released = threading.Event()
+        if not block:
+            self.released.set()
+
+    def post(self, url, json=None, **kwargs):
+        self.released.wait()
+        self.messages.append(json['text'])
+
+
+class TestSlackReporter(unittest.TestCase):
+
+    def setUp(self):
+        self.reporter = None
+
+    def tearDown(self):
+        if self.reporter is not None:
+            self.reporter.stop()
+
+    def wait_for(self, condition, timeout=5):
+        finish_by = time.time() + timeout
+        while not condition() and time.time() < finish_by:
+            time.sleep(0.05)
+        return condition()
+
+    def test_coalesce(self):
+        """
+        the first error is sent straight away, repeats within the window are sent once with a count
+        :return:
+        """
+        client = FakeSlackClient()
+        reporter = self.reporter = SlackReporter('https://hooks.slack.test/hook', window=1, min_interval=0,
+                                                 client=client)
+        reporter.report('404 Not Found', 'http://localhost/missing', '/missing')
+        assert self.wait_for(lambda: len(client.messages) == 1)
+        assert 'Occurred' not in client.messages[0]
+
+        for i in range(5):
+            reporter.report('404 Not Found', 'http://localhost/missing', '/missing')
+        assert self.wait_for(lambda: len(client.messages) == 2)
+        assert 'Occurred 5 times' in client.messages[1]
+        time.sleep(0.2)
+        assert len(client.messages) == 2
+
+    def test_drop_when_full(self):
+        """
+        errors are dropped, not waited on, when Slack is slow and the queue is full
+        :return:
+        """
+        client = FakeSlackClient(block=True)
+        reporter = self.reporter = SlackReporter('https://hooks.slack.test/hook', queue_size=2, min_interval=0,
+                                                 client=client)
+        started = time.time()
+        for i in range(10):
+            reporter.report('500 Internal Server Error', 'http://localhost/%d' % i)
+        assert time.time() - started < 1
+        assert reporter.stats()['dropped'] >= 7
+        client.released.set()
+
+    def test_stop(self):
+        """
+        the worker thread stops, and starts again for the next error
+        :return:
+        """
+        client = FakeSlackClient()
+        reporter = self.reporter = SlackReporter('https://hooks.slack.test/hook', min_interval=0, client=client)
+        reporter.report('404 Not Found', 'http://localhost/missing')
+        thread = reporter.thread
+        reporter.stop()
+        assert not thread.is_alive()
+        reporter.report('404 Not Found', 'http://localhost/other')
+        assert self.wait_for(lambda: len(client.messages) == 2)
+
+    def test_no_webhook(self):
+        """
+        nothing is queued without a webhook url
+        :return:
+        """
+        reporter = SlackReporter(client=FakeSlackClient())
+        reporter.report('404 Not Found', 'http://localhost/missing')
+        assert reporter.thread is None
+        assert reporter.stats()['queued'] == 0
+
+
+class TestDomainExtractor(unittest.TestCase):
+
+    def test_domain(self):
+        extractor = DomainExtractor()
+        assert extractor.domain('https://news.ucsc.edu/2017/01/page.html') == 'ucsc'
+        assert extractor.domain('http://www.bbc.co.uk/') == 'bbc'
+        assert extractor.domain('ucsc.edu/page') == 'ucsc'
+        assert extractor.domain('http://google.com') == 'google'
+        assert extractor.domain('ucsc') == 'ucsc'
+
+    def test_known_host(self):
+        """
+        the emailbuilder host is answered without reading the suffix list
+        :return:
+        """
+        extractor = DomainExtractor()
+        assert extractor.domain('https://emailbuilder.ucsc.edu/messaging/page') == 'ucsc'
+        assert extractor.extractor is None
+
+    def test_cold_start(self):
+        """
+        the suffix list is read from the bundled snapshot at startup, so the first lookup is fast
+        and works without a network
+        :return:
+        """
+        extractor = DomainExtractor()
+        started = time.time()
+        extractor.load()
+        load_seconds = time.time() - started
+        assert extractor.extractor.suffix_list_urls == ()
+        assert not extractor.extractor.cache_file
+
+        started = time.time()
+        assert extractor.domain('https://news.ucsc.edu/') == 'ucsc'
+        first_seconds = time.time() - started
+        assert load_seconds < 2
+        assert first_seconds < 0.05
+
+
+class TestApi(unittest.TestCase):
+
+    def setUp(self):
+        import views
+        from app import app
+        app.config['TESTING'] = True
+        self.config = app.config
+        self.settings = dict((key, app.config[key]) for key in ('CHECK_BROKEN_LINKS', 'PROBE_IMAGE_SIZES'))
+        app.config.update(CHECK_BROKEN_LINKS=False, PROBE_IMAGE_SIZES=False)
+        self.views = views
+        self.fetch_messaging_page = views.fetch_messaging_page
+        views.fetch_messaging_page = lambda url: make_page(url=url)
+        self.app = app.test_client()
+
+    def tearDown(self):
+        self.views.fetch_messaging_page = self.fetch_messaging_page
+        self.config.update(self.settings)
+
+    def test_convert(self):
+        rv = self.app.get('/api/convert?url=' + SAMPLE_URL)
+        assert rv.status_code == 200
+        result = json.loads(rv.data)
+        assert result['url'] == SAMPLE_URL
+        assert 'color:red' in result['content']
+        assert [category['category'] for category in result['errors']] == ['Image Check', 'Link Check', 'Tag Check']
+
+        rv = self.app.get('/api/convert?errors_only=1&url=' + SAMPLE_URL)
+        result = json.loads(rv.data)
+        assert 'content' not in result
+        assert len(result['errors']) == 3
+
+    def test_etag(self):
+        """
+        a conversion that hasn't changed is answered with 304 Not Modified
+        :return:
+        """
+        rv = self.app.get('/api/convert?url=' + SAMPLE_URL)
+        etag = rv.headers['ETag']
+        assert etag
+
+        rv = self.app.get('/api/convert?url=' + SAMPLE_URL, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == ''
+
+        rv = self.app.get('/api/convert?url=' + SAMPLE_URL, headers={'If-None-Match': 'W/"other"'})
+        assert rv.status_code == 200
+
+    def test_gzip(self):
+        rv = self.app.get('/api/convert?url=' + SAMPLE_URL, headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in rv.headers['Vary']
+        result = json.loads(gzip.GzipFile(fileobj=io.BytesIO(rv.data)).read())
+        assert result['url'] == SAMPLE_URL
+
+        rv = self.app.get('/api/convert?url=' + SAMPLE_URL)
+        assert 'Content-Encoding' not in rv.headers
+
+    def test_invalid_url(self):
+        self.views.fetch_messaging_page = self.fetch_messaging_page
+        rv = self.app.get('/api/convert?url=http://google.com')
+        assert rv.status_code == 400
+        assert json.loads(rv.data)['error'] == 'URL must belong to a UCSC domain'
+
+        rv = self.app.get('/api/convert')
+        assert rv.status_code == 400
+
+    def test_pool_full(self):
+        """
+        conversions rejected by a full process pool are answered with 503 and Retry-After
+        :return:
+        """
+        class FullScraper(object):
+            def scrape(self, url, page=None):
+                raise PoolFullException(7)
+
+        scraper_for = self.views.scraper_for
+        self.views.scraper_for = lambda config: FullScraper()
+        try:
+            rv = self.app.get('/api/convert?url=' + SAMPLE_URL)
+        finally:
+            self.views.scraper_for = scraper_for
+        assert rv.status_code == 503
+        assert rv.headers['Retry-After'] == '7'
+        assert 'busy' in json.loads(rv.data)['error']
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def tearDown(self):
+        instrumentation.enabled = False
+        instrumentation.finish()
+
+    def test_disabled(self):
+        """
+        nothing is recorded while disabled
+        :return:
+        """
+        timing = Instrumentation()
+        timing.start()
+        assert timing.timer('inline') is NULL_TIMER
+        assert timing.finish() is None
+
+    def test_scrape_stages(self):
+        instrumentation.enabled = True
+        instrumentation.start()
+        MessagingScraper().scrape(SAMPLE_URL, page=make_page())
+        timings = instrumentation.finish('test')
+
+        stages = [stage for stage, seconds in timings.items()]
+        for stage in ('parse', 'url_rewriter', 'image_check', 'link_check', 'tag_check', 'serialize', 'inline',
+                      'extract'):
+            assert stage in stages
+        assert 'inline;dur=' in timings.server_timing()
+
+        metrics = instrumentation.render_metrics()
+        assert 'web_to_email_stage_seconds_bucket{stage="inline",le="+Inf"}' in metrics
+        assert 'web_to_email_request_seconds_count{endpoint="test"}' in metrics
+
+    def test_histogram(self):
+        timing = Instrumentation(enabled=True, buckets=(0.1, 1))
+        for seconds in (0.05, 0.5, 5):
+            timing.start()
+            timing.current().add('fetch', seconds)
+            timing.finish()
+        metrics = timing.render_metrics()
+        assert 'web_to_email_stage_seconds_bucket{stage="fetch",le="0.1"} 1' in metrics
+        assert 'web_to_email_stage_seconds_bucket{stage="fetch",le="1.0"} 2' in metrics
+        assert 'web_to_email_stage_seconds_bucket{stage="fetch",le="+Inf"} 3' in metrics
+        assert 'web_to_email_stage_seconds_count{stage="fetch"} 3' in metrics
+
+    def test_server_timing_header(self):
+        import views
+        from app import app
+        fetch_messaging_page = views.fetch_messaging_page
+        views.fetch_messaging_page = lambda url: make_page(url=url)
+        instrumentation.enabled = True
+        try:
+            rv = app.test_client().get('/api/convert?url=' + SAMPLE_URL)
+        finally:
+            views.fetch_messaging_page = fetch_messaging_page
+        assert 'inline;dur=' in rv.headers['Server-Timing']
+        rv = app.test_client().get('/metrics')
+        assert 'web_to_email_request_seconds_count{endpoint="api_convert"}' in rv.data
+
+
+@unittest.skipIf(gevent is None, 'gevent is not installed')
+class TestAsyncScraper(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer({
+            '/style.css': (200, {'Content-Type': 'text/css'}, 'p { color: blue; }'),
+        })
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_scrape(self):
+        """
+        the async scraper converts a page the same way as the sync one
+        :return:
+        """
+        content, errors = MessagingScraper().scrape(SAMPLE_URL, page=make_page())
+        greenlet = AsyncMessagingScraper().scrape_async(SAMPLE_URL, page=make_page())
+        async_content, async_errors = greenlet.get(timeout=10)
+
+        assert async_content == content
+        assert [category.to_dict() for category in async_errors] == [category.to_dict() for category in errors]
+
+    def test_prefetch_stylesheets(self):
+        stylesheet_url = self.server.url('/style.css')
+        html = SAMPLE_PAGE.replace('</head>', '<link rel="stylesheet" href="%s"></head>' % stylesheet_url)
+        soup = BeautifulSoup(html, 'lxml')
+        from styles import stylesheet_cache
+        stylesheet_cache.sheets.delete(stylesheet_url)
+
+        assert AsyncMessagingScraper().prefetch_stylesheets(soup)
+        assert stylesheet_cache.sheets.get(stylesheet_url) == 'p { color: blue; }'
+
+        soup = BeautifulSoup(html.replace(stylesheet_url, 'http://127.0.0.1:1/style.css'), 'lxml')
+        assert not AsyncMessagingScraper().prefetch_stylesheets(soup)
+
+    def test_concurrent_conversions(self):
+        """
+        with gevent's patched sockets, one process converts pages waiting on a slow server at once
+        :return:
+        """
+        script = textwrap.dedent('''
+            from gevent import monkey
+            monkey.patch_all()
+            import sys, time
+            sys.path.insert(0, %r)
+            from tests import StubServer, SAMPLE_PAGE
+            from async_scraper import AsyncMessagingScraper, is_cooperative
+            assert is_cooperative()
+            paths = ['/page%%d.html' %% i for i in range(8)]
+            routes = dict((path, (200, {'Content-Type': 'text/html; charset=UTF-8'}, SAMPLE_PAGE)) for path in paths)
+            server = StubServer(routes, delays=dict((path, 0.5) for path in paths))
+            scraper = AsyncMessagingScraper()
+            started = time.time()
+            results = list(scraper.scrape_many([server.url(path) for path in paths], concurrency=8))
+            elapsed = time.time() - started
+            assert all(greenlet.successful() for url, greenlet in results)
+            print('%%d %%.3f' %% (len(results), elapsed))
+        ''') % os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.STDOUT)
+        count, elapsed = output.split()[-2:]
+        assert int(count) == 8
+        # one after another they'd take 4 seconds
+        assert float(elapsed) < 2
+
+
+def sleep_and_return(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def raise_value_error(message):
+    raise ValueError(message)
+
+
+class BadReply(object):
+    """
+    pickles in a pool process, and can't be unpickled back
+    """
+    def __reduce__(self):
+        return raise_value_error, ('bad reply', )
+
+
+def return_bad_reply():
+    return BadReply()
+
+
+def get_cached(url):
+    return conversion_cache.get(url)
+
+
+class TestProcessPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ProcessPool(processes=1, queue_size=0, timeout=5, retry_after=3)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_scrape(self):
+        """
+        the pooled scraper converts a page the same way as the in process one
+        :return:
+        """
+        content, errors = MessagingScraper().scrape(SAMPLE_URL, page=make_page())
+        pooled_content, pooled_errors = PooledMessagingScraper(pool=self.pool).scrape(SAMPLE_URL, page=make_page())
+
+        assert pooled_content == content
+        assert [category.to_dict() for category in pooled_errors] == [category.to_dict() for category in errors]
+
+        content, check = PooledMessagingScraper(pool=self.pool).scrape_content_first(SAMPLE_URL, page=make_page())
+        assert content == pooled_content
+        assert [category.to_dict() for category in check()] == [category.to_dict() for category in errors]
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.pool.run(raise_value_error, 'bad page')
+        # the process carries on after an exception
+        assert self.pool.run(sleep_and_return, 0, 'ok') == 'ok'
+
+    def test_bad_reply(self):
+        """
+        a process whose reply couldn't be read is replaced, so the next conversion doesn't read a stale reply
+        :return:
+        """
+        self.pool.start()
+        pid = self.pool.workers[0].pid
+        with self.assertRaises(ValueError):
+            self.pool.run(return_bad_reply)
+        assert self.pool.workers[0].pid != pid
+        assert self.pool.run(sleep_and_return, 0, 'ok') == 'ok'
+
+    def test_locks_after_fork(self):
+        """
+        a lock held in the parent when the processes were forked is free in them
+        :return:
+        """
+        with conversion_cache.backend.lock:
+            self.pool.start()
+        assert self.pool.run(get_cached, 'http://emailbuilder.ucsc.edu/not-cached.html') is None
+
+    def test_pool_full(self):
+        """
+        once every process is busy and the queue is full, conversions are rejected straight away
+        :return:
+        """
+        self.pool.start()
+        thread = threading.Thread(target=self.pool.run, args=(sleep_and_return, 0.5, None))
+        thread.start()
+        time.sleep(0.1)
+        try:
+            with self.assertRaises(PoolFullException) as context:
+                self.pool.run(sleep_and_return, 0, None)
+            assert context.exception.retry_after == 3
+            assert self.pool.stats()['rejected'] == 1
+        finally:
+            thread.join()
+        assert self.pool.run(sleep_and_return, 0, 'ok') == 'ok'
+
+    def test_timeout(self):
+        """
+        a process that takes longer than the timeout is replaced
+        :return:
+        """
+        self.pool.timeout = 0.2
+        self.pool.start()
+        pid = self.pool.workers[0].pid
+        with self.assertRaises(Exception):
+            self.pool.run(sleep_and_return, 1, None)
+        assert self.pool.workers[0].pid != pid
+        self.pool.timeout = 5
+        assert self.pool.run(sleep_and_return, 0, 'ok') == 'ok'
+
+
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_replacement_under_gevent(self):
+        """
+        a process replaced while a gevent worker serves doesn't answer the worker's connections
+        :return:
+        """
+        script = textwrap.dedent('''
+            from gevent import monkey
+            monkey.patch_all()
+            import os, socket, sys, time
+            sys.path.insert(0, %r)
+            import gevent
+            from gevent.server import StreamServer
+            from app.workers import ProcessPool
+
+            def sleep_and_return(seconds, value):
+                time.sleep(seconds)
+                return value
+
+            def answer(sock, address):
+                sock.sendall(str(os.getpid()))
+                sock.close()
+
+            pool = ProcessPool(processes=1, queue_size=1, timeout=0.2)
+            pool.start()
+            server = StreamServer(('127.0.0.1', 0), answer)
+            server.start()
+            try:
+                pool.run(sleep_and_return, 1, None)
+            except Exception:
+                pass
+            pool.timeout = 5
+            # the replacement waits in a patched sleep while connections come in
+            job = gevent.spawn(pool.run, sleep_and_return, 0.5, None)
+            gevent.sleep(0.1)
+            pids = set()
+            for i in range(20):
+                client = socket.create_connection(server.address)
+                pids.add(client.recv(16))
+                client.close()
+            job.get()
+            pool.stop()
+            print('ok' if pids == set([str(os.getpid())]) else pids)
+        ''') % os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.STDOUT)
+        assert output.split()[-1] == 'ok'
+
+
+MARKUP_PAGE = '<html><head><script>if (a < b && c) {}</script></head><body>' \
+              '<p class=" lead  intro " id="first" data-x=\'say "hi"\'>Fish &amp; chips <b>now</b> &lt;3</p>' \
+              '<p title="it\'s &quot;here&quot;"><!-- nothing --> </p>' \
+              '<p>\xc2\xa0</p>' \
+              '<li><br></li>' \
+              '<a rel="nofollow  external" href="/a?x=1&amp;y=2"><img alt="" src="/i.png"></a>' \
+              '<a name="top"></a>' \
+              '</body></html>'
+
+
+INDENTED_PAGE = '''<html>
+  <head>
+    <style>
+      td.story { padding: 10px; }
+      p { margin: 0 0 10px; }
+    </style>
+  </head>
+  <body>
+    <table align="center">
+      <tr>
+        <td class="story">
+          <h2>Story</h2>
+          <p>
+          </p>
+          <p>Some <b>bold</b>
+            <a href="/story.html">text</a>
+          </p>
+          <!--   -->
+          <pre>
+  kept   as
+    it is
+          </pre>
+          <img src="/story.png"/>
+        </td>
+      </tr>
+    </table>
+  </body>
+</html>
+'''
+
+
+class TestLxmlBackend(unittest.TestCase):
+
+    def test_tag_html(self):
+        """
+        lxml tags are written the way BeautifulSoup writes them
+        :return:
+        """
+        soup = BeautifulSoup(MARKUP_PAGE, 'lxml')
+        tree = etree.fromstring(MARKUP_PAGE, etree.HTMLParser(encoding='utf-8'))
+        tags = [tag for tag in soup.descendants if hasattr(tag, 'attrs')]
+        lxml_tags = list(LxmlBackend().iter_tags(tree))
+
+        assert [tag.name for tag in lxml_tags] == [tag.name for tag in tags]
+        for tag, lxml_tag in zip(tags, lxml_tags):
+            assert str(lxml_tag) == str(tag)
+            assert is_empty_tag(lxml_tag) == is_empty_tag(tag)
+            assert dict(lxml_tag.attrs) == tag.attrs
+
+    def test_attributes(self):
+        tag = LxmlTag(etree.fromstring('<a class="one two" href="/page">link</a>', etree.HTMLParser()).find('.//a'))
+        assert tag['class'] == ['one', 'two']
+        assert 'href' in tag.attrs and 'src' not in tag.attrs
+        tag['class'] = ['three']
+        tag.attrs['href'] = 'http://emailbuilder.ucsc.edu/page'
+        assert str(tag) == '<a class="three" href="http://emailbuilder.ucsc.edu/page">link</a>'
+
+    def test_scrape(self):
+        """
+        both backends return the same content and errors
+        :return:
+        """
+        for html in (SAMPLE_PAGE, MARKUP_PAGE.replace('<body>', '<body><style>p { color: blue; }</style>'),
+                     INDENTED_PAGE):
+            content, errors = MessagingScraper(backend=get_backend('soup')).scrape(SAMPLE_URL, page=make_page(html))
+            scraper = MessagingScraper(backend=get_backend('lxml'))
+            lxml_content, lxml_errors = scraper.scrape(SAMPLE_URL, page=make_page(html))
+
+            assert lxml_content == content
+            assert [category.to_dict() for category in lxml_errors] == [category.to_dict() for category in errors]
+
+            streamed_content, check = scraper.scrape_content_first(SAMPLE_URL, page=make_page(html))
+            assert streamed_content == content
+            assert [category.to_dict() for category in check()] == [category.to_dict() for category in errors]
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            get_backend('html5lib')
+
+
+class TestTagRef(unittest.TestCase):
+
+    def test_lazy(self):
+        """
+        a tag's html is written when it is first used, and the tag is let go
+        :return:
+        """
+        soup = BeautifulSoup('<p><img src="/a.png"/></p>', 'lxml')
+        error_type = ErrorType('Missing alt text')
+        error_type.add_tag(soup.img)
+        ref = error_type.tags[0]
+        assert ref.name == 'img' and ref.tag is soup.img
+
+        soup.img['alt'] = 'changed'
+        assert error_type.to_dict()['tags'] == ['<img alt="changed" src="/a.png"/>']
+        assert ref.tag is None
+        assert ref == '<img alt="changed" src="/a.png"/>'
+
+    def test_snippet(self):
+        soup = BeautifulSoup('<a href="/story.html">%s</a>' % ('<span>word</span>' * 200), 'lxml')
+        ref = TagRef(soup.a)
+        assert len(str(ref)) == SNIPPET_LENGTH + 3
+        assert str(ref).startswith('<a href="/story.html"><span>word</span>') and str(ref).endswith('...')
+
+        copy = pickle.loads(pickle.dumps(ref, pickle.HIGHEST_PROTOCOL))
+        assert copy == ref and copy.name == 'a'
+
+    def test_line(self):
+        tree = etree.fromstring('<html><body>\n<p>\n<img src="/a.png"></p></body></html>', etree.HTMLParser())
+        assert TagRef(LxmlTag(tree.find('.//img'))).line == 3
+        assert TagRef(BeautifulSoup('<img src="/a.png"/>', 'lxml').img).line is None
+
+    def test_is_empty_tag(self):
+        soup = BeautifulSoup('<p> <!-- --> </p><p><!-- note --></p><p><br/></p><p>\xc2\xa0</p>', 'lxml')
+        assert [is_empty_tag(p) for p in soup.find_all('p')] == [True, False, False, False]
+
+
+def make_newsletter(stories, css='h2 { color: navy; } p.lead { font-size: 14px; }'):
+    """
+    builds a page whose content is a block per story
+    :return:
+    """
+    blocks = ''.join('<table class="story"><tr><td><h2>Story %d</h2><p class="lead">%s</p><p></p>'
+                     '<a href="/story%d.html"><img src="/story%d.png"/></a></td></tr></table>\n' % (i, story, i, i)
+                     for i, story in enumerate(stories))
+    return '<html><head><style>%s</style></head><body>\n%s</body></html>' % (css, blocks)
+
+
+class TestIncrementalMessagingScraper(unittest.TestCase):
+
+    def setUp(self):
+        self.scraper = IncrementalMessagingScraper()
+
+    def assert_converted_as_whole(self, html, content, errors):
+        whole_content, whole_errors = MessagingScraper().scrape(SAMPLE_URL, page=make_page(html))
+        assert content == whole_content
+        assert [category.to_dict() for category in errors] == [category.to_dict() for category in whole_errors]
+
+    def test_scrape(self):
+        """
+        only the blocks that changed are converted again, and the result is the same as converting the whole page
+        :return:
+        """
+        html = make_newsletter(['First', 'Second', 'Third'])
+        content, errors = self.scraper.scrape(SAMPLE_URL, page=make_page(html))
+        self.assert_converted_as_whole(html, content, errors)
+        assert self.scraper.block_cache.stats() == {'hits': 0, 'misses': 3, 'blocks': 3}
+
+        html = make_newsletter(['First', 'Second, edited', 'Third'])
+        content, errors = self.scraper.scrape(SAMPLE_URL, page=make_page(html))
+        self.assert_converted_as_whole(html, content, errors)
+        assert 'Second, edited' in content
+        assert self.scraper.block_cache.stats() == {'hits': 2, 'misses': 4, 'blocks': 4}
+
+        content, check = self.scraper.scrape_content_first(SAMPLE_URL, page=make_page(html))
+        self.assert_converted_as_whole(html, content, check())
+        assert self.scraper.block_cache.stats()['misses'] == 4
+
+    def test_stylesheet_change(self):
+        """
+        every block is converted again when the stylesheets change
+        :return:
+        """
+        self.scraper.scrape(SAMPLE_URL, page=make_page(make_newsletter(['First', 'Second'])))
+        html = make_newsletter(['First', 'Second'], css='h2 { color: red; }')
+        content, errors = self.scraper.scrape(SAMPLE_URL, page=make_page(html))
+        self.assert_converted_as_whole(html, content, errors)
+        assert self.scraper.block_cache.stats()['hits'] == 0
+
+    def test_positional_selectors(self):
+        """
+        pages whose stylesheets match elements by their siblings are converted as a whole
+        :return:
+        """
+        html = make_newsletter(['First', 'Second'], css='table.story + table.story { margin-top: 10px; }')
+        content, errors = self.scraper.scrape(SAMPLE_URL, page=make_page(html))
+        self.assert_converted_as_whole(html, content, errors)
+        assert 'margin-top:10px' in content
+        assert self.scraper.block_cache.stats()['blocks'] == 0
+
+
+class RecordingUtils(ArticleUtils):
+    """
+    ArticleUtils that serves canned pages instead of downloading them, recording the request headers
+    """
+
+    def __init__(self, pages):
+        ArticleUtils.__init__(self)
+        self.pages = pages
+        self.requests = []
+
+    def fetch_page(self, page_url, headers=None):
+        self.requests.append(headers or {})
+        return self.pages.pop(0)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = []
+
+    def call_slowly(self, result, seconds=0.2):
+        self.calls.append(result)
+        time.sleep(seconds)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def run_concurrently(self, function, count=5):
+        results = []
+
+        def run():
+            try:
+                results.append(function())
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce(self):
+        """
+        concurrent calls for a key share one call, later calls call again
+        :return:
+        """
+        results = self.run_concurrently(lambda: self.flights.do('key', lambda: self.call_slowly('converted')))
+        assert results == ['converted'] * 5
+        assert len(self.calls) == 1
+        assert self.flights.stats() == {'running': 0, 'leaders': 1, 'followers': 4}
+
+        self.flights.do('key', lambda: self.call_slowly('again', 0))
+        self.flights.do('other key', lambda: self.call_slowly('other', 0))
+        assert self.calls == ['converted', 'again', 'other']
+
+    def test_errors(self):
+        """
+        what the call raised is raised to every caller
+        :return:
+        """
+        error = ValueError('Not found')
+        results = self.run_concurrently(lambda: self.flights.do('key', lambda: self.call_slowly(error)))
+        assert results == [error] * 5
+        assert len(self.calls) == 1
+
+    def test_disabled(self):
+        self.flights.enabled = False
+        self.run_concurrently(lambda: self.flights.do('key', lambda: self.call_slowly('converted')), count=3)
+        assert len(self.calls) == 3
+
+    def test_lock_dir(self):
+        """
+        a call for the key in another process is waited for, and then retried
+        :return:
+        """
+        lock_dir = tempfile.mkdtemp()
+        try:
+            self.flights.configure({'SINGLE_FLIGHT_LOCK_DIR': lock_dir})
+            other_process = SingleFlight(lock_dir=lock_dir)
+            thread = threading.Thread(target=other_process.do, args=('key', lambda: self.call_slowly('converted')),
+                                      kwargs={'retry': lambda: None})
+            thread.start()
+            time.sleep(0.05)
+            started = time.time()
+            result = self.flights.do('key', lambda: self.call_slowly('converted again', 0),
+                                     retry=lambda: 'from the cache')
+            thread.join()
+            assert result == 'from the cache'
+            assert time.time() - started > 0.1
+            assert self.calls == ['converted']
+        finally:
+            shutil.rmtree(lock_dir)
+
+    def test_normalize_url(self):
+        assert normalize_url(' HTTP://EmailBuilder.ucsc.edu:80/News.html#top ') == 'http://emailbuilder.ucsc.edu/News.html'
+        assert normalize_url('https://emailbuilder.ucsc.edu:443?page=2') == 'https://emailbuilder.ucsc.edu/?page=2'
+        assert normalize_url('http://emailbuilder.ucsc.edu:8080/') == 'http://emailbuilder.ucsc.edu:8080/'
+
+    def test_once(self):
+        check = once(lambda: self.call_slowly('errors', 0))
+        assert [check(), check()] == ['errors', 'errors']
+        assert len(self.calls) == 1
+
+    def test_scraper(self):
+        """
+        concurrent requests for a url share one conversion, and one run of its checks
+        :return:
+        """
+        scraper = MessagingScraper()
+        conversions = []
+
+        def scrape_content_first(url, page=None):
+            conversions.append(url)
+            time.sleep(0.2)
+            return MessagingScraper.scrape_content_first(scraper, url, page=page)
+
+        scraper.scrape_content_first = scrape_content_first
+        coalesced = SingleFlightScraper(scraper, self.flights)
+        results = self.run_concurrently(lambda: coalesced.scrape_content_first(SAMPLE_URL, page=make_page()))
+        assert len(conversions) == 1
+        content, check = results[0]
+        assert all(result[0] == content for result in results)
+        assert check() is results[-1][1]()
+
+    def test_streamed_checks(self):
+        """
+        a streamed conversion is shared until its checks are done, which are finished and cached
+        without waiting for the stream
+        :return:
+        """
+        cache = ConversionCache()
+        scraper = MessagingScraper(cache=cache)
+        conversions = []
+
+        def scrape_content_first(url, page=None):
+            conversions.append(url)
+            content, check = MessagingScraper.scrape_content_first(scraper, url, page=page)
+
+            def check_slowly():
+                time.sleep(0.2)
+                return check()
+
+            return content, check_slowly
+
+        scraper.scrape_content_first = scrape_content_first
+        coalesced = SingleFlightScraper(scraper, self.flights)
+        content, check = coalesced.scrape_content_first(SAMPLE_URL, page=make_page())
+        later_content, later_check = coalesced.scrape_content_first(SAMPLE_URL, page=make_page())
+        assert len(conversions) == 1
+        assert later_content == content and later_check is check
+
+        time.sleep(0.4)
+        assert cache.get(SAMPLE_URL) is not None
+        assert self.flights.get_streamed(normalize_url(SAMPLE_URL)) is None
+
+
+class TestPrewarm(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = PrewarmQueue(os.path.join(self.directory, 'prewarm.db'), max_attempts=2, retry_delay=0)
+        self.worker = PrewarmWorker(self.queue, {})
+        self.fetch_messaging_page = prewarm.fetch_messaging_page
+        self.converted = []
+
+    def tearDown(self):
+        prewarm.fetch_messaging_page = self.fetch_messaging_page
+        shutil.rmtree(self.directory)
+
+    def test_queue(self):
+        """
+        a url is queued once while it waits, and again once it has been converted
+        :return:
+        """
+        assert self.queue.enqueue(SAMPLE_URL)
+        assert not self.queue.enqueue(SAMPLE_URL + '#top')
+        assert self.queue.enqueue(SAMPLE_URL, PrewarmJob.INDEX)
+        assert self.queue.stats() == {'queued': 2, 'running': 0, 'done': 0, 'failed': 0}
+
+        job = self.queue.claim()
+        assert (job.url, job.kind, job.attempts) == (SAMPLE_URL, PrewarmJob.PAGE, 1)
+        assert not self.queue.enqueue(SAMPLE_URL)
+        self.queue.complete(job)
+        assert self.queue.claim().kind == PrewarmJob.INDEX
+        assert self.queue.claim() is None
+
+        assert self.queue.enqueue(SAMPLE_URL)
+        assert self.queue.claim().attempts == 1
+
+    def test_retries(self):
+        """
+        conversions that fail are retried until max_attempts, validation errors aren't
+        :return:
+        """
+        def fetch_messaging_page(url):
+            self.converted.append(url)
+            if 'invalid' in url:
+                raise ValueError('URL must be from emailbuilder.ucsc.edu')
+            raise PageUnavailableError('That URL could not be loaded. Please try again in a moment.')
+
+        prewarm.fetch_messaging_page = fetch_messaging_page
+        self.queue.enqueue(SAMPLE_URL)
+        self.queue.enqueue('http://emailbuilder.ucsc.edu/invalid.html')
+        while self.worker.run_once() is not None:
+            pass
+        assert sorted(self.converted) == ['http://emailbuilder.ucsc.edu/invalid.html', SAMPLE_URL, SAMPLE_URL]
+        assert self.queue.stats()['failed'] == 2
+
+    def test_convert(self):
+        """
+        the worker converts queued pages into the conversion cache
+        :return:
+        """
+        cache = ConversionCache()
+        prewarm.fetch_messaging_page = lambda url: make_page(url=url)
+        original_from_config = MessagingScraper.from_config
+        MessagingScraper.from_config = classmethod(lambda cls, config: cls(cache=cache))
+        try:
+            self.queue.enqueue(SAMPLE_URL)
+            job = self.worker.run_once()
+        finally:
+            MessagingScraper.from_config = original_from_config
+        assert job.url == SAMPLE_URL
+        assert 'color:red' in cache.get(SAMPLE_URL).content
+        assert self.queue.stats()['done'] == 1
+
+    def test_converted_for_readers(self):
+        """
+        a reader whose url is spelled differently finds the conversion of the queued url
+        :return:
+        """
+        cache = ConversionCache()
+        prewarm.fetch_messaging_page = lambda url: make_page(url=url)
+        original_from_config = MessagingScraper.from_config
+        MessagingScraper.from_config = classmethod(lambda cls, config: cls(cache=cache))
+        try:
+            self.queue.enqueue('HTTP://EmailBuilder.ucsc.edu/samples/newsletter/index.html#top')
+            self.worker.run_once()
+        finally:
+            MessagingScraper.from_config = original_from_config
+
+        scraper = MessagingScraper(cache=cache)
+        scraper.utils = RecordingUtils([make_page()])
+        content, errors = scraper.scrape(SAMPLE_URL)
+        assert 'color:red' in content
+        assert cache.stats()['hits'] == 1
+
+    def test_discover_urls(self):
+        index = make_page('<html><body><a href="/issue/one.html#top">One</a><a href="two.html">Two</a>'
+                          '<a href="http://google.com/">Elsewhere</a><a href="/issue/one.html">Again</a>'
+                          '<a href="index.html">Index</a></body></html>', url='http://emailbuilder.ucsc.edu/issue/index.html')
+        assert discover_urls(index) == ['http://emailbuilder.ucsc.edu/issue/one.html',
+                                        'http://emailbuilder.ucsc.edu/issue/two.html']
+
+        sitemap = make_page('<?xml version="1.0" encoding="UTF-8"?>\n'
+                            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                            '<url><loc> http://emailbuilder.ucsc.edu/issue/one.html </loc></url>'
+                            '<url><loc>http://www.ucsc.edu/</loc></url></urlset>',
+                            url='http://emailbuilder.ucsc.edu/sitemap.xml')
+        assert discover_urls(sitemap) == ['http://emailbuilder.ucsc.edu/issue/one.html']
+
+    def test_endpoint(self):
+        """
+        /prewarm queues the ucsc urls posted
+        :return:
+        """
+        from app import app
+        from prewarm import prewarm_queue
+        path = prewarm_queue.path
+        prewarm_queue.path = self.queue.path
+        try:
+            rv = app.test_client().post('/prewarm', content_type='application/json', data=json.dumps({
+                'urls': [SAMPLE_URL, SAMPLE_URL, 'http://google.com/'],
+                'indexes': ['http://emailbuilder.ucsc.edu/sitemap.xml'],
+            }))
+            assert rv.status_code == 202
+            assert json.loads(rv.data) == {'queued': [SAMPLE_URL, 'http://emailbuilder.ucsc.edu/sitemap.xml'],
+                                           'rejected': ['http://google.com/']}
+
+            rv = app.test_client().post('/prewarm', content_type='application/json', data=json.dumps({'urls': 'x'}))
+            assert rv.status_code == 400
+        finally:
+            prewarm_queue.path = path
+
+
+class TestCreateApp(unittest.TestCase):
+
+    def tearDown(self):
+        """
+        the shared caches and clients go back to the settings of the app the other tests use
+        :return:
+        """
+        from app import app, configure_shared
+        configure_shared(app.config)
+
+    def test_create_app(self):
+        """
+        each app gets the views, the commands and its own settings, and configures the shared objects
+        :return:
+        """
+        from app import create_app
+        app = create_app({'TESTING': True, 'BATCH_MAX_URLS': 1, 'CONVERSION_CACHE_SIZE': 1})
+        assert app.config['BATCH_MAX_URLS'] == 1
+        assert conversion_cache.backend.max_size == 1
+        assert set(['convert', 'prewarm', 'prewarm-worker']) <= set(app.cli.commands)
+        rv = app.test_client().post('/batch', data=json.dumps({'urls': ['ucsc', 'ucsc']}),
+                                    content_type='application/json')
+        assert rv.status_code == 400
+
+    def test_lazy_imports(self):
+        """
+        Premailer is only imported for the first conversion
+        :return:
+        """
+        script = textwrap.dedent('''
+            import sys
+            sys.path.insert(0, %r)
+            import app
+            assert 'premailer' not in sys.modules and 'cssutils' not in sys.modules
+            from app.workers import warm_up
+            warm_up()
+            assert 'premailer' in sys.modules
+            print('ok')
+        ''') % os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.STDOUT)
+        assert output.split()[-1] == 'ok'
+
+
+class TestOutputCompactor(unittest.TestCase):
+
+    def setUp(self):
+        self.compactor = OutputCompactor(enabled=True)
+
+    def test_compact_style(self):
+        """
+        repeated, overridden and default declarations are left out, unless they matter
+        :return:
+        """
+        td = etree.Element('td')
+        assert compact_style('color: red; font-size: 14px; color: blue', td) == 'font-size:14px;color:blue'
+        assert compact_style('color: red !important; color: blue', td) == 'color:red!important'
+        assert compact_style('margin-top: 5px; padding: 0px; margin: 0px 10px', td) == 'padding:0;margin:0 10px'
+        assert compact_style('background: #fff; background: linear-gradient(#fff, #eee)', td) == \
+            'background:#fff;background:linear-gradient(#fff, #eee)'
+        assert compact_style('float: none; position: static', td) == ''
+        assert compact_style('float: none', etree.Element('img', align='left')) == 'float:none'
+
+    def test_compact(self):
+        """
+        whitespace is collapsed except where it is shown, comments are removed except Outlook's
+        :return:
+        """
+        content = ('<p style="color: red;  color: red">Some   \n  text<!-- a comment --> after</p>\n\n'
+                   '<pre>keep   this\n  as it is</pre><!--[if mso]><table><tr><td><![endif]-->')
+        compacted = self.compactor.compact(content)
+        assert compacted == ('<p style="color:red">Some text after</p> <pre>keep   this\n  as it is</pre>'
+                             '<!--[if mso]><table><tr><td><![endif]-->')
+
+    def test_size_check(self):
+        """
+        the size is reported, with an error when it is over the budget
+        :return:
+        """
+        content, size_check = OutputCompactor().compact_content('<p>small</p>')
+        assert size_check is None
+
+        content, size_check = OutputCompactor(budget=10).compact_content('<p>not so small</p>')
+        assert size_check.summary == 'The html is 19 bytes'
+        assert size_check.to_dict()['types'][0]['name'] == 'Over the Gmail clipping limit'
+
+        content, size_check = self.compactor.compact_content('<p>   spaced   </p>')
+        assert content == '<p> spaced </p>'
+        assert size_check.summary == 'The html is 15 bytes, compacted from 19 bytes'
+        assert size_check.to_dict()['types'] == []
+
+    def test_scrape(self):
+        """
+        the scraper compacts the inlined content and adds the size check to the errors
+        :return:
+        """
+        content, errors = MessagingScraper().scrape(SAMPLE_URL, page=make_page())
+        compacted, compacted_errors = MessagingScraper(compactor=self.compactor).scrape(SAMPLE_URL, page=make_page())
+        assert len(compacted) <= len(content)
+        assert [category.category for category in compacted_errors] == [category.category for category in errors] + \
+            ['Size Check']
+        assert compacted_errors[-1].summary.startswith('The html is %s bytes' % format(len(compacted), ','))
+
+
+class TestConversionCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        """
+        the least recently used entry is evicted first
+        :return:
+        """
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_lru_ttl(self):
+        """
+        expired entries are not returned
+        :return:
+        """
+        cache = LRUCache(max_size=2, ttl=-1)
+        cache.set('a', 1)
+        assert cache.get('a') is None
+
+    def test_file_cache(self):
+        """
+        entries written by one file cache can be read by another on the same directory
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            FileCache(directory).set(SAMPLE_URL, {'content': 'inlined'})
+            assert FileCache(directory).get(SAMPLE_URL) == {'content': 'inlined'}
+            assert FileCache(directory).get('http://emailbuilder.ucsc.edu/other.html') is None
+        finally:
+            shutil.rmtree(directory)
+
+    def test_revalidated_hit(self):
+        """
+        a cached conversion is reused when the page answers a conditional request with 304
+        :return:
+        """
+        cache = ConversionCache()
+        headers = {'content-type': 'text/html; charset=UTF-8', 'etag': '"v1"'}
+        utils = RecordingUtils([make_page(headers=headers), make_page(status_code=304, html='')])
+        scraper = MessagingScraper(cache=cache)
+        scraper.utils = utils
+
+        content, errors = scraper.scrape(SAMPLE_URL)
+        assert cache.stats()['misses'] == 1
+
+        cached_content, cached_errors = scraper.scrape(SAMPLE_URL)
+        assert utils.requests[1] == {'If-None-Match': '"v1"'}
+        assert cached_content == content and cached_errors is errors
+        assert cache.stats()['hits'] == 1 and cache.stats()['not_modified'] == 1
+
+    def test_unchanged_content_hit(self):
+        """
+        a cached conversion is reused when the server resends the same page
+        :return:
+        """
+        cache = ConversionCache()
+        scraper = MessagingScraper(cache=cache)
+        scraper.utils = RecordingUtils([make_page(), make_page(), make_page(html=SAMPLE_PAGE + ' ')])
+
+        content, errors = scraper.scrape(SAMPLE_URL)
+        cached_content, cached_errors = scraper.scrape(SAMPLE_URL)
+        assert cached_errors is errors
+        changed_content, changed_errors = scraper.scrape(SAMPLE_URL)
+        assert changed_errors is not errors
+        assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+
+    def test_key(self):
+        """
+        entries are shared by urls that normalize alike, and not by conversions with other settings
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ConversionCache()
+            cache.configure({'CONVERSION_CACHE_DIR': directory, 'OUTPUT_COMPACTION': False})
+            cache.store(make_page(), 'inlined', [])
+            assert cache.get('HTTP://EmailBuilder.ucsc.edu:80/samples/newsletter/index.html#top').content == 'inlined'
+
+            cache.configure({'CONVERSION_CACHE_DIR': directory, 'OUTPUT_COMPACTION': True})
+            assert cache.get(SAMPLE_URL) is None
+            cache.configure({'CONVERSION_CACHE_DIR': directory, 'OUTPUT_COMPACTION': False})
+            assert cache.get(SAMPLE_URL).content == 'inlined'
+        finally:
+            shutil.rmtree(directory)
+
+class CountingPremailer(CachingPremailer):
+    """
+    CachingPremailer that serves a stylesheet from memory and counts the downloads
+    """
+    downloads = 0
+
+    def download_stylesheet(self, url):
+        CountingPremailer.downloads += 1
+        return u'p { color: blue; } a:hover { color: red; }'
+
+
+class TestStylesheetCache(unittest.TestCase):
+
+    def test_stylesheet_downloaded_once(self):
+        """
+        a stylesheet linked by several pages is downloaded and parsed once
+        :return:
+        """
+        stylesheet_cache = StylesheetCache()
+        html = '<html><head><link rel="stylesheet" href="http://emailbuilder.ucsc.edu/style.css"></head>' \
+               '<body><p>Styled</p></body></html>'
+        CountingPremailer.downloads = 0
+
+        for i in range(3):
+            output = CountingPremailer(html, stylesheet_cache=stylesheet_cache).transform()
+            assert '<p style="color:blue">' in output
+            assert 'a:hover' in output
+
+        assert CountingPremailer.downloads == 1
+        assert stylesheet_cache.stats()['hits'] == 2
+        assert stylesheet_cache.stats()['rule_sets'] == 1
+
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_selectors_shared_by_greenlets(self):
+        """
+        the requests a gevent worker serves at once share the compiled selectors
+        :return:
+        """
+        script = textwrap.dedent('''
+            from gevent import monkey
+            monkey.patch_all()
+            import sys
+            sys.path.insert(0, %r)
+            import gevent
+            from app.styles import compiled_css_selector
+            selectors = [job.get() for job in [gevent.spawn(compiled_css_selector, 'p.lead') for i in range(3)]]
+            print('ok' if all(selector is selectors[0] for selector in selectors) else selectors)
+        ''') % os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.STDOUT)
+        assert output.split()[-1] == 'ok'
+
+
 if __name__ == '__main__':
     unittest.main()
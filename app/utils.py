@@ -1,10 +1,32 @@
-from urlparse import urljoin
+import cgi
+import codecs
+import hashlib
+import time
 import bs4
 import requests
 from bs4 import BeautifulSoup
+from lxml import etree
 import re
-from premailer import Premailer
-from errors import ErrorCategory, ErrorType
+from http_client import http_client
+from checks import UrlRewriter, ImageSizer, ImageCheck, LinkCheck, TagCheck
+from images import ImageException, image_prober
+from link_checker import link_checker
+from cache import conversion_cache
+from instrumentation import instrumentation, stage_name
+from backends import document_backends
+from compactor import output_compactor
+
+
+def latin_1_fallback(error):
+    """
+    codecs error handler that decodes the bytes that aren't valid utf-8 as latin-1
+    :param error: the UnicodeDecodeError
+    :return:
+    """
+    return error.object[error.start:error.end].decode('iso-8859-1'), error.end
+
+
+codecs.register_error('latin-1-fallback', latin_1_fallback)
 
 
 class ContentNotHTMLException(Exception):
@@ -31,9 +53,78 @@ class BodyIsNoneException(Exception):
         Exception.__init__(self, "Body is None")
 
 
-class ImageException(Exception):
-    def __init__(self, image_url):
-        Exception.__init__(self, "Error getting height and width of image " + image_url)
+def premailer_for(html):
+    """
+    Returns the CachingPremailer that inlines a page. Premailer is imported on the first call
+    :param html: the page, as a string or an lxml tree
+    :return:
+    """
+    from inliner import CachingPremailer
+    return CachingPremailer(html=html)
+
+
+class FetchedPage(object):
+    """
+    The result of downloading a page once: the response status, headers and bytes, plus the
+    BeautifulSoup or lxml tree parsed from them on first use. Shared by the url validator and the
+    scraper so that a conversion costs a single request and a single parse
+
+    cached is set to a ConversionEntry when the conversion cache already holds a current result
+    for the page
+    """
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.cached = None
+        self._soup = None
+        self._tree = None
+        self._content_hash = None
+
+    @property
+    def soup(self):
+        """
+        The page parsed with BeautifulSoup, parsed the first time it is asked for
+        :return: A Soup object representing the page html
+        """
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.content, 'lxml')
+        return self._soup
+
+    @property
+    def tree(self):
+        """
+        The page parsed with lxml, parsed the first time it is asked for
+        :return: the root element of the page
+        """
+        if self._tree is None:
+            self._tree = etree.fromstring(self.content, etree.HTMLParser(encoding='utf-8'))
+        return self._tree
+
+    @property
+    def content_hash(self):
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha1(self.content).hexdigest()
+        return self._content_hash
+
+    def copy(self):
+        """
+        Returns the downloaded page without the trees parsed from it, for another request to convert
+        :return:
+        """
+        page = FetchedPage(self.url, self.status_code, self.headers, self.content)
+        page.cached = self.cached
+        return page
+
+    def is_ok(self):
+        return self.status_code == requests.codes.ok
+
+    def is_not_modified(self):
+        return self.status_code == requests.codes.not_modified
+
+    def is_html(self):
+        return self.headers.get('content-type') == 'text/html; charset=UTF-8'
 
 
 class ArticleUtils(object):
@@ -41,7 +132,18 @@ class ArticleUtils(object):
     This class provides functions to manipulate and reformat information scraped from
     articles, like urls, category names, etc.
     """
-    def __init__(self):
+    def __init__(self, link_checker=None, image_prober=None, backend=None):
+        """
+        :param link_checker: a LinkChecker used by the checks to find broken links and images, they
+        aren't requested when this is None
+        :param image_prober: an ImageProber used to fill in missing image sizes, they aren't filled
+        in when this is None
+        :param backend: the document backend pages are parsed, checked and inlined with, the one
+        chosen by PARSER_BACKEND when None
+        """
+        self.link_checker = link_checker
+        self.image_prober = image_prober
+        self.backend = backend if backend is not None else document_backends.default
         self.article_slug_regex = re.compile(r".*\/([^\/\.]+)(?:.[^\.\/]+$)*")
         self.article_ending_regex = re.compile(r".*\/([^\/]+)")
         self.content_tags_dict = {
@@ -54,21 +156,42 @@ class ArticleUtils(object):
             'p':    True,
             'li':   True,
         }
+        self.checks = [ImageCheck, LinkCheck, TagCheck]
+
+    def fetch_page(self, page_url, headers=None):
+        """
+        Downloads a web page once and wraps the response so it can be shared
+        :param page_url: the url of the page to be fetched
+        :param headers: extra request headers, e.g. to make the request conditional
+        :return: A FetchedPage for the url
+        """
+        with instrumentation.timer('fetch'):
+            r = http_client.get(page_url, headers=headers)
+        return FetchedPage(page_url, r.status_code, r.headers, r.content)
+
+    def get_soup_from_page(self, page):
+        """
+        Returns the document of an already fetched page, parsed by the backend
+        :param page: a FetchedPage
+        :raises: ContentNotHTMLException: if the page isn't html
+        :return: A Soup object representing the page html (the root lxml element with the lxml
+        backend), or 404 if the page wasn't found
+        """
+        if not page.is_ok():
+            return 404
+        if not page.is_html():
+            raise ContentNotHTMLException()
+        with instrumentation.timer('parse'):
+            return self.backend.parse(page)
 
     def get_soup_from_url(self, page_url):
         """
         Takes the url of a web page and returns a BeautifulSoup Soup object representation
         :param page_url: the url of the page to be parsed
-        :param article_url: the url of the web page
-        :raises: r.raise_for_status: if the url doesn't return an HTTP 200 response
+        :raises: ContentNotHTMLException: if the page isn't html
         :return: A Soup object representing the page html
         """
-        r = requests.get(page_url)
-        if r.status_code != requests.codes.ok:
-            return 404
-        if r.headers['content-type'] != 'text/html; charset=UTF-8':
-            raise ContentNotHTMLException()
-        return BeautifulSoup(r.content, 'lxml')
+        return self.get_soup_from_page(self.fetch_page(page_url))
 
     def get_response(self, url):
         """
@@ -79,7 +202,7 @@ class ArticleUtils(object):
 
         # noinspection PyBroadException
         try:
-            r = requests.get(url)
+            r = http_client.get(url)
         except:
             return 404
         return r.status_code
@@ -88,27 +211,176 @@ class ArticleUtils(object):
         """
         converts all unicode characters in a string to their html entity equivalents
         without converting any already existing html entities into their ascii equivalents
-        :param content_string:
+
+        the whole string is converted in a single pass by the codecs, bytes that aren't part of a
+        valid utf-8 sequence are read as latin-1
+        :param content_string: a utf-8 encoded str, or a unicode string
+        :return: an ascii str
+        """
+        if not isinstance(content_string, unicode):
+            content_string = content_string.decode('utf-8', 'latin-1-fallback')
+        return content_string.encode('ascii', 'xmlcharrefreplace')
+
+    def register_check(self, check_class):
+        """
+        Adds a check to the ones run by get_errors_dict and check_document. A check is a
+        DocumentVisitor class whose constructor takes this ArticleUtils
+        :param check_class:
         :return:
         """
+        self.checks.append(check_class)
 
-        transformed = ""
-        i = 0
-        while i < len(content_string):
-            if ord(content_string[i]) >= 128:
-                temp = content_string[i] + content_string[i + 1] + content_string[i + 2] + content_string[i + 3]
-                print temp + content_string[i + 4] + content_string[i + 5] + content_string[i + 6] + content_string[i + 7]
+    def walk(self, soup, visitors):
+        """
+        Walks the tree once, passing each tag to the visitors interested in its tag name
+        :param soup: a document or tag of the backend
+        :param visitors: a list of DocumentVisitors, each tag is visited in list order
+        :return: the ErrorCategory results of the visitors that return one
+        """
+        self.visit_tree(soup, visitors)
+        return self.finish_visitors(visitors)
 
-                try:
-                    transformed += temp.decode('utf-8').encode('ascii', 'xmlcharrefreplace')
-                except UnicodeDecodeError as e:
-                    transformed += temp.decode('iso-8859-1').encode('ascii', 'xmlcharrefreplace')
-                i += 4
+    def visit_tree(self, soup, visitors):
+        """
+        Passes each tag of the tree to the visitors interested in its tag name, without finishing them
+        :param soup: a document or tag of the backend
+        :param visitors: a list of DocumentVisitors, each tag is visited in list order
+        :return:
+        """
+        timings = instrumentation.current() if instrumentation.enabled else None
+
+        visits_by_name = {}
+        visit_all = []
+        for visitor in visitors:
+            visit = visitor.visit if timings is None else self.timed(visitor.visit, visitor, timings)
+            if visitor.tag_names is None:
+                visit_all.append(visit)
             else:
-                transformed += content_string[i]
-                i += 1
+                for name in visitor.tag_names:
+                    visits_by_name.setdefault(name, []).append(visit)
+
+        no_visits = []
+        for tag in self.backend.iter_tags(soup, None if visit_all else list(visits_by_name)):
+            for visit in visits_by_name.get(tag.name, no_visits):
+                visit(tag)
+            for visit in visit_all:
+                visit(tag)
+
+    def finish_visitors(self, visitors):
+        """
+        Checks the urls the visitors collected with the LinkChecker, if there is one, and collects
+        their results
+        :param visitors: DocumentVisitors that have visited a tree
+        :return: the ErrorCategory results of the visitors that return one
+        """
+        timings = instrumentation.current() if instrumentation.enabled else None
+
+        if self.link_checker is not None:
+            urls = []
+            for visitor in visitors:
+                urls.extend(visitor.resource_urls())
+            if urls:
+                with instrumentation.timer('check_links'):
+                    statuses = self.link_checker.check(urls)
+                for visitor in visitors:
+                    visitor.resolve(statuses)
+
+        results = []
+        for visitor in visitors:
+            if timings is None:
+                result = visitor.result()
+            else:
+                result = self.timed(visitor.result, visitor, timings)()
+            if result is not None:
+                results.append(result)
+        return results
+
+    def resource_errors(self, visitors):
+        """
+        Returns the ResourceErrors of finished visitors whose urls were checked by the LinkChecker
+        :param visitors: DocumentVisitors finished with finish_visitors
+        :return: a list of ResourceErrors
+        """
+        if self.link_checker is None:
+            return []
+        resources = [visitor.resource_errors() for visitor in visitors]
+        return [resource for resource in resources if resource is not None]
+
+    def resolve_resources(self, errors, resources):
+        """
+        Checks the urls of a cached conversion's links and images again with the LinkChecker, which
+        keeps their statuses for LINK_CHECK_TTL, and adds the broken and unverified ones to the errors
+        :param errors: the cached list of ErrorCategory objects, left unchanged
+        :param resources: the ResourceErrors cached with them
+        :return: a list of ErrorCategory objects
+        """
+        if self.link_checker is None or not resources:
+            return errors
+        urls = []
+        for resource in resources:
+            urls.extend(resource.urls())
+        with instrumentation.timer('check_links'):
+            statuses = self.link_checker.check(urls)
+        errors = list(errors)
+        for resource in resources:
+            resource.add_errors(errors, statuses)
+        return errors
+
+    def timed(self, method, visitor, timings):
+        """
+        Wraps a method of a visitor so the time spent in it is added to the visitor's stage, e.g.
+        image_check for ImageCheck
+        :param method:
+        :param visitor:
+        :param timings: the Timings of the current request
+        :return:
+        """
+        stage = stage_name(visitor)
+
+        def timed_method(*args):
+            started = time.time()
+            try:
+                return method(*args)
+            finally:
+                timings.add(stage, time.time() - started)
+
+        return timed_method
+
+    def check_document(self, soup, page_url):
+        """
+        Converts the urls of a page, fills in missing image sizes and runs every registered check on
+        it in a single walk
+        :param soup:
+        :param page_url:
+        :return: a list of ErrorCategory objects
+        """
+        return self.walk(soup, self.prepare_visitors(page_url) + self.check_visitors())
+
+    def prepare_document(self, soup, page_url):
+        """
+        Converts the urls of a page and fills in missing image sizes, without checking it
+        :param soup:
+        :param page_url:
+        :return:
+        """
+        self.walk(soup, self.prepare_visitors(page_url))
+
+    def run_checks(self, soup):
+        """
+        Runs every registered check on a page that has been through prepare_document
+        :param soup:
+        :return: a list of ErrorCategory objects
+        """
+        return self.walk(soup, self.check_visitors())
 
-        return transformed
+    def prepare_visitors(self, page_url):
+        visitors = [UrlRewriter(page_url)]
+        if self.image_prober is not None:
+            visitors.append(ImageSizer(self.image_prober))
+        return visitors
+
+    def check_visitors(self):
+        return [check_class(self) for check_class in self.checks]
 
     def convert_urls(self, body, page_url):
         """
@@ -117,38 +389,7 @@ class ArticleUtils(object):
         :param body:
         :return:
         """
-        images = body.find_all("img")
-        if images is not None:
-            for image in images:
-                if 'src' in image.attrs:
-                    image_relative_src = image.attrs['src']
-                    image_src = urljoin(page_url, image_relative_src)
-                    image.attrs['src'] = image_src
-
-        iframes = body.find_all("iframe")
-        if iframes is not None:
-            for iframe in iframes:
-                if 'src' in iframe.attrs:
-                    iframe_relative_src = iframe.attrs['src']
-                    iframe_src = urljoin(page_url, iframe_relative_src)
-                    iframe.attrs['src'] = iframe_src
-
-        a_tags = body.find_all("a")
-        if a_tags is not None:
-            for a_tag in a_tags:
-                if 'href' in a_tag.attrs:
-                    a_tag_relative_src = a_tag.attrs['href']
-                    a_tag_src = urljoin(page_url, a_tag_relative_src)
-                    a_tag.attrs['href'] = a_tag_src
-
-        links = body.find_all("link")
-        if links is not None:
-            for link in links:
-                if 'href' in link.attrs:
-                    link_relative_src = link.attrs['href']
-                    link_src = urljoin(page_url, link_relative_src)
-                    link.attrs['href'] = link_src
-
+        self.walk(body, [UrlRewriter(page_url)])
 
     def tag_check(self, soup):
         """
@@ -157,112 +398,27 @@ class ArticleUtils(object):
         :param soup:
         :return:
         """
-
-        tag_check = ErrorCategory('Tag Check')
-        empty_tag = ErrorType('Empty tag')
-
-        for child in soup.recursiveChildGenerator():
-            if isinstance(child, bs4.element.Tag):
-                if str(child.name).lower() in self.content_tags_dict:
-                    if len(child.contents) == 0:
-                        empty_tag.add_tag(str(child))
-                    else:
-                        empty = True
-                        for content in child.contents:
-                            if isinstance(content, bs4.element.Tag):
-                                stripped_content = content.encode(formatter='html').lstrip().rstrip()
-                            else:
-                                stripped_content = content.encode('utf-8').lstrip().rstrip()
-                            if len(stripped_content) != 0:
-                                empty = False
-                        if empty:
-                            empty_tag.add_tag(str(child))
-
-        if len(empty_tag.tags) > 0:
-            tag_check.add_type(empty_tag)
-
-        return tag_check
+        return self.walk(soup, [TagCheck(self)])[0]
 
     def image_check(self, soup):
         """
         Takes a bs4 Soup , iterates through all the image tags, and checks them for errors including:
             - missing alt attribute
             - missing src attribute
-            - broken link
         :param soup:
         :return:
         """
-
-        image_check = ErrorCategory('Image Check')
-        missing_src = ErrorType('Missing source')
-        missing_alt = ErrorType('Missing alt text')
-
-        images = soup.find_all("img")
-        if images is not None:
-            for image in images:
-                if 'src' not in image.attrs:
-                    missing_src.add_tag(str(image))
-                elif len(image['src'].lstrip().rstrip()) == 0:
-                    missing_src.add_tag(str(image))
-
-                if 'alt' in image.attrs:
-                    alt = image.attrs['alt'].lstrip().rstrip()
-                    if len(alt) == 0:
-                        missing_alt.add_tag(str(image))
-                else:
-                    missing_alt.add_tag(str(image))
-
-        if len(missing_src.tags) > 0:
-            image_check.add_type(missing_src)
-
-        if len(missing_alt.tags) > 0:
-            image_check.add_type(missing_alt)
-
-        return image_check
+        return self.walk(soup, [ImageCheck(self)])[0]
 
     def link_check(self, soup):
         """
         Takes a bs4 Soup , iterates through all the <a> tags, and checks them for errors including:
-            - missing alt attribute
-            - missing src attribute
-            - broken link
+            - no content
+            - missing href attribute
         :param soup:
         :return:
         """
-
-        link_check = ErrorCategory('Link Check')
-        empty_link = ErrorType('Empty link')
-        missing_href = ErrorType('Missing href')
-
-        links = soup.find_all("a")
-        if links is not None:
-            for link in links:
-                if len(link.contents) == 0:
-                    empty_link.add_tag(str(link))
-                else:
-                    empty = True
-                    for content in link.contents:
-                        if isinstance(content, bs4.element.Tag):
-                            stripped_content = content.encode(formatter='html').lstrip().rstrip()
-                        else:
-                            stripped_content = (content.encode('utf-8')).lstrip().rstrip()
-                        if len(stripped_content) != 0:
-                            empty = False
-                    if empty:
-                        empty_link.add_tag(str(link))
-                if 'href' not in link.attrs:
-                    missing_href.add_tag(str(link))
-                else:
-                    if len(link['href'].lstrip().rstrip()) == 0:
-                        missing_href.add_tag(str(link))
-
-        if len(empty_link.tags) > 0:
-            link_check.add_type(empty_link)
-
-        if len(missing_href.tags) > 0:
-            link_check.add_type(missing_href)
-
-        return link_check
+        return self.walk(soup, [LinkCheck(self)])[0]
 
     def get_errors_dict(self, soup):
         """
@@ -270,79 +426,252 @@ class ArticleUtils(object):
         :param soup:
         :return:
         """
-
-        return [
-            self.image_check(soup),
-            self.link_check(soup),
-            self.tag_check(soup),
-        ]
+        return self.walk(soup, [check_class(self) for check_class in self.checks])
 
 
 class MessagingScraper(object):
     """
     scrapes a tuesday newsday page
     """
-    def __init__(self, start_index=0):
+    def __init__(self, start_index=0, cache=None, link_checker=None, image_prober=None, backend=None, compactor=None):
         """
         Initializes the index counter for parsed objects to start_index or 0 if none is given
+        :param cache: a ConversionCache to reuse and store results in
+        :param link_checker: a LinkChecker to find broken links and images with
+        :param image_prober: an ImageProber to fill in missing image sizes with
+        :param backend: the document backend to parse pages with, the one chosen by PARSER_BACKEND when None
+        :param compactor: an OutputCompactor to compact the inlined content with and report its size
+        :return:
+        """
+        self.utils = ArticleUtils(link_checker=link_checker, image_prober=image_prober, backend=backend)
+        self.cache = cache
+        self.compactor = compactor
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns a scraper using the shared conversion cache and output compactor, and the shared link
+        checker and image prober when the config enables them
+        :param config: the app config
         :return:
         """
-        self.utils = ArticleUtils()
+        return cls(cache=conversion_cache,
+                   link_checker=link_checker if config.get('CHECK_BROKEN_LINKS') else None,
+                   image_prober=image_prober if config.get('PROBE_IMAGE_SIZES') else None,
+                   compactor=output_compactor)
 
-    def scrape(self, url):
+    def scrape(self, url, page=None):
+        """
+        Inlines the css of a page and checks its content for errors
+        :param url: the url of the page
+        :param page: the FetchedPage for the url if it has already been downloaded, e.g. by the form validator
+        :return: the inlined content and a list of ErrorCategory objects
         """
+        page = self.get_page(url, page)
+
+        if page.cached is not None:
+            return page.cached.content, self.cached_errors(page.cached)
+
+        content_string, check = self.convert_page(url, page)
+
+        return content_string, check()
 
+    def scrape_content_first(self, url, page=None):
+        """
+        Inlines the css of a page, leaving the checks, which may wait on link checks, to be finished
+        afterwards. The page is walked once before inlining, and the checks let go of its tags
+        :param url: the url of the page
+        :param page: the FetchedPage for the url if it has already been downloaded, e.g. by the form validator
+        :return: the inlined content and a function that runs the checks and returns a list of
+        ErrorCategory objects
+        """
+        page = self.get_page(url, page)
+
+        if page.cached is not None:
+            cached = page.cached
+            return cached.content, lambda: self.cached_errors(cached)
+
+        return self.convert_page(url, page)
+
+    def convert_page(self, url, page):
+        """
+        Converts a fetched page and compacts the content, leaving the checks to be finished
         :param url:
+        :param page: a FetchedPage that isn't cached
+        :return: the inlined content and a function that finishes the checks, stores the result in
+        the cache and returns a list of ErrorCategory objects
+        """
+        content_string, check_visitors = self.convert(url, page)
+
+        content_string, size_check = self.compact_content(content_string)
+
+        def check():
+            errors = self.utils.finish_visitors(check_visitors)
+            if size_check is not None:
+                errors.append(size_check)
+            if self.cache is not None:
+                self.cache.store(page, content_string, errors, self.utils.resource_errors(check_visitors))
+            return errors
+
+        return content_string, check
+
+    def cached_errors(self, entry):
+        """
+        Returns the errors of a cached conversion, with its links and images checked again
+        :param entry: a ConversionEntry
+        :return: a list of ErrorCategory objects
+        """
+        return self.utils.resolve_resources(entry.errors, entry.resources)
+
+    def convert(self, url, page):
+        """
+        Parses a page, rewrites its urls, fills in image sizes, visits it with the checks and inlines
+        its css. Subclasses convert elsewhere by overriding it, or add to the stages with the
+        after_parse and before_inline hooks
+        :param url:
+        :param page: a FetchedPage
+        :return: the inlined content and the visited checks, to be finished with ArticleUtils.finish_visitors
+        """
+        soup = self.utils.get_soup_from_page(page)
+
+        self.after_parse(soup)
+
+        prepare_visitors = self.utils.prepare_visitors(url)
+        check_visitors = self.utils.check_visitors()
+        self.utils.visit_tree(soup, prepare_visitors + check_visitors)
+        self.utils.finish_visitors(prepare_visitors)
+
+        # the lxml backend inlines the tree the checks visited
+        if self.utils.backend.inlines_in_place:
+            for visitor in check_visitors:
+                visitor.detach()
+
+        self.wrap_content(soup)
+
+        self.before_inline(soup)
+
+        content_string = self.inline_content(soup)
+
+        return content_string, check_visitors
+
+    def after_parse(self, soup):
+        """
+        Called once a page has been parsed, before it is visited
+        :param soup:
         :return:
         """
-        soup = self.utils.get_soup_from_url(url)
+        pass
 
-        self.utils.convert_urls(soup, url)
+    def before_inline(self, soup):
+        """
+        Called once the content of a page has been wrapped, before it is inlined
+        :param soup:
+        :return:
+        """
+        pass
+
+    def compact_content(self, content_string):
+        """
+        Compacts the inlined content with the scraper's compactor, when it has one
+        :param content_string: the inlined content, or None
+        :return: the content, and a Size Check ErrorCategory to add to the errors, or None
+        """
+        if self.compactor is None or content_string is None:
+            return content_string, None
+        with instrumentation.timer('compact'):
+            return self.compactor.compact_content(content_string)
+
+    def get_page(self, url, page=None):
+        if page is not None:
+            return page
+        if self.cache is not None:
+            return self.cache.fetch_page(url, self.utils)
+        return self.utils.fetch_page(url)
+
+    def wrap_content(self, soup):
+        """
+        Moves the contents of the body into a div with the content_div class
+        :param soup:
+        :return:
+        """
+        self.utils.backend.wrap_content(soup)
 
-        body = soup.body
+    def inline_content(self, soup):
+        """
+        Inlines the css of a page whose body has been wrapped in the content div and returns the html
+        of the content div. Premailer works on an lxml tree of the page, from the backend, and the
+        content is serialized straight from that tree as html: non-ascii characters and named
+        entities are written as numeric entities (&#233;, &#160;) and void tags without a slash (<br>)
+        :param soup:
+        :return: the inlined content as an ascii string
+        """
+        with instrumentation.timer('serialize'):
+            document = self.utils.backend.to_etree(soup)
 
-        content_div = soup.new_tag('div')
+        with instrumentation.timer('inline'):
+            premailer = premailer_for(document)
 
-        content_div.attrs['class'] = 'content_div'
+            premailer.transform()
 
-        for content in reversed(body.contents):
-            content_div.insert(0, content.extract())
+        with instrumentation.timer('extract'):
+            content_tags = document.xpath('//div[@class="content_div"]')
 
-        body.append(content_div)
+            if not content_tags:
+                content_string = None
+            else:
+                content_tag = content_tags[0]
 
-        # soup_string = str(soup)
+                content_string = ''
 
-        soup_string = soup.encode(formatter='html')
+                if content_tag.text:
+                    content_string += cgi.escape(content_tag.text).encode('ascii', 'xmlcharrefreplace')
 
-        soup_string = self.utils.unicode_to_html_entities(soup_string)
+                for content in content_tag:
+                    content_string += etree.tostring(content, method='html', encoding='us-ascii')
 
-        premailer = Premailer(html=soup_string)
+        if content_string is None:
+            return self.inline_content_string(self.utils.backend.serialize(soup))
+
+        return content_string
+
+    def inline_content_string(self, soup_string):
+        """
+        Inlines the css of a serialized page by handing Premailer the html as a string and parsing
+        its output again to find the content div
+        :param soup_string:
+        :return: the inlined content as an ascii string
+        """
+        with instrumentation.timer('entity_encode'):
+            soup_string = self.utils.unicode_to_html_entities(soup_string)
 
-        output = premailer.transform()
+        with instrumentation.timer('inline'):
+            premailer = premailer_for(soup_string)
 
-        inline_body_soup = BeautifulSoup(output, 'lxml')
+            output = premailer.transform()
 
-        content_tag = inline_body_soup.find('div', {'class': 'content_div'})
+        with instrumentation.timer('reparse'):
+            inline_body_soup = BeautifulSoup(output, 'lxml')
 
-        content_string = ''
+        with instrumentation.timer('extract'):
+            content_tag = inline_body_soup.find('div', {'class': 'content_div'})
 
-        if content_tag is not None:
-            for content in content_tag.contents:
+            content_string = ''
 
-                if isinstance(content, bs4.element.Tag):
-                    if 'class' in content.attrs:
-                        for class_name in content.attrs['class']:
-                            if class_name == 'ignore':
-                                continue
+            if content_tag is not None:
+                for content in content_tag.contents:
 
-                if isinstance(content, bs4.element.Comment):
-                    content_string += '<!--' + str(content) + '-->'
-                elif isinstance(content, bs4.element.NavigableString):
-                    content_string += str(content)
-                elif isinstance(content, bs4.element.Tag):
-                    content_string += content.encode(formatter='html')
+                    if isinstance(content, bs4.element.Tag):
+                        if 'class' in content.attrs:
+                            for class_name in content.attrs['class']:
+                                if class_name == 'ignore':
+                                    continue
 
-        content_string = self.utils.unicode_to_html_entities(content_string)
-        errors = self.utils.get_errors_dict(content_tag)
+                    if isinstance(content, bs4.element.Comment):
+                        content_string += '<!--' + str(content) + '-->'
+                    elif isinstance(content, bs4.element.NavigableString):
+                        content_string += str(content)
+                    elif isinstance(content, bs4.element.Tag):
+                        content_string += content.encode(formatter='html')
 
-        return content_string, errors
+        with instrumentation.timer('entity_encode'):
+            return self.utils.unicode_to_html_entities(content_string)
@@ -1,13 +1,66 @@
-from flask import render_template, flash, redirect, url_for, request
-from app import app
+from flask import Blueprint, current_app, render_template, flash, redirect, url_for, request, jsonify, Response, \
+    stream_with_context
 from forms import URLForm
-from utils import MessagingScraper
-import requests
-import os
+from async_scraper import scraper_for
+from batch import BatchConverter
+from compression import compress_response
+from form_validators import fetch_messaging_page
+from cache import conversion_cache, block_cache
+from styles import stylesheet_cache
+from slack import slack_reporter
+from instrumentation import instrumentation
+from workers import PoolFullException, process_pool
+from singleflight import conversion_flights
+from prewarm import PrewarmJob, prewarm_queue
+from domains import domain_extractor
+from errors import ErrorCategory, ErrorType
+import json
 import re
 
 
-@app.route('/', methods=['GET', ])
+main = Blueprint('main', __name__)
+
+# the endpoints whose stages are timed when instrumentation is enabled
+TIMED_ENDPOINTS = ('index', 'api_convert')
+
+
+def endpoint_name():
+    """
+    The endpoint of the request without the blueprint's name, as it is reported in timings
+    :return:
+    """
+    return (request.endpoint or '').rpartition('.')[2]
+
+
+@main.before_app_request
+def start_timings():
+    if instrumentation.enabled and endpoint_name() in TIMED_ENDPOINTS:
+        instrumentation.start()
+
+
+@main.after_app_request
+def finish_timings(response):
+    """
+    Adds the stage timings of the request to the metrics, a Server-Timing header and the log. The
+    checks of a streamed result page run after this, and aren't included
+    """
+    if not instrumentation.enabled:
+        return response
+    timings = instrumentation.finish(endpoint_name())
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+        current_app.logger.info(json.dumps({
+            'event': 'timings',
+            'endpoint': endpoint_name(),
+            'url': request.args.get('url'),
+            'status': response.status_code,
+            'seconds': round(timings.total(), 6),
+            'stages': timings.to_dict(),
+        }, sort_keys=True))
+    return response
+
+
+@main.route('/', methods=['GET', ])
 def index():
     form = URLForm()
     if 'url' in request.args:
@@ -16,47 +69,195 @@ def index():
         if form.validate():
 
             template = 'result.html'
-            scraper = MessagingScraper()
+            scraper = scraper_for(current_app.config)
+            page = getattr(form.url, 'fetched_page', None)
+
+            if current_app.config.get('STREAM_RESULTS'):
+                return stream_result(template, scraper, url, page)
 
-            content, errors = scraper.scrape(url)
+            content, errors = scraper.scrape(url, page=page)
 
             return render_template(template, content=content, errors=errors)
 
         for field, errors in form.errors.items():
             for error in errors:
                 flash(error)
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     else:
         return render_template('index.html',
                                form=URLForm())
 
 
+def stream_result(template, scraper, url, page=None):
+    """
+    Renders the result page as a stream, so the page and the inlined content are sent as soon as
+    they are ready and the errors follow once the checks are done
+    :param template:
+    :param scraper: a MessagingScraper
+    :param url:
+    :param page: the FetchedPage for the url if it has already been downloaded
+    :return:
+    """
+    content, check = scraper.scrape_content_first(url, page=page)
+    request_url, request_path = request.url, request.path
+
+    def checked():
+        # the response has been sent by now, a failure is reported and shown in place of the errors
+        try:
+            return check()
+        except Exception as e:
+            current_app.logger.exception('Checks of a streamed result failed')
+            slack_reporter.report(e, request_url, request_path)
+            check_error = ErrorCategory('Check Error')
+            checks_failed = ErrorType('Checks failed')
+            checks_failed.add_tag('%s: %s' % (type(e).__name__, e))
+            check_error.add_type(checks_failed)
+            return [check_error]
+
+    context = {'content': content, 'check': checked, 'stream': True}
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template).stream(context)
+    return Response(stream_with_context(stream), mimetype='text/html')
+
+
+@main.route('/api/convert', methods=['GET', ])
+def api_convert():
+    """
+    Converts ?url= and returns the inlined content and its errors as json. With ?errors_only=1 the
+    content is left out. Responses carry an ETag, so a conversion that hasn't changed since the
+    client's copy is answered with 304 Not Modified
+    """
+    url = request.args.get('url', '').strip()
+    errors_only = request.args.get('errors_only', '0').lower() in ('1', 'true', 'yes')
+    if not url:
+        return jsonify(error='Expected a url parameter'), 400
+
+    try:
+        page = fetch_messaging_page(url)
+        content, errors = scraper_for(current_app.config).scrape(url, page=page)
+    except ValueError as e:
+        # ValidationErrors, and malformed urls
+        return jsonify(url=url, error=str(e)), 400
+    except PoolFullException:
+        raise
+    except Exception as e:
+        slack_reporter.report(e, request.url, request.path)
+        return jsonify(url=url, error='%s: %s' % (type(e).__name__, e)), 500
+
+    result = {
+        'url': url,
+        'errors': [error_category.to_dict() for error_category in errors],
+    }
+    if not errors_only:
+        result['content'] = content
+
+    response = Response(json.dumps(result, sort_keys=True), mimetype='application/json')
+    response.add_etag(weak=True)
+    response.make_conditional(request)
+    return compress_response(response, request.accept_encodings, current_app.config['API_COMPRESS_MIN_SIZE'])
+
+
+@main.route('/metrics', methods=['GET', ])
+def metrics():
+    """
+    The stage timing histograms of this process, in the Prometheus text format
+    """
+    return Response(instrumentation.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@main.route('/cache/stats', methods=['GET', ])
+def cache_stats():
+    stats = conversion_cache.stats()
+    stats['stylesheets'] = stylesheet_cache.stats()
+    stats['blocks'] = block_cache.stats()
+    stats['processes'] = process_pool.stats()
+    stats['single_flight'] = conversion_flights.stats()
+    stats['prewarm'] = prewarm_queue.stats()
+    return jsonify(stats)
+
+
+@main.route('/batch', methods=['POST', ])
+def batch():
+    """
+    Converts the urls posted as {"urls": [...]} and streams back one json result per line, in the
+    order the urls finish
+    """
+    data = request.get_json(silent=True)
+    urls = data.get('urls') if isinstance(data, dict) else None
+    if not isinstance(urls, list) or not all(isinstance(url, basestring) for url in urls):
+        return jsonify(error='Expected a json object with a list of urls'), 400
+    if len(urls) > current_app.config['BATCH_MAX_URLS']:
+        return jsonify(error='At most %d urls can be converted at once' % current_app.config['BATCH_MAX_URLS']), 400
+
+    converter = BatchConverter(current_app.config, workers=current_app.config['BATCH_WORKERS'])
+    results = (json.dumps(result) + '\n' for result in converter.convert(urls))
+    return Response(results, mimetype='application/x-ndjson')
+
+
+@main.route('/prewarm', methods=['POST', ])
+def prewarm():
+    """
+    Queues the urls posted as {"urls": [...]}, and the pages linked from the index pages or
+    sitemaps posted as {"indexes": [...]}, to be converted ahead of time by the prewarm-worker
+    """
+    if not prewarm_queue.enabled:
+        return jsonify(error='Pre-warming is not set up, set PREWARM_QUEUE_PATH'), 404
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error='Expected a json object with a list of urls or indexes'), 400
+    jobs = []
+    for key, kind in (('urls', PrewarmJob.PAGE), ('indexes', PrewarmJob.INDEX)):
+        urls = data.get(key, [])
+        if not isinstance(urls, list) or not all(isinstance(url, basestring) for url in urls):
+            return jsonify(error='Expected %s to be a list of urls' % key), 400
+        jobs.extend((url.strip(), kind) for url in urls if url.strip())
+    if len(jobs) > current_app.config['BATCH_MAX_URLS']:
+        return jsonify(error='At most %d urls can be queued at once' % current_app.config['BATCH_MAX_URLS']), 400
+
+    queued = []
+    rejected = []
+    for url, kind in jobs:
+        # index pages are crawled, only UCSC pages are requested
+        if domain_extractor.domain(url) != 'ucsc':
+            rejected.append(url)
+        elif prewarm_queue.enqueue(url, kind):
+            queued.append(url)
+    return jsonify(queued=queued, rejected=rejected), 202
+
+
 def flash_errors(form):
     for field, errors in form.errors.items():
         for error in errors:
             flash(error)
 
-def send_error_to_slack(error, url):
-    slack_url = os.environ.get('SLACK_WEBHOOK_URL')
-    error_message = "Error in the *Web-to-Email* tool: %(error)s \nURL: %(url)s" % locals()
-    message_payload = {'text': error_message}
-    requests.post(slack_url, json=message_payload)
-
+@main.app_errorhandler(PoolFullException)
+def pool_full(e):
+    """
+    Every converter process is busy and enough conversions are waiting, the client is asked to come
+    back rather than kept waiting
+    """
+    if request.path.startswith('/api/'):
+        response = jsonify(error=str(e))
+    else:
+        response = Response(str(e), mimetype='text/plain')
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
 
-@app.errorhandler(404)
-def page_not_found(e):    
+@main.app_errorhandler(404)
+def page_not_found(e):
     if re.search(r"\.[\w]{3,}$", request.path) is None:
-        send_error_to_slack(e, request.url)
+        slack_reporter.report(e, request.url, request.path)
     return render_template('404.html'), 404
 
-@app.errorhandler(403)
+@main.app_errorhandler(403)
 def page_not_found(e):
-    send_error_to_slack(e, request.url)
+    slack_reporter.report(e, request.url, request.path)
     return render_template('403.html'), 403
 
-@app.errorhandler(500)
+@main.app_errorhandler(500)
 def page_not_found(e):
     user_agent = request.headers.get('user-agent')
     if re.search(r"Slackbot\-LinkExpanding", user_agent) is None:
-        send_error_to_slack(e, request.url)
+        slack_reporter.report(e, request.url, request.path)
     return render_template('500.html'), 500
\ No newline at end of file
@@ -0,0 +1,411 @@
+import _multiprocessing
+import _socket
+import cPickle as pickle
+import logging
+import os
+import signal
+import socket
+import struct
+import threading
+from Queue import Queue
+from utils import ArticleUtils, FetchedPage, MessagingScraper
+from images import ImageProber, image_prober
+from http_client import http_client
+from styles import stylesheet_cache
+from cache import conversion_cache, block_cache
+from link_checker import link_checker
+from domains import domain_extractor
+from slack import slack_reporter
+from instrumentation import instrumentation
+from singleflight import conversion_flights
+
+try:
+    # forks without watching the child, which the spawner leaves to the kernel to reap
+    from gevent.os import fork_gevent as fork_process
+except ImportError:
+    fork_process = os.fork
+
+# a page with a little of everything, inlined by the pool before it forks so every import and
+# cache the conversion uses is loaded once in the parent
+WARM_UP_URL = 'http://emailbuilder.ucsc.edu/warm-up.html'
+WARM_UP_PAGE = '<html><head><style>h1 { color: red; } p.intro { font-size: 14px; }</style></head><body>' \
+               '<table align="center" summary="Email content"><tr><td><h1>Warm up</h1>' \
+               '<p class="intro">Caf\xc3\xa9 <a href="/news.html">news</a></p><img src="/image.png"/>' \
+               '</td></tr></table></body></html>'
+
+
+class PoolFullException(Exception):
+    """
+    Raised when a conversion is submitted while every process is busy and the queue is full
+    """
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'Every converter process is busy, retry in %d seconds' % retry_after)
+        self.retry_after = retry_after
+
+
+class WorkerException(Exception):
+    """
+    Raised for a conversion that failed in a pool process with an exception that couldn't be sent back
+    """
+    pass
+
+
+def send_message(sock, message):
+    send_data(sock, pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+
+def send_data(sock, data):
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def receive_data(sock):
+    size, = struct.unpack('!I', receive_exactly(sock, 4))
+    return receive_exactly(sock, size)
+
+
+def receive_message(sock):
+    return pickle.loads(receive_data(sock))
+
+
+# the ImageProber of a pool process, made once it has forked
+worker_image_prober = None
+
+
+def inline_page(url, status_code, headers, content, checks, probe_images=False, backend=None):
+    """
+    MessagingScraper.convert, the CPU bound part of a conversion, in a pool process: parses the page,
+    rewrites its urls, fills in image sizes, visits it with the checks and inlines its css. Broken link
+    checks are left to the caller, which finishes the returned checks with ArticleUtils.finish_visitors
+    :param url:
+    :param status_code: the status code of the fetched page
+    :param headers: the headers of the fetched page
+    :param content: the fetched page
+    :param checks: the DocumentVisitor classes to check the page with
+    :param probe_images: whether to fill in missing image sizes, in a pool process
+    :param backend: the document backend to convert with, the default one when None
+    :return: the inlined content and the visited, detached checks
+    """
+    scraper = MessagingScraper(image_prober=worker_image_prober if probe_images else None, backend=backend)
+    scraper.utils.checks = list(checks)
+    return scraper.convert(url, FetchedPage(url, status_code, headers, content))
+
+
+def reset_after_fork():
+    """
+    Replaces, in a forked process, what the parent's other threads may have been using when it
+    forked: a lock they held stays held in the child, where no thread will release it, and thread
+    pools have no threads left
+    :return:
+    """
+    for shared in (http_client, conversion_cache, block_cache, stylesheet_cache, link_checker, image_prober,
+                   domain_extractor, slack_reporter, instrumentation, conversion_flights):
+        shared.after_fork()
+
+    # noinspection PyProtectedMember
+    logging._lock = threading.RLock()
+    # noinspection PyProtectedMember
+    for handler_ref in logging._handlerList:
+        handler = handler_ref()
+        if handler is not None:
+            handler.createLock()
+
+
+def warm_up():
+    """
+    Inlines WARM_UP_PAGE, which loads every import and cache a conversion uses. Done before the pool
+    forks, and by gunicorn in the master process when the app is preloaded, so the processes forked
+    after share them
+    :return:
+    """
+    inline_page(WARM_UP_URL, 200, {'content-type': 'text/html; charset=UTF-8'}, WARM_UP_PAGE, ArticleUtils().checks)
+
+
+class WorkerProcess(object):
+    """
+    A forked pool process and the socket the pool talks to it over
+    """
+    def __init__(self, pid, sock):
+        self.pid = pid
+        self.sock = sock
+
+
+class Spawner(object):
+    """
+    A process that forks the pool processes of a worker. It is forked when the pool starts, before
+    a gevent worker serves any request, and waits on a blocking socket that never runs gevent's
+    hub. A process forked by the worker while it serves would inherit the greenlets of its requests
+    and its accept loop, and answer requests on the listening socket as soon as it waited on a
+    socket of its own. The sockets of the pool processes are sent back over a unix socket
+    """
+    def __init__(self, pid, sock):
+        self.pid = pid
+        self.sock = sock
+
+    @classmethod
+    def start(cls, serve):
+        """
+        Forks the spawner
+        :param serve: called in each pool process with its end of the socket, doesn't return
+        :return:
+        """
+        # sockets of the _socket module aren't patched by gevent, and block
+        parent_sock, child_sock = _socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                parent_sock.close()
+                cls.run(child_sock, serve)
+            finally:
+                os._exit(0)
+        child_sock.close()
+        return cls(pid, parent_sock)
+
+    @staticmethod
+    def run(sock, serve):
+        """
+        The loop of the spawner: forks a pool process for each byte received, and sends back its
+        socket and pid, until the worker closes its end of the socket
+        :param sock:
+        :param serve:
+        :return:
+        """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        while sock.recv(1):
+            process_sock, serve_sock = _socket.socketpair()
+            pid = fork_process()
+            if pid == 0:
+                try:
+                    sock.close()
+                    process_sock.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    serve(serve_sock)
+                finally:
+                    os._exit(0)
+            serve_sock.close()
+            _multiprocessing.sendfd(sock.fileno(), process_sock.fileno())
+            sock.sendall(struct.pack('!I', pid))
+            process_sock.close()
+
+    def fork(self):
+        """
+        Has the spawner fork a pool process
+        :raises: WorkerException: if the spawner is gone
+        :return: a WorkerProcess
+        """
+        try:
+            self.sock.sendall('f')
+            fd = _multiprocessing.recvfd(self.sock.fileno())
+            pid, = struct.unpack('!I', receive_exactly(self.sock, 4))
+        except (EOFError, OSError, socket.error):
+            raise WorkerException('The converter processes can\'t be started')
+        sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fd)
+        return WorkerProcess(pid, sock)
+
+    def stop(self):
+        self.sock.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+
+class ProcessPool(object):
+    """
+    Pre-forked processes that inline pages, so conversions use every core instead of taking turns
+    on the GIL. The processes are forked once the parent has warmed up, so they start with every
+    import loaded, and talk to the parent over socket pairs, which gevent workers wait on
+    cooperatively. At most processes conversions run and queue_size wait at once, further
+    conversions are rejected straight away with a PoolFullException. The processes, and the ones
+    that replace processes that died or timed out, are forked by a Spawner
+    """
+    def __init__(self, processes=0, queue_size=8, timeout=30, retry_after=5, config=None):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.config = config or {}
+        self.workers = []
+        self.idle = None
+        self.admission = None
+        self.pid = None
+        self.spawner = None
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def configure(self, config):
+        self.processes = config.get('INLINE_PROCESSES', self.processes)
+        self.queue_size = config.get('INLINE_QUEUE_SIZE', self.queue_size)
+        self.timeout = config.get('INLINE_TIMEOUT', self.timeout)
+        self.retry_after = config.get('INLINE_RETRY_AFTER', self.retry_after)
+        self.config = dict(config)
+
+    @property
+    def enabled(self):
+        return self.processes > 0
+
+    def start(self):
+        """
+        Forks the spawner and the pool processes, if they haven't been forked by this process yet.
+        Called by gunicorn once a worker has loaded the app, before it serves requests, which a
+        gevent worker must do. Otherwise called on first use
+        :return:
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            warm_up()
+            self.pid = os.getpid()
+            self.workers = []
+            self.idle = Queue()
+            self.admission = threading.BoundedSemaphore(self.processes + self.queue_size)
+            self.spawner = Spawner.start(self.serve)
+            for i in range(self.processes):
+                worker = self.spawner.fork()
+                self.workers.append(worker)
+                self.idle.put(worker)
+
+    def stop(self):
+        """
+        Closes the sockets of the pool processes and of the spawner, which exit once they are closed
+        :return:
+        """
+        with self.lock:
+            for worker in self.workers:
+                worker.sock.close()
+            self.workers = []
+            if self.spawner is not None and self.pid == os.getpid():
+                self.spawner.stop()
+            self.spawner = None
+            self.pid = None
+
+    def serve(self, sock):
+        """
+        The loop of a pool process: receives (function, args) messages and sends back ('ok', result)
+        or ('error', exception) until the parent closes its end of the socket
+        :param sock:
+        :return:
+        """
+        for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2, signal.SIGQUIT):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        global worker_image_prober
+        reset_after_fork()
+        stylesheet_cache.configure(self.config)
+        worker_image_prober = ImageProber()
+        worker_image_prober.configure(self.config)
+
+        while True:
+            try:
+                data = receive_data(sock)
+            except EOFError:
+                return
+            # noinspection PyBroadException
+            try:
+                function, args = pickle.loads(data)
+                result = ('ok', function(*args))
+            except Exception as e:
+                result = ('error', e)
+            # noinspection PyBroadException
+            try:
+                data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                error = WorkerException('%s: %s' % (type(result[1]).__name__, result[1]))
+                data = pickle.dumps(('error', error), pickle.HIGHEST_PROTOCOL)
+            send_data(sock, data)
+
+    def run(self, function, *args):
+        """
+        Runs a function in a pool process, waiting for a free one if every process is busy
+        :param function: a module level function
+        :param args: picklable arguments
+        :raises: PoolFullException: if processes + queue_size conversions are already running or waiting
+        :return: what the function returns
+        """
+        self.start()
+        if not self.admission.acquire(False):
+            with self.lock:
+                self.rejected += 1
+            raise PoolFullException(self.retry_after)
+        try:
+            worker = self.idle.get()
+            try:
+                worker.sock.settimeout(self.timeout)
+                send_message(worker.sock, (function, args))
+                status, result = receive_message(worker.sock)
+            except (EOFError, socket.error):
+                # the process died or took longer than the timeout, it's replaced by a new one
+                worker = self.replace(worker)
+                raise WorkerException('The converter process stopped while converting')
+            except Exception:
+                # a message that couldn't be pickled or unpickled may leave the socket out of step, with
+                # the next conversion reading this one's reply
+                worker = self.replace(worker)
+                raise
+            finally:
+                self.idle.put(worker)
+        finally:
+            self.admission.release()
+        if status == 'error':
+            raise result
+        return result
+
+    def replace(self, worker):
+        worker.sock.close()
+        try:
+            # the spawner reaps it
+            os.kill(worker.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        with self.lock:
+            replacement = self.spawner.fork()
+            self.workers = [replacement if w is worker else w for w in self.workers]
+        return replacement
+
+    def stats(self):
+        return {
+            'processes': self.processes,
+            'idle': self.idle.qsize() if self.idle is not None else self.processes,
+            'rejected': self.rejected,
+        }
+
+
+class PooledMessagingScraper(MessagingScraper):
+    """
+    MessagingScraper that parses, checks and inlines pages in the ProcessPool. The page is fetched
+    and its links are checked in the calling worker, which only waits on the network
+    """
+    def __init__(self, start_index=0, cache=None, link_checker=None, image_prober=None, backend=None, pool=None,
+                 compactor=None):
+        """
+        :param pool: the ProcessPool to convert in, the shared process_pool if None
+        """
+        MessagingScraper.__init__(self, start_index, cache=cache, link_checker=link_checker, image_prober=image_prober,
+                                  backend=backend, compactor=compactor)
+        self.pool = pool if pool is not None else process_pool
+
+    def convert(self, url, page):
+        """
+        Inlines and checks a fetched page in the pool
+        :param url:
+        :param page: a FetchedPage
+        :return: the inlined content and the visited checks, to be finished with ArticleUtils.finish_visitors
+        """
+        return self.pool.run(inline_page, url, page.status_code, page.headers, page.content, self.utils.checks,
+                             self.utils.image_prober is not None, self.utils.backend)
+
+
+process_pool = ProcessPool()
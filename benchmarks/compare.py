@@ -0,0 +1,82 @@
+"""
+Compares two benchmark results saved by suite.py
+
+    python benchmarks/compare.py benchmarks/results/<before>.json benchmarks/results/<after>.json [--threshold 10]
+
+Prints the change of each measurement per fixture, and exits with 1 if any got worse by more than
+threshold percent
+"""
+import argparse
+import json
+import sys
+
+# (name, path in the fixture results, whether a higher value is better)
+MEASUREMENTS = [
+    ('scrape median s', ('scrape_seconds', 'median'), False),
+    ('scrape p95 s', ('scrape_seconds', 'p95'), False),
+    ('peak memory KB', ('peak_memory_kb', ), False),
+    ('requests/s', ('throughput', 'requests_per_second'), True),
+    ('request p95 s', ('throughput', 'latency_seconds', 'p95'), False),
+]
+
+
+def lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def compare(before, after, threshold):
+    """
+    Prints the changes between two results
+    :param before: the results of suite.py for the older commit
+    :param after: the results for the newer commit
+    :param threshold: percent a measurement may get worse by
+    :return: the list of (fixture, measurement, percent) that got worse by more than threshold
+    """
+    regressions = []
+    print '%-10s %-18s %12s %12s %9s' % ('fixture', 'measurement', before['commit'], after['commit'], 'change')
+    for fixture in sorted(after['fixtures']):
+        if fixture not in before['fixtures']:
+            continue
+        for name, path, higher_is_better in MEASUREMENTS:
+            old = lookup(before['fixtures'][fixture], path)
+            new = lookup(after['fixtures'][fixture], path)
+            if old is None or new is None:
+                continue
+            change = (new - old) * 100.0 / old if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = ' !'
+                regressions.append((fixture, name, change))
+            print '%-10s %-18s %12s %12s %+8.1f%%%s' % (fixture, name, old, new, change, flag)
+
+        before_stages = before['fixtures'][fixture].get('stage_seconds', {})
+        after_stages = after['fixtures'][fixture].get('stage_seconds', {})
+        for stage in sorted(set(before_stages) | set(after_stages)):
+            print '%-10s %-18s %12s %12s' % (fixture, '  ' + stage, before_stages.get(stage, '-'),
+                                             after_stages.get(stage, '-'))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares two benchmark results')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent a measurement may get worse by')
+    args = parser.parse_args()
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        regressions = compare(json.load(before_file), json.load(after_file), args.threshold)
+
+    if regressions:
+        print '%d measurements got worse by more than %.0f%%' % (len(regressions), args.threshold)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of ArticleUtils.unicode_to_html_entities against the original byte by byte
+implementation, on a newsletter of about 500 KB
+
+    python benchmarks/entities.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from utils import ArticleUtils
+
+
+def original_unicode_to_html_entities(content_string):
+    """
+    the implementation unicode_to_html_entities replaced, without its debugging print. It reads
+    every non-ascii character as a 4 byte sequence, so the sample text keeps at least three ascii
+    bytes after each multi-byte character
+    :param content_string:
+    :return:
+    """
+    transformed = ""
+    i = 0
+    while i < len(content_string):
+        if ord(content_string[i]) >= 128:
+            temp = content_string[i] + content_string[i + 1] + content_string[i + 2] + content_string[i + 3]
+
+            try:
+                transformed += temp.decode('utf-8').encode('ascii', 'xmlcharrefreplace')
+            except UnicodeDecodeError as e:
+                transformed += temp.decode('iso-8859-1').encode('ascii', 'xmlcharrefreplace')
+            i += 4
+        else:
+            transformed += content_string[i]
+            i += 1
+
+    return transformed
+
+
+def make_newsletter(size=500 * 1024):
+    """
+    builds a newsletter-like utf-8 document of roughly size bytes
+    :param size:
+    :return:
+    """
+    story = u'<tr><td class="story"><h2>Caf\xe9 opening on the \u201cUpper Quarry\u201d</h2>' \
+            u'<p>Students \u2014 and faculty \u2014 are invited to the r\xe9sum\xe9 workshop. ' \
+            u'It\u2019s free &amp; open to all.</p></td></tr>\n'
+    story = story.encode('utf-8')
+    return '<html><body><table>' + story * (size // len(story)) + '</table></body></html>'
+
+
+def main():
+    utils = ArticleUtils()
+    newsletter = make_newsletter()
+    assert utils.unicode_to_html_entities(newsletter) == original_unicode_to_html_entities(newsletter)
+
+    runs = 3
+    original = min(timeit.repeat(lambda: original_unicode_to_html_entities(newsletter), number=1, repeat=runs))
+    current = min(timeit.repeat(lambda: utils.unicode_to_html_entities(newsletter), number=1, repeat=runs))
+
+    print 'document size: %d bytes' % len(newsletter)
+    print 'original: %.4fs' % original
+    print 'current:  %.4fs' % current
+    print 'speedup:  %.1fx' % (original / current)
+
+
+if __name__ == '__main__':
+    main()
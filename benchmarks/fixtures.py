@@ -0,0 +1,190 @@
+"""
+Newsletter fixtures for the benchmark suite, and a stub server that serves them
+
+Pages recorded from emailbuilder.ucsc.edu with record.py are read from benchmarks/fixtures/<name>.html.
+Fixtures that haven't been recorded are built here in the emailbuilder layout: a centered email
+content table of stories with images, links and a stylesheet, at three sizes. The stub server is an
+http proxy, so the app requests the real emailbuilder.ucsc.edu urls and the domain and page checks
+run as they do in production
+"""
+import io
+import os
+import random
+import threading
+import time
+import zlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+from PIL import Image
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+HOST = 'http://emailbuilder.ucsc.edu'
+
+# (name, stories, images per story, links per story) of the fixtures built when none is recorded
+SIZES = [
+    ('small', 1, 1, 2),
+    ('typical', 8, 1, 4),
+    ('large', 80, 2, 5),
+]
+
+STYLESHEET = '''
+body { margin: 0; font-family: Georgia, serif; }
+table.main { width: 600px; background-color: #ffffff; }
+td.story { padding: 10px 20px; border-bottom: 1px solid #dddddd; }
+h1 { color: #003c6c; font-size: 28px; }
+h2 { color: #003c6c; font-size: 20px; margin: 0 0 8px 0; }
+p { color: #333333; font-size: 14px; line-height: 20px; }
+p.caption { color: #777777; font-size: 12px; font-style: italic; }
+a { color: #006aad; text-decoration: underline; }
+td.footer p { font-size: 11px; color: #999999; }
+'''
+
+
+def fixture_url(name):
+    return '%s/benchmarks/%s/index.html' % (HOST, name)
+
+
+def build_page(name, stories, images, links):
+    """
+    Builds a newsletter page in the emailbuilder layout
+    :param name: the fixture name, used in the image and link urls
+    :param stories:
+    :param images: images per story
+    :param links: links per story
+    :return: the utf-8 encoded page
+    """
+    rows = []
+    for story in range(stories):
+        parts = [u'<tr><td class="story">', u'<h2>Story %d: Caf\xe9 opening on the \u201cUpper Quarry\u201d</h2>' % story]
+        for image in range(images):
+            index = story * images + image
+            # some images leave out their size, so the image prober has something to do
+            if index % 2:
+                parts.append(u'<img src="/images/%s/%d.png" alt="Photo %d"/>' % (name, index, index))
+            else:
+                parts.append(u'<img src="/images/%s/%d.png" alt="Photo %d" width="560" height="315"/>'
+                             % (name, index, index))
+            parts.append(u'<p class="caption">Photo %d \u2014 UC Santa Cruz</p>' % index)
+        for link in range(links):
+            parts.append(u'<p>Students \u2014 and faculty \u2014 are invited to the r\xe9sum\xe9 workshop. '
+                         u'<a href="/news/%s/%d-%d.html">Read more</a></p>' % (name, story, link))
+        parts.append(u'</td></tr>')
+        rows.append(u''.join(parts))
+
+    page = u'<!DOCTYPE html><html><head><meta charset="utf-8"><title>%s newsletter</title>' \
+           u'<link rel="stylesheet" href="/css/newsletter.css">' \
+           u'<style>td.story img { display: block; } .ignore { display: none; }</style>' \
+           u'</head><body>' \
+           u'<table align="center" summary="Email content" class="main">' \
+           u'<tr><td><h1>UC Santa Cruz %s newsletter</h1></td></tr>%s' \
+           u'<tr><td class="footer"><p>University of California, Santa Cruz</p></td></tr>' \
+           u'</table></body></html>' % (name, name, u'\n'.join(rows))
+    return page.encode('utf-8')
+
+
+def load_fixtures():
+    """
+    Returns the fixture pages, recorded ones where they exist
+    :return: a list of (name, url, page) tuples, smallest first
+    """
+    fixtures = []
+    for name, stories, images, links in SIZES:
+        path = os.path.join(FIXTURE_DIR, name + '.html')
+        if os.path.exists(path):
+            with open(path, 'rb') as recorded:
+                page = recorded.read()
+        else:
+            page = build_page(name, stories, images, links)
+        fixtures.append((name, fixture_url(name), page))
+    return fixtures
+
+
+def make_png(index):
+    """
+    a small png of a size that depends on its index, so image sizes differ
+    :param index:
+    :return:
+    """
+    size = (200 + index % 7 * 40, 100 + index % 5 * 30)
+    image = Image.new('RGB', size, (random.Random(index).randint(0, 255), 90, 160))
+    buf = io.BytesIO()
+    image.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """
+    Answers proxied requests for the fixture pages, their stylesheet, images and links
+    """
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def respond(self, send_body):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        path = urlparse(self.path).path
+        status, content_type, body = self.server.route(path)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubProxy(ThreadingMixIn, HTTPServer):
+    """
+    A local http proxy answering for emailbuilder.ucsc.edu, waiting delay seconds before each
+    response to stand in for the network
+    """
+    daemon_threads = True
+
+    def __init__(self, fixtures, delay=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ProxyHandler)
+        self.delay = delay
+        self.pages = dict((urlparse(url).path, page) for name, url, page in fixtures)
+        self.images = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def route(self, path):
+        """
+        Serves the fixture pages by path. Any other host or path is answered too, so recorded pages
+        whose images, stylesheets and links point elsewhere still convert without errors
+        :param path:
+        :return: the status, content type and body
+        """
+        if path in self.pages:
+            return 200, 'text/html; charset=UTF-8', self.pages[path]
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.css':
+            return 200, 'text/css', STYLESHEET
+        if extension in ('.png', '.jpg', '.jpeg', '.gif'):
+            index = zlib.crc32(path) & 0xffff
+            with self.lock:
+                if index not in self.images:
+                    self.images[index] = make_png(index)
+                return 200, 'image/png', self.images[index]
+        return 200, 'text/html; charset=UTF-8', '<html><body><p>Story</p></body></html>'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
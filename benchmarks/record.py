@@ -0,0 +1,42 @@
+"""
+Records emailbuilder pages as benchmark fixtures, replacing the built ones of the same name
+
+    python benchmarks/record.py typical=http://emailbuilder.ucsc.edu/... large=http://emailbuilder.ucsc.edu/...
+
+The fixture names are small, typical and large. The page is saved as it was downloaded, its images,
+links and stylesheets are served by the stub server
+"""
+import os
+import sys
+import requests
+from fixtures import FIXTURE_DIR, SIZES
+
+
+def record(name, url):
+    response = requests.get(url, timeout=(3.05, 30))
+    response.raise_for_status()
+    if not os.path.isdir(FIXTURE_DIR):
+        os.makedirs(FIXTURE_DIR)
+    path = os.path.join(FIXTURE_DIR, name + '.html')
+    with open(path, 'wb') as fixture:
+        fixture.write(response.content)
+    return path, len(response.content)
+
+
+def main(args):
+    names = [size[0] for size in SIZES]
+    if not args:
+        print __doc__
+        return 1
+    for arg in args:
+        name, _, url = arg.partition('=')
+        if name not in names or not url:
+            print 'expected name=url with name one of %s, got %s' % (', '.join(names), arg)
+            return 1
+        path, size = record(name, url)
+        print 'recorded %s (%d bytes) to %s' % (url, size, path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
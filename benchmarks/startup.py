@@ -0,0 +1,182 @@
+"""
+Benchmarks how long the app takes to start and how much memory its gunicorn workers use
+
+    python benchmarks/startup.py [--runs 5] [--workers 2] [--no-gunicorn] [--output startup.json]
+
+It measures, each in new processes:
+    - the time to import the app, and which heavy modules the import loads
+    - the time of the first conversion after the import, which loads the rest
+    - for gunicorn with and without --preload: the seconds until the first request is answered,
+      and the memory private to each worker (Linux only), after conversions of a fixture served by
+      the stub proxy of suite.py
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import requests
+from fixtures import StubProxy, load_fixtures
+from suite import percentile, git_commit
+
+# the modules looked for in sys.modules after the import
+HEAVY_MODULES = ['premailer', 'cssutils', 'bs4', 'lxml.etree', 'requests', 'PIL.Image', 'gevent', 'sqlite3']
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+started = time.time()
+import app
+imported = time.time()
+loaded = [name for name in %r if name in sys.modules]
+from app.workers import warm_up
+warm_up()
+print json.dumps({
+    'import_seconds': imported - started,
+    'first_conversion_seconds': time.time() - imported,
+    'loaded': loaded,
+})
+''' % HEAVY_MODULES
+
+
+def measure_import(runs):
+    """
+    :param runs: the number of new interpreters to import the app in
+    :return: the median times, and the heavy modules the import loads before any conversion
+    """
+    results = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], cwd=ROOT_DIR)
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'import_seconds': round(percentile([result['import_seconds'] for result in results], 50), 6),
+        'first_conversion_seconds': round(
+            percentile([result['first_conversion_seconds'] for result in results], 50), 6),
+        'loaded_by_import': results[0]['loaded'],
+    }
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def private_memory_kb(pid):
+    """
+    The memory of a process that isn't shared with any other, from /proc/<pid>/smaps
+    :param pid:
+    :return: kilobytes, or None where there is no /proc
+    """
+    path = '/proc/%d/smaps' % pid
+    if not os.path.exists(path):
+        return None
+    total = 0
+    with open(path) as smaps:
+        for line in smaps:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                total += int(line.split()[1])
+    return total
+
+
+def child_pids(pid):
+    try:
+        output = subprocess.check_output(['ps', '-o', 'pid=', '--ppid', str(pid)])
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return [int(line) for line in output.split()]
+
+
+def measure_gunicorn(preload, workers, proxy, url, timeout=60):
+    """
+    Starts gunicorn with the app's settings, converts a page in each worker and stops it
+    :param preload: whether to load the app in the master before forking the workers
+    :param workers:
+    :param proxy: the StubProxy serving the page
+    :param url: the page to convert
+    :param timeout: seconds to wait for the first answer
+    :return: the seconds until the first answer and the private memory of each worker
+    """
+    port = free_port()
+    environ = dict(os.environ, GUNICORN_PRELOAD='1' if preload else '0', GUNICORN_WORKER_CLASS='sync',
+                   HTTP_PROXY=proxy.url, http_proxy=proxy.url, NO_PROXY='127.0.0.1,localhost',
+                   no_proxy='127.0.0.1,localhost', CHECK_BROKEN_LINKS='0', PROBE_IMAGE_SIZES='0',
+                   CONVERSION_CACHE_SIZE='0')
+    started = time.time()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn.app.wsgiapp', '-c', 'gunicorn_config.py',
+                               '-b', '127.0.0.1:%d' % port, '-w', str(workers), 'app:app'],
+                              cwd=ROOT_DIR, env=environ, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    session = requests.Session()
+    session.trust_env = False
+    try:
+        first_answer = None
+        while first_answer is None and time.time() - started < timeout:
+            try:
+                session.get('http://127.0.0.1:%d/' % port, timeout=1)
+                first_answer = time.time() - started
+            except requests.RequestException:
+                time.sleep(0.02)
+        # enough conversions that every worker has done some
+        for i in range(workers * 4):
+            session.get('http://127.0.0.1:%d/api/convert' % port, params={'url': url}, timeout=30)
+        memory = [private_memory_kb(pid) for pid in child_pids(server.pid)]
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'first_answer_seconds': round(first_answer, 3) if first_answer is not None else None,
+        'worker_private_kb': memory,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the startup time and memory of the app')
+    parser.add_argument('--runs', type=int, default=5, help='imports to time')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--no-gunicorn', dest='gunicorn', action='store_false', help='only time the import')
+    parser.add_argument('--output', help='json file to save the results in')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'import': measure_import(args.runs),
+    }
+    print 'import %.3fs, first conversion %.3fs, loaded by the import: %s' % (
+        results['import']['import_seconds'], results['import']['first_conversion_seconds'],
+        ', '.join(results['import']['loaded_by_import']))
+
+    if args.gunicorn:
+        results['gunicorn'] = {}
+        fixtures = load_fixtures()
+        name, url, page = fixtures[0]
+        proxy = StubProxy(fixtures, delay=0).start()
+        try:
+            for preload in (False, True):
+                name = 'preload' if preload else 'no_preload'
+                result = results['gunicorn'][name] = measure_gunicorn(preload, args.workers, proxy, url)
+                print 'gunicorn %-10s first answer %.3fs, worker private memory %s KB' % (
+                    name, result['first_answer_seconds'], ', '.join(str(kb) for kb in result['worker_private_kb']))
+        finally:
+            proxy.stop()
+
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+        print 'saved to %s' % args.output
+
+
+if __name__ == '__main__':
+    main()
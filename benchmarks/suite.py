@@ -0,0 +1,297 @@
+"""
+End to end benchmarks of the conversion, run offline against the fixtures in fixtures.py
+
+    python benchmarks/suite.py [--iterations 5] [--clients 8] [--requests 40] [--delay 0.02] [--warm]
+                               [--backend soup|lxml] [--output benchmarks/results/<commit>.json]
+
+For each fixture it measures:
+    - scrape latency, calling MessagingScraper.scrape in process
+    - the time spent in each stage of the scrape, from the app's instrumentation
+    - peak memory while scraping, over the memory in use before
+    - throughput and latency of /api/convert with --clients concurrent clients, through the Flask
+      app served by a threaded werkzeug server
+
+Every scrape starts from empty caches, and /api/convert runs without the conversion cache, unless
+--warm is given. The upstream server answers after --delay seconds, standing in for the network.
+Pages are parsed with the PARSER_BACKEND setting, or --backend.
+Results are saved as json, compare two runs with compare.py
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+import requests
+from fixtures import StubProxy, load_fixtures
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(int(round(percent / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(seconds):
+    return {
+        'min': round(min(seconds), 6),
+        'median': round(percentile(seconds, 50), 6),
+        'p95': round(percentile(seconds, 95), 6),
+        'mean': round(sum(seconds) / len(seconds), 6),
+    }
+
+
+class MemorySampler(object):
+    """
+    Samples the resident memory of the process every interval seconds while in use, to find its peak.
+    Uses /proc/self/statm, falling back on the process's maximum resident memory elsewhere
+    """
+    statm = '/proc/self/statm'
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.page_size = resource.getpagesize()
+        self.baseline = None
+        self.peak = None
+        self.running = False
+        self.thread = None
+
+    def rss(self):
+        if os.path.exists(self.statm):
+            with open(self.statm) as statm:
+                return int(statm.read().split()[1]) * self.page_size
+        # ru_maxrss is in kilobytes on linux and bytes on macOS, only the peak since start is known
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.peak = self.rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+        return False
+
+    def peak_kb(self):
+        return (self.peak - self.baseline) // 1024
+
+
+class Benchmark(object):
+
+    def __init__(self, proxy, iterations=5, clients=8, requests_per_fixture=40, warm=False, backend=None):
+        self.proxy = proxy
+        self.iterations = iterations
+        self.clients = clients
+        self.requests_per_fixture = requests_per_fixture
+        self.warm = warm
+
+        # the app is imported once the proxy is known, so its requests go through it
+        os.environ['HTTP_PROXY'] = os.environ['http_proxy'] = proxy.url
+        os.environ['NO_PROXY'] = os.environ['no_proxy'] = '127.0.0.1,localhost'
+        if backend is not None:
+            os.environ['PARSER_BACKEND'] = backend
+        from app import app
+        from app.utils import MessagingScraper
+        from app.cache import conversion_cache, LRUCache
+        from app.styles import stylesheet_cache
+        from app.link_checker import link_checker
+        from app.images import image_prober
+        from app.instrumentation import instrumentation
+        self.app = app
+        self.scraper_class = MessagingScraper
+        self.conversion_cache = conversion_cache
+        self.lru_cache_class = LRUCache
+        self.stylesheet_cache = stylesheet_cache
+        self.link_checker = link_checker
+        self.image_prober = image_prober
+        self.instrumentation = instrumentation
+
+    def clear_caches(self):
+        for cache in (self.conversion_cache.backend, self.stylesheet_cache.sheets, self.stylesheet_cache.rules,
+                      self.link_checker.results, self.image_prober.sizes):
+            if hasattr(cache, 'clear'):
+                cache.clear()
+
+    def scrape(self, url):
+        """
+        Scrapes a fixture iterations times
+        :param url:
+        :return: the latency, stage and memory results
+        """
+        scraper = self.scraper_class.from_config(self.app.config)
+        # the first scrape starts the thread pools and fills the selector caches
+        scraper.scrape(url)
+
+        latencies = []
+        stages = {}
+        self.instrumentation.enabled = True
+        try:
+            with MemorySampler() as memory:
+                for i in range(self.iterations):
+                    if not self.warm:
+                        self.clear_caches()
+                    self.instrumentation.start()
+                    started = time.time()
+                    scraper.scrape(url)
+                    latencies.append(time.time() - started)
+                    for stage, seconds in self.instrumentation.finish().items():
+                        stages[stage] = stages.get(stage, 0.0) + seconds
+        finally:
+            self.instrumentation.enabled = False
+
+        return {
+            'scrape_seconds': summarize(latencies),
+            'stage_seconds': dict((stage, round(seconds / self.iterations, 6)) for stage, seconds in stages.items()),
+            'peak_memory_kb': memory.peak_kb(),
+        }
+
+    def throughput(self, server_url, url):
+        """
+        Sends requests_per_fixture requests for a fixture to /api/convert from clients threads
+        :param server_url: the url of the app
+        :param url: the fixture url
+        :return: the throughput results
+        """
+        remaining = [self.requests_per_fixture]
+        lock = threading.Lock()
+        latencies = []
+        failures = [0]
+
+        def client():
+            session = requests.Session()
+            session.trust_env = False
+            while True:
+                with lock:
+                    if remaining[0] == 0:
+                        return
+                    remaining[0] -= 1
+                started = time.time()
+                response = session.get(server_url + '/api/convert', params={'url': url})
+                seconds = time.time() - started
+                with lock:
+                    latencies.append(seconds)
+                    if response.status_code != 200:
+                        failures[0] += 1
+
+        threads = [threading.Thread(target=client) for i in range(self.clients)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        return {
+            'clients': self.clients,
+            'requests': len(latencies),
+            'failures': failures[0],
+            'seconds': round(elapsed, 6),
+            'requests_per_second': round(len(latencies) / elapsed, 3),
+            'latency_seconds': summarize(latencies),
+        }
+
+    def run(self, fixtures):
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        results = {}
+        for name, url, page in fixtures:
+            results[name] = {'bytes': len(page)}
+            results[name].update(self.scrape(url))
+
+        server = make_server('127.0.0.1', 0, self.app, threaded=True, request_handler=QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        backend = self.conversion_cache.backend
+        if not self.warm:
+            self.conversion_cache.backend = self.lru_cache_class(max_size=0)
+        try:
+            server_url = 'http://127.0.0.1:%d' % server.server_port
+            for name, url, page in fixtures:
+                self.clear_caches()
+                results[name]['throughput'] = self.throughput(server_url, url)
+        finally:
+            self.conversion_cache.backend = backend
+            server.shutdown()
+        return results
+
+
+def git_commit():
+    # noinspection PyBroadException
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR).strip()
+    except Exception:
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the conversion against local fixtures')
+    parser.add_argument('--iterations', type=int, default=5, help='scrapes of each fixture')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent /api/convert clients')
+    parser.add_argument('--requests', type=int, default=40, help='/api/convert requests per fixture')
+    parser.add_argument('--delay', type=float, default=0.02, help='seconds the upstream server waits to answer')
+    parser.add_argument('--warm', action='store_true', help='keep the caches between conversions')
+    parser.add_argument('--backend', choices=['soup', 'lxml'], help='parser backend, PARSER_BACKEND by default')
+    parser.add_argument('--output', help='json file to save the results in')
+    args = parser.parse_args()
+
+    fixtures = load_fixtures()
+    proxy = StubProxy(fixtures, delay=args.delay).start()
+    try:
+        benchmark = Benchmark(proxy, iterations=args.iterations, clients=args.clients,
+                              requests_per_fixture=args.requests, warm=args.warm, backend=args.backend)
+        fixture_results = benchmark.run(fixtures)
+    finally:
+        proxy.stop()
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'fixtures': fixture_results,
+    }
+
+    output = args.output or os.path.join(BENCHMARK_DIR, 'results', '%s.json' % commit)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+    for name, url, page in fixtures:
+        result = fixture_results[name]
+        print '%-8s %8d bytes  scrape median %.3fs  p95 %.3fs  peak memory %6d KB  %.1f req/s' % (
+            name, result['bytes'], result['scrape_seconds']['median'], result['scrape_seconds']['p95'],
+            result['peak_memory_kb'], result['throughput']['requests_per_second'])
+    print 'saved to %s' % output
+
+
+if __name__ == '__main__':
+    main()
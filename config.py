@@ -2,3 +2,99 @@ import os
 
 WTF_CSRF_ENABLED = False
 SECRET_KEY = os.environ.get('SECRET_KEY')
+
+# Inlined results are cached per url and the settings they were converted with, and revalidated with
+# conditional requests. Set CONVERSION_CACHE_DIR to share the cache between gunicorn workers.
+CONVERSION_CACHE_SIZE = int(os.environ.get('CONVERSION_CACHE_SIZE', 128))
+CONVERSION_CACHE_TTL = int(os.environ.get('CONVERSION_CACHE_TTL', 24 * 60 * 60))
+CONVERSION_CACHE_DIR = os.environ.get('CONVERSION_CACHE_DIR')
+
+# With INCREMENTAL_INLINING, the top-level blocks of a page's content are converted one by one and
+# the last BLOCK_CACHE_SIZE of them are kept, so a page that was edited only has its changed blocks
+# inlined and checked again
+INCREMENTAL_INLINING = os.environ.get('INCREMENTAL_INLINING', '0') == '1'
+BLOCK_CACHE_SIZE = int(os.environ.get('BLOCK_CACHE_SIZE', 2048))
+
+# Concurrent requests for the same url share one download and conversion. Set SINGLE_FLIGHT_LOCK_DIR
+# along with CONVERSION_CACHE_DIR to have gunicorn workers wait for each other's conversions too
+SINGLE_FLIGHT = os.environ.get('SINGLE_FLIGHT', '1') == '1'
+SINGLE_FLIGHT_LOCK_DIR = os.environ.get('SINGLE_FLIGHT_LOCK_DIR')
+SINGLE_FLIGHT_TIMEOUT = int(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 60))
+
+# External stylesheets and the rules parsed from them are shared by every conversion in a process
+STYLESHEET_CACHE_SIZE = int(os.environ.get('STYLESHEET_CACHE_SIZE', 256))
+STYLESHEET_CACHE_TTL = int(os.environ.get('STYLESHEET_CACHE_TTL', 300))
+
+# Every outbound request shares one pooled session with these limits
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.3))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_MAX_RESPONSE_BYTES = int(os.environ.get('HTTP_MAX_RESPONSE_BYTES', 10 * 1024 * 1024))
+
+# With STREAM_RESULTS the result page is streamed, the inlined content is sent before the checks are
+# done. A failure of the checks is then reported and shown in the page, as the response has started
+STREAM_RESULTS = os.environ.get('STREAM_RESULTS', '0') == '1'
+
+# Links and images are requested to find broken ones, urls not checked within the deadline are
+# reported as not verified. Off by default, a conversion can wait up to the deadline for them. Their
+# statuses are kept LINK_CHECK_TTL seconds, cached conversions have their links checked again
+CHECK_BROKEN_LINKS = os.environ.get('CHECK_BROKEN_LINKS', '0') == '1'
+LINK_CHECK_DEADLINE = float(os.environ.get('LINK_CHECK_DEADLINE', 5))
+LINK_CHECK_WORKERS = int(os.environ.get('LINK_CHECK_WORKERS', 16))
+LINK_CHECK_PER_HOST = int(os.environ.get('LINK_CHECK_PER_HOST', 4))
+LINK_CHECK_TTL = int(os.environ.get('LINK_CHECK_TTL', 600))
+
+# Images without a width or height get them from the size of the image file, read from its first
+# IMAGE_PROBE_BYTES. Set IMAGE_SIZE_CACHE_DIR to keep the sizes across restarts and workers. Off by
+# default, a conversion can wait up to the deadline for them
+PROBE_IMAGE_SIZES = os.environ.get('PROBE_IMAGE_SIZES', '0') == '1'
+IMAGE_PROBE_DEADLINE = float(os.environ.get('IMAGE_PROBE_DEADLINE', 2))
+IMAGE_PROBE_WORKERS = int(os.environ.get('IMAGE_PROBE_WORKERS', 8))
+IMAGE_PROBE_BYTES = int(os.environ.get('IMAGE_PROBE_BYTES', 64 * 1024))
+IMAGE_SIZE_CACHE_DIR = os.environ.get('IMAGE_SIZE_CACHE_DIR')
+IMAGE_SIZE_CACHE_SIZE = int(os.environ.get('IMAGE_SIZE_CACHE_SIZE', 4096))
+
+# POST /batch and `flask convert` convert many urls at once
+BATCH_MAX_URLS = int(os.environ.get('BATCH_MAX_URLS', 500))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
+
+# Urls posted to /prewarm or queued with `flask prewarm` wait in the sqlite database at
+# PREWARM_QUEUE_PATH until `flask prewarm-worker` converts them into the shared CONVERSION_CACHE_DIR.
+# Failed conversions are tried PREWARM_MAX_ATTEMPTS times, PREWARM_RETRY_DELAY seconds apart at first
+PREWARM_QUEUE_PATH = os.environ.get('PREWARM_QUEUE_PATH')
+PREWARM_MAX_ATTEMPTS = int(os.environ.get('PREWARM_MAX_ATTEMPTS', 3))
+PREWARM_RETRY_DELAY = int(os.environ.get('PREWARM_RETRY_DELAY', 30))
+
+# The inlined html is compacted after Premailer when OUTPUT_COMPACTION is on: repeated, overridden and
+# default declarations, extra whitespace and comments are removed. The result page shows its size, and
+# warns when it is over OUTPUT_SIZE_BUDGET bytes, past which Gmail clips messages
+OUTPUT_COMPACTION = os.environ.get('OUTPUT_COMPACTION', '0') == '1'
+OUTPUT_SIZE_BUDGET = int(os.environ.get('OUTPUT_SIZE_BUDGET', 102000))
+
+# Pages are parsed, checked and inlined in INLINE_PROCESSES processes per worker, 0 to convert them in
+# the worker itself. When every process is busy and INLINE_QUEUE_SIZE conversions are waiting,
+# requests are answered with 503 and Retry-After: INLINE_RETRY_AFTER
+INLINE_PROCESSES = int(os.environ.get('INLINE_PROCESSES', 0))
+INLINE_QUEUE_SIZE = int(os.environ.get('INLINE_QUEUE_SIZE', 8))
+INLINE_TIMEOUT = int(os.environ.get('INLINE_TIMEOUT', 30))
+INLINE_RETRY_AFTER = int(os.environ.get('INLINE_RETRY_AFTER', 5))
+
+# Pages are parsed with BeautifulSoup (soup), or with lxml alone (lxml), which parses and checks
+# large pages several times faster and gives the same results
+PARSER_BACKEND = os.environ.get('PARSER_BACKEND', 'soup')
+
+# Time each stage of a conversion, for the Server-Timing header, the log and /metrics
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '0') == '1'
+
+# /api/convert responses larger than API_COMPRESS_MIN_SIZE bytes are sent compressed, with brotli
+# when it's installed and the client accepts it, gzip otherwise
+API_COMPRESS_MIN_SIZE = int(os.environ.get('API_COMPRESS_MIN_SIZE', 500))
+
+# Errors are sent to Slack from a background thread, repeats of an error on the same path are
+# sent as one message per SLACK_COALESCE_WINDOW seconds
+SLACK_WEBHOOK_URL = os.environ.get('SLACK_WEBHOOK_URL')
+SLACK_QUEUE_SIZE = int(os.environ.get('SLACK_QUEUE_SIZE', 100))
+SLACK_COALESCE_WINDOW = int(os.environ.get('SLACK_COALESCE_WINDOW', 60))
+SLACK_MIN_INTERVAL = float(os.environ.get('SLACK_MIN_INTERVAL', 1))
@@ -0,0 +1,44 @@
+"""
+gunicorn settings, used by the Procfile. Workers are sync workers unless GUNICORN_WORKER_CLASS is
+set to gevent, so a worker keeps serving other requests while conversions wait on upstream servers.
+The app is loaded and warmed up once in the master process, and the workers forked from it share
+its memory
+"""
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+
+# requests each gevent worker serves at once
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+# load the app before forking the workers, instead of in each of them
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+if preload_app and worker_class == 'gevent':
+    # the modules loaded in the master have to use gevent's sockets and locks, which a gevent worker
+    # only patches in once it has been forked
+    from gevent import monkey
+    monkey.patch_all()
+
+# link checks and image probes can make a conversion take a while
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+
+
+def post_worker_init(worker):
+    """
+    Forks the converter processes of a worker as soon as it has loaded the app, so the first
+    requests don't wait for them
+    """
+    from app.workers import process_pool
+    if process_pool.enabled:
+        process_pool.start()
+
+
+def when_ready(server):
+    """
+    Converts a page in the master process once the preloaded app is ready, so every worker starts with
+    Premailer imported and the caches a conversion fills loaded
+    """
+    if server.cfg.preload_app:
+        from app.workers import warm_up
+        warm_up()